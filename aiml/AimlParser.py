@@ -1,11 +1,67 @@
 from xml.sax.handler import ContentHandler
 from xml.sax.xmlreader import Locator
+from xml.parsers import expat
+import re
 import sys
 import xml.sax
 import xml.sax.handler
 
 class AimlParserError(Exception): pass
 
+# Parsed templates are stored in a compact, read-only form.  Each element is
+# a tuple (name, attributes, child, child, ...), where name is an interned
+# string and attributes is a dictionary shared by every element with the
+# same attributes.  Text elements are tuples ("text", {}, text), and their
+# whitespace has already been collapsed unless xml:space="preserve" was in
+# effect.  Nothing may modify a template (or its attribute maps) once it
+# has been created.
+_noAttributes = {}
+_sharedAttributes = {}
+_textAttributes = {
+	"default":  {"xml:space": "default"},
+	"preserve": {"xml:space": "preserve"},
+}
+_whitespaceRE = re.compile("\s+")
+
+def shareAttributes(attrs):
+	"""Return the shared attribute map with the same contents as attrs."""
+	if len(attrs) == 0:
+		return _noAttributes
+	key = tuple(sorted(attrs.items()))
+	try: return _sharedAttributes[key]
+	except KeyError:
+		shared = _sharedAttributes[key] = dict(attrs)
+		return shared
+
+def _compactText(elem):
+	"""Return the compact form of a text element."""
+	text = elem[2]
+	if elem[1].get("xml:space") == "default":
+		text = _whitespaceRE.sub(" ", text)
+	return ("text", _noAttributes, text)
+
+def _compactChildren(elem):
+	"""Return the compact form of an element whose element children are
+	already compact, but whose text children might not be.
+
+	"""
+	children = [type(e) is list and e[0] == "text" and _compactText(e) or e for e in elem[2:]]
+	return (intern(elem[0]), shareAttributes(elem[1])) + tuple(children)
+
+def compactElement(elem):
+	"""Return the compact form of an AIML element.
+
+	elem may be a template in the nested-list form used by older versions of
+	PyAIML (for example, one read from an old brain file), or a compact
+	template whose attribute maps need to be shared again after being
+	unmarshalled.
+
+	"""
+	name = intern(str(elem[0]))
+	if name == "text":
+		return _compactText(elem)
+	return (name, shareAttributes(elem[1])) + tuple([compactElement(e) for e in elem[2:]])
+
 class AimlHandler(ContentHandler):
 	# The legal states of the AIML parser
 	_STATE_OutsideAiml    = 0
@@ -18,8 +74,12 @@ class AimlHandler(ContentHandler):
 	_STATE_InsideTemplate = 7
 	_STATE_AfterTemplate  = 8
 	
-	def __init__(self, encoding = "UTF-8"):
+	def __init__(self, encoding = "UTF-8", sink = None):
+		# Completed categories are passed to sink(key, template) as soon as
+		# their </category> tag is parsed.  Without a sink, they accumulate
+		# in the categories dictionary instead.
 		self.categories = {}
+		self._sink = sink
 		self._encoding = encoding
 		self._state = self._STATE_OutsideAiml
 		self._version = ""
@@ -300,7 +360,7 @@ class AimlHandler(ContentHandler):
 			if textElemOnStack:
 				self._elemStack[-1][-1][2] += text
 			else:
-				self._elemStack[-1].append(["text", {"xml:space": self._whitespaceBehaviorStack[-1]}, text])
+				self._elemStack[-1].append(["text", _textAttributes[self._whitespaceBehaviorStack[-1]], text])
 		else:
 			# all other text is ignored
 			pass
@@ -365,10 +425,13 @@ class AimlHandler(ContentHandler):
 			if self._state != self._STATE_AfterTemplate:
 				raise AimlParserError, "Unexpected </category> tag "+self._location()
 			self._state = self._STATE_InsideAiml
-			# End the current category.  Store the current pattern/that/topic and
-			# element in the categories dictionary.
+			# End the current category.  Pass the current pattern/that/topic and
+			# element to the sink, or store them in the categories dictionary.
 			key = (self._currentPattern.strip(), self._currentThat.strip(),self._currentTopic.strip())
-			self.categories[key] = self._elemStack[-1]
+			if self._sink is not None:
+				self._sink(key, self._elemStack[-1])
+			else:
+				self.categories[key] = self._elemStack[-1]
 			self._whitespaceBehaviorStack.pop()
 		elif name == "pattern":
 			# </pattern> tags are only legal in the InsidePattern state
@@ -384,6 +447,7 @@ class AimlHandler(ContentHandler):
 			if self._state != self._STATE_InsideTemplate:
 				raise AimlParserError, "Unexpected </template> tag "+self._location()
 			self._state = self._STATE_AfterTemplate
+			self._elemStack[-1] = _compactChildren(self._elemStack[-1])
 			self._whitespaceBehaviorStack.pop()
 		elif self._state == self._STATE_InsidePattern:
 			# Certain tags are allowed inside <pattern> elements.
@@ -395,8 +459,9 @@ class AimlHandler(ContentHandler):
 				raise AimlParserError, ("Unexpected </%s> tag " % name)+self._location()
 		elif self._state == self._STATE_InsideTemplate:
 			# End of an element inside the current template.  Append the
-			# element at the top of the stack onto the one beneath it.
-			elem = self._elemStack.pop()
+			# (compacted) element at the top of the stack onto the one
+			# beneath it.
+			elem = _compactChildren(self._elemStack.pop())
 			self._elemStack[-1].append(elem)
 			self._whitespaceBehaviorStack.pop()
 			# If the element was a condition, pop an item off the
@@ -536,10 +601,263 @@ class AimlHandler(ContentHandler):
 		# All is well!
 		return True
 
-def create_parser():
-	"""Create and return an AIML parser object."""
-	parser = xml.sax.make_parser()
-	handler = AimlHandler("UTF-8")
+class TrustedAimlHandler(AimlHandler):
+	"""An AimlHandler for documents that are already known to be valid
+	AIML (for instance, because they've passed aimlvalidate.py).
+
+	It builds the same categories as AimlHandler does for a valid
+	document, but skips all of the checks on element nesting and
+	attributes, along with the machinery for recovering from errors.  Its
+	behavior on invalid documents is undefined.
+
+	"""
+	def startElement(self, name, attr):
+		# If we're inside an unknown element, ignore everything until we're
+		# out again.
+		if self._currentUnknown != "":
+			return
+		state = self._state
+		if name == "aiml":
+			self._state = self._STATE_InsideAiml
+			self._insideTopic = False
+			self._currentTopic = u""
+			try: self._version = attr["version"]
+			except KeyError: self._version = "1.0"
+			self._forwardCompatibleMode = (self._version != "1.0.1")
+			self._pushWhitespaceBehavior(attr)
+		elif state == self._STATE_OutsideAiml:
+			return
+		elif state == self._STATE_InsideTemplate and self._validInfo.has_key(name):
+			attrDict = {}
+			for k,v in attr.items():
+				attrDict[k.encode(self._encoding)] = unicode(v)
+			self._elemStack.append([name.encode(self._encoding),attrDict])
+			self._pushWhitespaceBehavior(attr)
+		elif name == "category":
+			self._state = self._STATE_InsideCategory
+			self._currentPattern = u""
+			self._currentThat = u""
+			if not self._insideTopic: self._currentTopic = u"*"
+			self._elemStack = []
+			self._pushWhitespaceBehavior(attr)
+		elif name == "pattern":
+			self._state = self._STATE_InsidePattern
+		elif name == "template":
+			if state == self._STATE_AfterPattern:
+				self._currentThat = u"*"
+			self._state = self._STATE_InsideTemplate
+			self._elemStack.append(['template',{}])
+			self._pushWhitespaceBehavior(attr)
+		elif name == "that" and state == self._STATE_AfterPattern:
+			self._state = self._STATE_InsideThat
+		elif name == "topic":
+			self._currentTopic = unicode(attr['name'])
+			self._insideTopic = True
+		elif state == self._STATE_InsidePattern:
+			self._currentPattern += u" BOT_NAME "
+		elif state == self._STATE_InsideThat:
+			self._currentThat += u" BOT_NAME "
+		else:
+			self._currentUnknown = name
+
+	def characters(self, ch):
+		if self._currentUnknown != "":
+			return
+		state = self._state
+		if state == self._STATE_InsideTemplate:
+			parent = self._elemStack[-1]
+			# Only whitespace can appear directly inside <random> and
+			# non-block-style <condition> elements, and it's ignored.
+			if parent[0] == "random" or (parent[0] == "condition" and not (parent[1].has_key("name") and parent[1].has_key("value"))):
+				return
+			text = unicode(ch)
+			last = parent[-1]
+			if type(last) is list and last[0] == "text":
+				last[2] += text
+			else:
+				parent.append(["text", _textAttributes[self._whitespaceBehaviorStack[-1]], text])
+		elif state == self._STATE_InsidePattern:
+			self._currentPattern += unicode(ch)
+		elif state == self._STATE_InsideThat:
+			self._currentThat += unicode(ch)
+
+	def endElement(self, name):
+		if self._currentUnknown != "":
+			if name == self._currentUnknown:
+				self._currentUnknown = ""
+			return
+		state = self._state
+		if state == self._STATE_OutsideAiml:
+			return
+		elif state == self._STATE_InsideTemplate:
+			elem = _compactChildren(self._elemStack.pop())
+			self._whitespaceBehaviorStack.pop()
+			if name == "template":
+				self._elemStack.append(elem)
+				self._state = self._STATE_AfterTemplate
+			else:
+				self._elemStack[-1].append(elem)
+		elif name == "category":
+			self._state = self._STATE_InsideAiml
+			key = (self._currentPattern.strip(), self._currentThat.strip(),self._currentTopic.strip())
+			if self._sink is not None:
+				self._sink(key, self._elemStack[-1])
+			else:
+				self.categories[key] = self._elemStack[-1]
+			self._whitespaceBehaviorStack.pop()
+		elif name == "pattern":
+			self._state = self._STATE_AfterPattern
+		elif name == "that" and state == self._STATE_InsideThat:
+			self._state = self._STATE_AfterThat
+		elif name == "topic":
+			self._insideTopic = False
+			self._currentTopic = u""
+		elif name == "aiml":
+			self._state = self._STATE_OutsideAiml
+			self._whitespaceBehaviorStack.pop()
+
+class _ExpatLocator(Locator):
+	"""Reports the current position of an ExpatParser."""
+	def __init__(self, parser):
+		self._parser = parser
+
+	def getColumnNumber(self):
+		return self._parser._expat.CurrentColumnNumber
+
+	def getLineNumber(self):
+		return self._parser._expat.CurrentLineNumber
+
+	def getSystemId(self):
+		return self._parser._systemId
+
+class ExpatParser:
+	"""An AIML parser that drives an AimlHandler from pyexpat directly.
+
+	This avoids the overhead of the xml.sax machinery: expat hands its
+	events straight to the handler, and buffers text so that each run of
+	character data arrives in a single characters() call.  The handler
+	builds exactly the same categories as it does under xml.sax, and
+	documents that aren't well-formed raise the same
+	xml.sax.SAXParseException.
+
+	"""
+	# Size of the buffer used for both reading the input and collecting
+	# character data.
+	_bufferSize = 65536
+
+	def __init__(self):
+		self._handler = None
+		self._expat = None
+		self._systemId = None
+
+	def getContentHandler(self):
+		return self._handler
+
+	def setContentHandler(self, handler):
+		self._handler = handler
+
+	def parse(self, source):
+		"""Parse an AIML document.  source is either a filename or an
+		open file object.
+
+		"""
+		if hasattr(source, "read"):
+			self._systemId = getattr(source, "name", "<stream>")
+			self._parse(source)
+		else:
+			self._systemId = source
+			inFile = open(source, "rb")
+			try: self._parse(inFile)
+			finally: inFile.close()
+
+	def _parse(self, inFile):
+		handler = self._handler
+		self._expat = expat.ParserCreate()
+		self._expat.buffer_text = True
+		self._expat.buffer_size = self._bufferSize
+		self._expat.StartElementHandler = handler.startElement
+		self._expat.EndElementHandler = handler.endElement
+		self._expat.CharacterDataHandler = handler.characters
+		handler.setDocumentLocator(_ExpatLocator(self))
+		handler.startDocument()
+		try:
+			while True:
+				data = inFile.read(self._bufferSize)
+				self._expat.Parse(data, len(data) == 0)
+				if len(data) == 0: break
+		except expat.ExpatError, e:
+			raise xml.sax.SAXParseException(expat.ErrorString(e.code), e, _ErrorLocator(e, self._systemId))
+		handler.endDocument()
+
+class _ErrorLocator(Locator):
+	"""Reports the position of an ExpatError."""
+	def __init__(self, error, systemId):
+		self._error = error
+		self._systemId = systemId
+
+	def getColumnNumber(self):
+		return self._error.offset
+
+	def getLineNumber(self):
+		return self._error.lineno
+
+	def getSystemId(self):
+		return self._systemId
+
+# The parser backends accepted by create_parser()
+backends = ["sax", "expat"]
+
+def create_parser(sink = None, backend = "sax", trusted = False):
+	"""Create and return an AIML parser object.
+
+	If sink is provided, each category is passed to sink(key, template) as
+	soon as it has been parsed, instead of being collected in the handler's
+	categories dictionary.
+
+	The backend argument selects the XML parser: "sax" uses the standard
+	xml.sax module, and "expat" uses the faster ExpatParser.  Both produce
+	the same categories and report errors the same way.
+
+	If trusted is True, the parser uses a TrustedAimlHandler, which skips
+	all validation.  Only use it on documents that are known to be valid.
+
+	"""
+	if backend == "sax":
+		parser = xml.sax.make_parser()
+	elif backend == "expat":
+		parser = ExpatParser()
+	else:
+		raise ValueError, "backend must be one of %s" % backends
+	if trusted:
+		handler = TrustedAimlHandler("UTF-8", sink)
+	else:
+		handler = AimlHandler("UTF-8", sink)
 	parser.setContentHandler(handler)
 	#parser.setFeature(xml.sax.handler.feature_namespaces, True)
 	return parser
+
+# Self test
+if __name__ == "__main__":
+	import cStringIO
+	def _categories(source, backend, trusted = False):
+		parser = create_parser(None, backend, trusted)
+		parser.parse(source)
+		return parser.getContentHandler().categories
+
+	# The expat backend builds the same categories as the sax one...
+	categories = _categories("self-test.aiml", "sax")
+	assert(len(categories) > 0)
+	assert(_categories("self-test.aiml", "expat") == categories)
+
+	# So does the TrustedAimlHandler, with either backend, for a valid
+	# document.
+	for backend in ["sax", "expat"]:
+		assert(_categories("self-test.aiml", backend, True) == categories)
+
+	# ...and reports badly-formed documents the same way.
+	badDoc = "<aiml version=\"1.0\">\n<category><pattern>HI</pattern>\n<template>hi</category></aiml>"
+	errors = []
+	for backend in ["sax", "expat"]:
+		try: _categories(cStringIO.StringIO(badDoc), backend)
+		except xml.sax.SAXParseException, e: errors.append(e.getLineNumber())
+	assert(errors == [3, 3])
@@ -0,0 +1,549 @@
+"""This file contains the Analyzer class, which looks for categories in a
+brain that can make pattern matching expensive.
+
+PatternMgr matches input by depth-first search, trying each way a * or _
+can split the input until it finds a template.  Patterns with several
+wildcards, particularly adjacent ones, can make it try a great many
+splits of a long input that doesn't quite match them.
+
+Usage:
+    > analyzer = Analyzer(patternMgr)
+    > print analyzer.report()
+
+"""
+
+import string
+
+class Analyzer:
+    """Estimates the worst-case cost of matching input against a
+    PatternMgr's node tree, and searches for inputs that come close to it.
+
+    Costs are counted in nodes visited by PatternMgr._match(), for inputs
+    of up to 'length' words in each of the pattern, that and topic
+    segments.  The static costs are upper bounds: they assume that every
+    branch the matcher tries fails, and that the input can contain
+    whichever word is worst at every position.
+
+    """
+    def __init__(self, patternMgr, length = 8):
+        self._mgr = patternMgr
+        self._length = length
+        self._walk = None
+        self._costs = None
+
+    def _walkTree(self):
+        """Walk the node tree, making a list of its nodes with each one
+        ahead of its children.
+
+        """
+        if self._walk is not None: return
+        mgr = self._mgr
+        # Each entry is (nid, segment, path), where path is the tuple of
+        # keys leading to the node.
+        self._walk = []
+        self._words = {}
+        stack = [(mgr._root, "pattern", ())]
+        while len(stack) > 0:
+            nid, segment, path = stack.pop()
+            self._walk.append((nid, segment, path))
+            for key, child in mgr._nodes[nid].items():
+                if key == mgr._TEMPLATE: continue
+                childSegment = segment
+                if key == mgr._THAT: childSegment = "that"
+                elif key == mgr._TOPIC: childSegment = "topic"
+                elif type(key) != int: self._words[key] = 1
+                stack.append((child, childSegment, path + (key,)))
+
+    def _analyze(self):
+        """Work out the worst-case cost of matching from each node."""
+        if self._costs is not None: return
+        self._walkTree()
+        mgr = self._mgr
+        nodes = mgr._nodes
+        length = self._length
+        # _costs[nid][n] is the largest number of nodes that matching n
+        # words from node nid can visit.  Going through the walk
+        # backwards, each node's children are done before it.
+        self._costs = {}
+        for i in range(len(self._walk) - 1, -1, -1):
+            nid, segment, path = self._walk[i]
+            node = nodes[nid]
+            costs = []
+            for n in range(length + 1):
+                cost = 1
+                if n == 0:
+                    # The matcher moves on to the next segment, if there is
+                    # one; an empty that is never matched against.
+                    if segment == "pattern" and node.has_key(mgr._THAT):
+                        cost += self._costs[node[mgr._THAT]][length]
+                    elif segment == "that" and node.has_key(mgr._TOPIC):
+                        cost += self._costs[node[mgr._TOPIC]][length]
+                else:
+                    # Each wildcard is tried with every number of words it
+                    # can match, but only one word child can match the
+                    # next word (plus the bot name, if it's that word).
+                    for key in [mgr._UNDERSCORE, mgr._STAR]:
+                        if node.has_key(key):
+                            cost += sum(self._costs[node[key]][:n])
+                    best = 0
+                    for key, child in node.items():
+                        if type(key) != int:
+                            best = max(best, self._costs[child][n-1])
+                    cost += best
+                    if node.has_key(mgr._BOT_NAME):
+                        cost += self._costs[node[mgr._BOT_NAME]][n-1]
+                costs.append(cost)
+            self._costs[nid] = costs
+
+    def _pathName(self, path):
+        return string.join([self._mgr._keyName(key) for key in path])
+
+    def _pathCost(self, path):
+        """Return the worst-case number of visits to the nodes along a path
+        (counting the root), if every alignment of the input with the path
+        is tried.
+
+        """
+        mgr = self._mgr
+        length = self._length
+        # ways[n] is the number of ways of reaching the current node with
+        # n words left in the current segment.
+        ways = [0] * length + [1]
+        total = 1
+        for key in path:
+            newWays = [0] * (length + 1)
+            if key == mgr._THAT or key == mgr._TOPIC:
+                newWays[length] = ways[0]
+            elif key == mgr._STAR or key == mgr._UNDERSCORE:
+                for m in range(length):
+                    newWays[m] = sum(ways[m+1:])
+            else:
+                newWays[:length] = ways[1:]
+            ways = newWays
+            total += sum(ways)
+        return total
+
+    def nodeCosts(self, limit = 20):
+        """Return a list of (cost, path) tuples for the nodes with the
+        highest worst-case cost of matching from that node, highest
+        first.  Only nodes with wildcard children, where the matcher has
+        to try more than one split of the input, are included.  path is
+        the keys leading to the node, as a string.
+
+        """
+        self._analyze()
+        mgr = self._mgr
+        results = []
+        depth = {}
+        for nid, segment, path in self._walk:
+            node = mgr._nodes[nid]
+            if not (node.has_key(mgr._STAR) or node.has_key(mgr._UNDERSCORE)):
+                continue
+            # Every key on the way down consumes at least one word, so a
+            # node at depth d in its segment has at most length-d left.
+            d = 0
+            for key in path:
+                if key == mgr._THAT or key == mgr._TOPIC: d = 0
+                else: d += 1
+            if d > self._length:
+                continue
+            results.append((self._costs[nid][self._length - d], self._pathName(path)))
+        results.sort(key=lambda result: -result[0])
+        return results[:limit]
+
+    def categoryCosts(self, limit = 20):
+        """Return a list of (cost, path) tuples for the categories whose
+        paths have the highest worst-case number of node visits, highest
+        first.  path is the category's pattern, that and topic as a
+        string, e.g. "* YOU * <that> * <topic> *".
+
+        """
+        return [(cost, self._pathName(path)) for cost, path in self._categoryPaths(limit)]
+
+    def _categoryPaths(self, limit):
+        """Like categoryCosts(), but the paths are tuples of keys."""
+        self._walkTree()
+        mgr = self._mgr
+        results = []
+        for nid, segment, path in self._walk:
+            if mgr._nodes[nid].has_key(mgr._TEMPLATE):
+                results.append((self._pathCost(path), path))
+        results.sort(key=lambda result: -result[0])
+        return results[:limit]
+
+    def _visited(self, words, botName):
+        result = self._mgr.explain(string.join(words), u"", u"", botName)
+        visited = 0
+        for counts in result["segments"].values():
+            visited += counts["visited"]
+        return visited
+
+    def adversarialInputs(self, count = 10, candidates = 50, botName = None):
+        """Search for inputs that make the matcher visit as many nodes as
+        possible.
+
+        For each of the 'candidates' most expensive categories, an input
+        is built from the words in its pattern, padded out to the analysis
+        length with a word that appears nowhere in the brain.  Each word
+        of the input is then replaced in turn by whichever of those words
+        makes matching visit the most nodes.  The number of nodes visited
+        is measured with PatternMgr.explain(), with an empty that and
+        topic.
+
+        Returns a list of up to 'count' (visited, input, path) tuples, most
+        expensive first, where path is the category the input was built
+        from.
+
+        """
+        self._walkTree()
+        mgr = self._mgr
+        filler = u"XYZZY"
+        while self._words.has_key(filler):
+            filler += u"Y"
+        found = {}
+        for cost, path in self._categoryPaths(candidates):
+            vocabulary = [filler]
+            words = []
+            for key in path:
+                if key == mgr._THAT or key == mgr._TOPIC:
+                    break
+                if key == mgr._STAR or key == mgr._UNDERSCORE:
+                    words.append(filler)
+                    continue
+                if key == mgr._BOT_NAME:
+                    key = botName or mgr._botName
+                elif key != key.upper() or mgr._puncStripRE.search(key):
+                    # No input can match this word.
+                    key = filler
+                words.append(key)
+                if key not in vocabulary:
+                    vocabulary.append(key)
+            words = (words + [filler] * self._length)[:self._length]
+            best = self._visited(words, botName)
+            # Two passes of coordinate ascent are usually enough to settle.
+            for i in range(2):
+                for pos in range(len(words)):
+                    for word in vocabulary:
+                        if word == words[pos]: continue
+                        trial = words[:pos] + [word] + words[pos+1:]
+                        visited = self._visited(trial, botName)
+                        if visited > best:
+                            best = visited
+                            words = trial
+            input = string.join(words)
+            if not found.has_key(input):
+                found[input] = (best, input, self._pathName(path))
+        results = found.values()
+        results.sort(key=lambda result: -result[0])
+        return results[:count]
+
+    def sraiCycles(self, normalize = None, botName = None):
+        """Return a list of the <srai> cycles that can be found without
+        running the brain: chains of categories whose templates contain
+        a <srai> with constant text that matches the next category in
+        the chain, leading back to the first.  Each cycle is a list of
+        category paths (as in categoryCosts()), with the first category
+        repeated at the end.
+
+        If normalize is provided, it is applied to the text of each
+        <srai> first, as Kernel._respond() does with its 'normal'
+        substitutions.  The text is matched with an empty that and topic,
+        so the categories that only match in a particular context are
+        never the target of a <srai>.
+
+        """
+        edges, tids, paths = self._sraiGraph(normalize, botName)
+        cycles = []
+        for component in _stronglyConnected(edges):
+            first = component[0]
+            if len(component) == 1 and first not in edges[first]:
+                continue
+            # Find the shortest way from the first category back to itself.
+            members = dict.fromkeys(component)
+            previous = {}
+            queue = [first]
+            while len(queue) > 0 and not previous.has_key(first):
+                nid = queue.pop(0)
+                for target in edges[nid]:
+                    if members.has_key(target) and not previous.has_key(target):
+                        previous[target] = nid
+                        queue.append(target)
+            cycle = [first]
+            nid = previous[first]
+            while nid != first:
+                cycle.insert(0, nid)
+                nid = previous[nid]
+            cycle.insert(0, first)
+            cycles.append([self._pathName(paths[nid]) for nid in cycle])
+        return cycles
+
+    def purity(self, normalize = None, botName = None):
+        """Classify the templates in the brain by whether their output
+        depends on anything besides the input that matched them (with its
+        that and topic), the bot predicates and the word substitutions.
+
+        Returns a dictionary mapping each template id to one of:
+         - 'impure': the template uses a tag that reads or changes the
+           state of the session or of the outside world, such as <set>,
+           <get>, <random>, <date>, <system>, <condition> or <that>, or
+           it leads to such a template through <srai> elements with
+           constant text.
+         - 'dynamic': the template contains <sr> or a <srai> whose text
+           depends on the input, so whether it is pure can only be told
+           while responding.
+         - 'pure': neither; every response it gives to an input is the
+           same.
+
+        The normalize and botName parameters are used to find the targets
+        of <srai> elements, as in sraiCycles().
+
+        """
+        edges, tids, paths = self._sraiGraph(normalize, botName)
+        mgr = self._mgr
+        # Classify each template on its own, and join them up through
+        # their <srai> targets.
+        ranks = {"pure": 0, "dynamic": 1, "impure": 2}
+        local = {}
+        graph = {}
+        for nid, tid in tids.items():
+            if not local.has_key(tid):
+                local[tid] = ranks[_localPurity(mgr._template(tid))]
+                graph[tid] = []
+            for target in edges[nid]:
+                if tids[target] not in graph[tid]:
+                    graph[tid].append(tids[target])
+        # The components come out with everything they lead to ahead of
+        # them, so the targets' classes are always known.
+        names = ["pure", "dynamic", "impure"]
+        result = {}
+        for component in _stronglyConnected(graph):
+            rank = 0
+            for tid in component:
+                rank = max(rank, local[tid])
+                for target in graph[tid]:
+                    if result.has_key(target):
+                        rank = max(rank, ranks[result[target]])
+            for tid in component:
+                result[tid] = names[rank]
+        return result
+
+    def _sraiGraph(self, normalize, botName):
+        """Return a tuple (edges, tids, paths) of dictionaries, mapping
+        the id of each node with a template to the ids of the nodes that
+        its <srai> elements with constant text lead to, to its template
+        id, and to its path.  See sraiCycles() for the parameters.
+
+        """
+        self._walkTree()
+        mgr = self._mgr
+        nodes = mgr._nodes
+        edges = {}
+        tids = {}
+        paths = {}
+        # Identical templates are shared, so they only need to be looked
+        # at once.
+        targets = {}
+        for nid, segment, path in self._walk:
+            node = nodes[nid]
+            if not node.has_key(mgr._TEMPLATE):
+                continue
+            paths[nid] = path
+            tid = tids[nid] = node[mgr._TEMPLATE]
+            if not targets.has_key(tid):
+                targets[tid] = []
+                for text in _constantSrais(mgr._template(tid)):
+                    if normalize is not None: text = normalize(text)
+                    target = self._matchNode(text, botName)
+                    if target is not None and target not in targets[tid]:
+                        targets[tid].append(target)
+            edges[nid] = targets[tid]
+        return edges, tids, paths
+
+    def _matchNode(self, text, botName):
+        """Return the id of the node holding the template that text
+        matches, or None.
+
+        """
+        mgr = self._mgr
+        if len(text) == 0:
+            return None
+        patMatch, tid = mgr._matchPath(text, u"", u"", botName)
+        if tid is None:
+            return None
+        nid = mgr._root
+        for key in patMatch:
+            node = mgr._nodes[nid]
+            # The path holds the bot's name itself, not the BOT_NAME key.
+            if not node.has_key(key): key = mgr._BOT_NAME
+            nid = node[key]
+        return nid
+
+    def report(self, limit = 10, adversarial = 5):
+        """Return a summary of the analysis as a string, listing the most
+        expensive nodes, categories and (unless adversarial is 0) inputs.
+
+        """
+        lines = ["Worst-case node visits for inputs of %d words:" % self._length, "",
+                 "Nodes:"]
+        for cost, path in self.nodeCosts(limit):
+            lines.append("%16d  %s" % (cost, path or "(root)"))
+        lines.extend(["", "Categories:"])
+        for cost, path in self.categoryCosts(limit):
+            lines.append("%16d  %s" % (cost, path))
+        if adversarial > 0:
+            lines.extend(["", "Adversarial inputs (nodes visited, input, category):"])
+            for visited, input, path in self.adversarialInputs(adversarial):
+                lines.append("%16d  %s  [%s]" % (visited, input, path))
+        return string.join(lines, "\n")
+
+# Tags whose output depends on more than the input that matched the
+# template, or that have side effects.
+_impureTags = dict.fromkeys(["condition", "date", "get", "gossip", "id", "input",
+                             "javascript", "learn", "random", "set", "system", "that"])
+
+def _localPurity(elem):
+    """Return the class of a template (see Analyzer.purity()), ignoring
+    the templates its <srai> elements lead to.
+
+    """
+    name = elem[0]
+    if name == "text":
+        return "pure"
+    if _impureTags.has_key(name):
+        return "impure"
+    result = "pure"
+    if name == "sr":
+        result = "dynamic"
+    elif name == "srai":
+        for child in elem[2:]:
+            if child[0] != "text": result = "dynamic"
+    for child in elem[2:]:
+        purity = _localPurity(child)
+        if purity == "impure":
+            return purity
+        if purity == "dynamic":
+            result = purity
+    return result
+
+def _constantSrais(elem):
+    """Yield the text of each <srai> element in a template that contains
+    nothing but text.
+
+    """
+    if elem[0] == "text":
+        return
+    children = elem[2:]
+    if elem[0] == "srai" and len(children) > 0:
+        for child in children:
+            if child[0] != "text": break
+        else:
+            yield string.join([child[2] for child in children], "")
+            return
+    for child in children:
+        for text in _constantSrais(child):
+            yield text
+
+def _stronglyConnected(edges):
+    """Return the strongly connected components of a directed graph, given
+    as a dictionary mapping each vertex to a list of the vertices it has
+    edges to.  Uses Tarjan's algorithm, without recursion.
+
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    onStack = {}
+    components = []
+    for root in edges.keys():
+        if index.has_key(root):
+            continue
+        work = [(root, 0)]
+        while len(work) > 0:
+            vertex, i = work.pop()
+            if i == 0:
+                index[vertex] = lowlink[vertex] = len(index)
+                stack.append(vertex)
+                onStack[vertex] = True
+            else:
+                # Returning from the (i-1)'th successor.
+                lowlink[vertex] = min(lowlink[vertex], lowlink[edges[vertex][i-1]])
+            successors = edges[vertex]
+            while i < len(successors):
+                successor = successors[i]
+                i += 1
+                if not index.has_key(successor):
+                    work.append((vertex, i))
+                    work.append((successor, 0))
+                    break
+                if onStack.get(successor):
+                    lowlink[vertex] = min(lowlink[vertex], index[successor])
+            else:
+                if lowlink[vertex] == index[vertex]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack[member] = False
+                        component.append(member)
+                        if member == vertex: break
+                    component.reverse()
+                    components.append(component)
+    return components
+
+# Self test
+if __name__ == "__main__":
+    from PatternMgr import PatternMgr
+    def _template(text):
+        return ("template", {}, ("text", {}, text))
+    def _srai(text):
+        return ("template", {}, ("srai", {}, ("text", {}, text)))
+
+    # A single category is small enough to work out its costs by hand.
+    # For inputs of 2 words, the root's * child can take 1 or 2 words,
+    # and so on down through the that and topic.
+    mgr = PatternMgr()
+    mgr.add((u"* A", u"*", u"*"), _template(u"a"))
+    analyzer = Analyzer(mgr, 2)
+    assert(analyzer.nodeCosts() == [(10, u""), (6, u"* A <that>"), (3, u"* A <that> * <topic>")])
+    assert(analyzer.categoryCosts() == [(10, u"* A <that> * <topic> *")])
+    inputs = analyzer.adversarialInputs()
+    assert(len(inputs) == 1)
+    visited, input, path = inputs[0]
+    assert(input == u"XYZZY A" and path == u"* A <that> * <topic> *")
+    # The static cost is an upper bound on what matching really visits.
+    assert(visited == analyzer._visited(input.split(), None) and visited <= 10)
+
+    # <srai> cycles: PING and PONG lead to each other, and LOOP to itself.
+    # START and GREET lead somewhere without coming back, and YES can't
+    # be reached without the right that.
+    mgr = PatternMgr()
+    mgr.addMany([
+        ((u"PING", u"*", u"*"), _srai(u"pong")),
+        ((u"PONG", u"*", u"*"), _srai(u"ping")),
+        ((u"LOOP", u"*", u"*"), _srai(u"loop")),
+        ((u"START", u"*", u"*"), _srai(u"ping")),
+        ((u"GREET", u"*", u"*"), _srai(u"hello")),
+        ((u"HELLO", u"*", u"*"), _template(u"hi")),
+        ((u"YES", u"DO YOU *", u"*"), _srai(u"yes")),
+    ])
+    def _rotated(cycle):
+        # The cycle can start at any of its members.
+        cycle = cycle[:-1]
+        first = cycle.index(min(cycle))
+        return cycle[first:] + cycle[:first]
+    cycles = [_rotated(cycle) for cycle in Analyzer(mgr).sraiCycles()]
+    cycles.sort()
+    assert(cycles == [[u"LOOP <that> * <topic> *"],
+                      [u"PING <that> * <topic> *", u"PONG <that> * <topic> *"]])
+
+    # Strongly connected components come out with the ones they lead to
+    # ahead of them.
+    components = _stronglyConnected({1: [2], 2: [1, 3], 3: [], 4: [4], 5: [3]})
+    assert(sorted([sorted(component) for component in components]) == [[1, 2], [3], [4], [5]])
+    order = {}
+    for i, component in enumerate(components):
+        for vertex in component: order[vertex] = i
+    assert(order[3] < order[1] and order[3] < order[5])
+    # A long chain doesn't run into the recursion limit.
+    chain = dict([(i, [i + 1]) for i in range(5000)])
+    chain[5000] = [0]
+    assert(len(_stronglyConnected(chain)) == 1)
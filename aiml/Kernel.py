@@ -1,22 +1,29 @@
 # -*- coding: latin-1 -*-
 """This file contains the public interface to the aiml module."""
 import AimlParser
+from Analyzer import Analyzer
 import DefaultSubs
+import Metrics
 import Utils
-from PatternMgr import PatternMgr
+from PatternMgr import BudgetExceeded, MatchBudget, PatternMgr
 from WordSub import WordSub
 
 from ConfigParser import ConfigParser
+import cStringIO
+import collections
 import copy
+import gc
 import glob
 import os
 import random
 import re
 import string
 import sys
+import tarfile
 import time
 import threading
 import xml.sax
+import zipfile
 
 
 class Kernel:
@@ -24,17 +31,40 @@ class Kernel:
     _globalSessionID = "_global" # key of the global session (duh)
     _maxHistorySize = 10 # maximum length of the _inputs and _responses lists
     _maxRecursionDepth = 100 # maximum number of recursive <srai>/<sr> tags before the response is aborted.
+    _learnBatchSize = 1000 # number of parsed categories learn() queues up before adding them to the brain
     # special predicate keys
     _inputHistory = "_inputHistory"     # keys to a queue (list) of recent user input
     _outputHistory = "_outputHistory"   # keys to a queue (list) of recent responses.
     _inputStack = "_inputStack"         # Should always be empty in between calls to respond()
+    _matchStack = "_matchStack"         # The normalized (input, that, topic, tokens) of each entry on the input stack
+    _thatContext = "_thatContext"       # The last response, normalized for matching (see _normalizedContext())
+    _topicContext = "_topicContext"     # The topic, normalized for matching
+    # stand-in element for the atomic forms of <person/>, <person2/> and <sr/>
+    _atomicStar = ("star", {})
+    # the phases of respond() that hooks can be registered for
+    _hookPhases = ["respond", "sentences", "substitute", "match", "element"]
 
     def __init__(self):
         self._verboseMode = True
         self._version = "PyAIML 0.8.6"
         self._brain = PatternMgr()
+        self._brainShared = False # True if the brain is shared with clones
         self._respondLock = threading.RLock()
         self._textEncoding = "utf-8"
+        self._gcHook = None
+        self._transcript = None
+        self._hooks = None # phase -> list of (pre, post) callbacks
+        self._budgetTimeout = None
+        self._budgetNodes = None
+        self._budgetFallback = ""
+        self._budget = None # the MatchBudget of the response in progress
+        self._responseCache = None # (input, that, topic) -> response
+        self._responseCacheSize = 0
+        self._purity = None # template id -> purity class, built on demand
+        self._impureResponse = False # True if the current response can't be cached
+        self._subsVersion = 0 # incremented whenever the substitutions change
+        self._normalMemo = None # input -> 'normal' substitution, during respondBatch()
+        self._initMetrics()
 
         # set up the sessions        
         self._sessions = {}
@@ -86,7 +116,51 @@ class Kernel:
             "version":      self._processVersion,
         }
 
-    def bootstrap(self, brainFile = None, learnFiles = [], commands = []):
+    def _initMetrics(self):
+        """Create the Kernel's metrics registry (see metrics())."""
+        registry = self._metrics = Metrics.Registry()
+        self._requestCount = registry.counter("aiml_requests_total",
+            "Number of calls to respond().")
+        self._respondTime = registry.histogram("aiml_respond_seconds",
+            "Time taken by respond(), including waiting for other threads.")
+        self._sentenceCount = registry.counter("aiml_sentences_total",
+            "Number of input sentences processed.")
+        self._matchCount = registry.counter("aiml_matches_total",
+            "Number of inputs (including those from <srai> elements) that matched a category.")
+        self._noMatchCount = registry.counter("aiml_no_matches_total",
+            "Number of inputs that didn't match any category.")
+        self._sraiCount = registry.counter("aiml_srai_total",
+            "Number of <srai> and <sr> elements processed.")
+        self._recursionAbortCount = registry.counter("aiml_recursion_aborts_total",
+            "Number of inputs abandoned because <srai> recursion went too deep.")
+        self._sraiCycleCount = registry.counter("aiml_srai_cycles_total",
+            "Number of inputs abandoned because they repeated an input already being processed.")
+        self._cacheHitCount = registry.counter("aiml_response_cache_hits_total",
+            "Number of inputs answered from the response cache.")
+        self._cacheMissCount = registry.counter("aiml_response_cache_misses_total",
+            "Number of inputs looked up in the response cache and not found.")
+        registry.gauge("aiml_response_cache_entries",
+            "Number of responses in the response cache.", lambda: len(self._responseCache or ()))
+        self._budgetExceededCount = registry.counter("aiml_budget_exceeded_total",
+            "Number of responses abandoned because they ran out of time or node budget.")
+        registry.gauge("aiml_sessions",
+            "Number of active sessions.", lambda: len(self._sessions))
+        registry.gauge("aiml_categories",
+            "Number of categories in the brain.", self.numCategories)
+        self._learnCount = registry.counter("aiml_learned_files_total",
+            "Number of AIML files learned.")
+        self._learnErrorCount = registry.counter("aiml_learn_errors_total",
+            "Number of AIML files that weren't well-formed XML.")
+
+    def metrics(self):
+        """Return the Kernel's metrics registry, which counts requests,
+        matches, <srai> calls and so on.  Use its asDict() or prometheus()
+        method to read the metrics.  See the Metrics module.
+
+        """
+        return self._metrics
+
+    def bootstrap(self, brainFile = None, learnFiles = [], commands = [], checkSrai = False):
         """Prepare a Kernel object for use.
 
         If a brainFile argument is provided, the Kernel attempts to
@@ -95,6 +169,9 @@ class Kernel:
         If learnFiles is provided, the Kernel attempts to load the
         specified AIML files.
 
+        If checkSrai is True, a warning is printed for each <srai> cycle
+        found by sraiCycles().
+
         Finally, each of the input strings in the commands list is
         passed to respond().
 
@@ -110,6 +187,11 @@ class Kernel:
         except: pass
         for file in learns:
             self.learn(file)
+
+        if checkSrai:
+            for cycle in self.sraiCycles():
+                err = "WARNING: <srai> cycle: %s\n" % string.join(cycle, " -> ").encode(self._textEncoding, 'replace')
+                sys.stderr.write(err)
             
         # ditto for commands
         cmds = commands
@@ -121,6 +203,73 @@ class Kernel:
         if self._verboseMode:
             print "Kernel bootstrap completed in %.2f seconds" % (time.clock() - start)
 
+    def clone(self):
+        """Return a new Kernel that shares this Kernel's brain and word
+        substitutors.
+
+        The clone starts out with a copy of this Kernel's bot predicates
+        and settings, but has no sessions of its own.  Changing one
+        Kernel's bot predicates or substitutions doesn't affect the other,
+        so a single brain can serve several bot personalities at the cost
+        of their sessions and predicates alone.
+
+        The shared brain is treated as read-only: if either Kernel learns
+        new categories, they go into an overlay on top of the shared brain
+        (see PatternMgr), which only holds that Kernel's own categories.
+
+        """
+        kern = copy.copy(self)
+        kern._respondLock = threading.RLock()
+        kern._sessions = {}
+        kern._addSession(self._globalSessionID)
+        kern._initMetrics()
+        kern._budget = None
+        kern._normalMemo = None
+        # The clone's bot predicates can diverge from ours, so it needs a
+        # cache of its own.  The template classes only change if the brain,
+        # the substitutions or the bot's name do, and are replaced rather
+        # than updated when that happens, so the two can share them.  Work
+        # them out now, rather than in the first respond() of each.
+        if self._responseCache is not None:
+            self._classifyTemplates()
+            kern._responseCache = collections.OrderedDict()
+        kern._purity = self._purity
+        kern._botPredicates = self._botPredicates.copy()
+        # Loading substitutions replaces a WordSub rather than changing
+        # it, so the subbers themselves can be shared.
+        kern._subbers = self._subbers.copy()
+        # The element processors are bound methods; rebind them to the
+        # clone.
+        kern._elementProcessors = {}
+        for name, proc in self._elementProcessors.items():
+            if getattr(proc, "im_self", None) is self:
+                proc = proc.im_func.__get__(kern, proc.im_class)
+            kern._elementProcessors[name] = proc
+        self._brainShared = kern._brainShared = True
+        return kern
+
+    def _ownBrain(self):
+        """Make sure this Kernel's brain isn't shared with any clones,
+        before modifying it.
+
+        """
+        if self._brainShared:
+            self._brain = PatternMgr(self._brain)
+            self._brainShared = False
+            # setBotPredicate() couldn't store the name in the shared brain.
+            self._brain.setBotName(self.getBotPredicate("name"))
+
+    def _matchBotName(self):
+        """Return the name that BOT_NAME in patterns should match, or None
+        to use the name stored in the brain.
+
+        """
+        # A shared brain can't store the names of all of the Kernels that
+        # use it.
+        if self._brainShared:
+            return self.getBotPredicate("name")
+        return None
+
     def verbose(self, isVerbose = True):
         """Enable/disable verbose output mode."""
         self._verboseMode = isVerbose
@@ -154,7 +303,31 @@ class Kernel:
         """
         if self._verboseMode: print "Loading brain from %s..." % filename,
         start = time.clock()
+        if self._brainShared:
+            # Don't clobber the brain we share with our clones.
+            self._brain = PatternMgr()
+            self._brainShared = False
         self._brain.restore(filename)
+        self._clearResponseCache()
+        if self._verboseMode:
+            end = time.clock() - start
+            print "done (%d categories in %.2f seconds)" % (self._brain.numTemplates(), end)
+
+    def mergeBrain(self, filename):
+        """Merge a previously-saved 'brain' into the current one.
+
+        Unlike loadBrain(), this keeps the current contents of the brain.
+        Where both contain a category with the same pattern, that and
+        topic, the one from the file wins.
+
+        """
+        if self._verboseMode: print "Merging brain from %s..." % filename,
+        start = time.clock()
+        other = PatternMgr()
+        other.restore(filename)
+        self._ownBrain()
+        self._brain.merge(other)
+        self._clearResponseCache()
         if self._verboseMode:
             end = time.clock() - start
             print "done (%d categories in %.2f seconds)" % (self._brain.numTemplates(), end)
@@ -167,6 +340,218 @@ class Kernel:
         if self._verboseMode:
             print "done (%.2f seconds)" % (time.clock() - start)
 
+    def loadOverlay(self, filename):
+        """Load categories saved with saveOverlay() on top of the current
+        contents of the brain.
+
+        The brain must contain the same categories as the brain the
+        overlay was saved from did.  This makes it cheap to give each of
+        several clones (see clone()) a few categories of its own.
+
+        """
+        if self._verboseMode: print "Loading overlay from %s..." % filename,
+        start = time.clock()
+        overlay = PatternMgr(self._brain)
+        overlay.restoreOverlay(filename)
+        # The overlay file holds the name of the bot that saved it.
+        overlay.setBotName(self.getBotPredicate("name"))
+        self._brain = overlay
+        self._brainShared = False
+        self._clearResponseCache()
+        if self._verboseMode:
+            print "done (%.2f seconds)" % (time.clock() - start)
+
+    def saveOverlay(self, filename):
+        """Save the categories that this Kernel has learned on top of a
+        brain that it shares (or shared) with another Kernel.  See
+        loadOverlay().
+
+        """
+        if self._verboseMode: print "Saving overlay to %s..." % filename,
+        start = time.clock()
+        self._brain.saveOverlay(filename)
+        if self._verboseMode:
+            print "done (%.2f seconds)" % (time.clock() - start)
+
+    def sraiCycles(self):
+        """Return a list of the <srai> cycles in the brain that can be
+        found without running it, i.e. chains of categories whose
+        templates contain <srai> elements with constant text that lead
+        back to where they started.  Each cycle is a list of the
+        categories' paths, starting and ending with the same one.  See
+        Analyzer.sraiCycles().
+
+        Cycles whose <srai> elements depend on <star/> and the like, or
+        on a particular that or topic, are only caught while responding:
+        an input that repeats one that is already being processed is
+        abandoned.
+
+        """
+        return Analyzer(self._brain).sraiCycles(self._subbers['normal'].sub,
+                                                self._matchBotName())
+
+    def freezeBrain(self):
+        """Freeze the bot's brain, so that the garbage collector no longer
+        has to scan it.
+
+        Call this once all of the bot's AIML has been loaded.  A frozen
+        brain is read-only; learning new categories thaws it again.
+
+        """
+        self._brain.freeze()
+        # Collect right away, so that the collector gets a chance to stop
+        # tracking the objects it no longer needs to.
+        gc.collect()
+
+    def setGCHook(self, hook):
+        """Install a function to be notified of garbage collection pauses
+        that occur while responding to input.
+
+        While a hook is installed, automatic garbage collection is
+        suspended for the duration of each respond() call.  If a
+        collection fell due in the meantime, it is run and timed just
+        before respond() returns, and the hook is called with two
+        arguments: the generation that was collected and the length of
+        the pause in seconds.  Pass None to remove the hook.
+
+        """
+        self._gcHook = hook
+
+    def addHook(self, phase, pre = None, post = None):
+        """Register callbacks to be called before (pre) and after (post)
+        a phase of the work done by respond().
+
+        The phases are:
+         - 'respond': all of the work done by a call to respond().
+         - 'sentences': splitting the input into sentences.
+         - 'substitute': running text through a word substitutor.
+         - 'match': looking up the template for an input in the brain,
+           or the words matched by a <star>, <thatstar> or <topicstar>.
+         - 'element': processing an element of a template.
+        If phase is None, the callbacks are registered for all of them.
+
+        Both callbacks are called with three arguments: the phase, a
+        detail, and the session ID.  The detail is the name of the word
+        substitutor for 'substitute', the element's tag for 'element',
+        the type of star for 'match' (or None for the template lookup),
+        and None otherwise.  Phases can be nested; e.g. a <srai> element
+        contains a whole new round of substitution and matching.  The
+        post callback is called even if the phase ends with an exception.
+
+        As long as no hooks are registered, the hook checks cost next to
+        nothing.  See Timing.TimingCollector for a ready-made pair of
+        callbacks.
+
+        """
+        if phase is None:
+            for phase in self._hookPhases:
+                self.addHook(phase, pre, post)
+            return
+        if phase not in self._hookPhases:
+            raise ValueError, "unknown hook phase: %s" % phase
+        # Replace the table rather than modifying it, so that responses
+        # in progress (and clones) aren't affected.
+        hooks = {}
+        if self._hooks is not None:
+            hooks.update(self._hooks)
+        hooks[phase] = hooks.get(phase, []) + [(pre, post)]
+        self._hooks = hooks
+
+    def removeHook(self, phase, pre = None, post = None):
+        """Unregister callbacks registered with addHook()."""
+        if phase is None:
+            for phase in self._hookPhases:
+                self.removeHook(phase, pre, post)
+            return
+        if self._hooks is None:
+            return
+        hooks = dict(self._hooks)
+        remaining = [callbacks for callbacks in hooks.get(phase, []) if callbacks != (pre, post)]
+        if len(remaining) > 0:
+            hooks[phase] = remaining
+        elif hooks.has_key(phase):
+            del hooks[phase]
+        self._hooks = hooks or None
+
+    def setTranscript(self, outFile):
+        """Record every exchange handled by respond() in a transcript.
+
+        outFile is an open file (or any object with a write() method);
+        each exchange is written to it as a single line, in the format
+        described in Utils.transcriptLine().  Clones made afterwards
+        write to the same file.  Pass None to stop recording.
+
+        """
+        self._transcript = outFile
+
+    def setBudget(self, timeout = None, nodes = None, fallback = ""):
+        """Limit the work that each call to respond() can do.
+
+        timeout is the number of seconds respond() has to come up with a
+        response, counting from when it's called.  nodes is the number
+        of nodes (of the pattern tree and of templates) that matching and
+        template processing can visit in all, including any <srai>
+        recursion.  Either limit can be None, for no limit.  If a
+        response runs out of time or nodes, it is abandoned, along with
+        any input that follows, and respond() returns the fallback
+        string instead.  The limits can also be overridden in each call
+        to respond().
+
+        The deadline is checked while matching, and after each template
+        element has been processed.  A slow element (such as a <system>
+        command) isn't interrupted, but the response is abandoned as
+        soon as the element finishes.
+
+        """
+        self._budgetTimeout = timeout
+        self._budgetNodes = nodes
+        self._budgetFallback = fallback
+
+    def setResponseCache(self, size):
+        """Keep up to 'size' responses in a cache shared by all sessions,
+        or pass 0 to stop caching.
+
+        Only responses that depend on nothing but the input (after the
+        'normal' substitutions), the bot's previous response and the
+        topic are cached, including the responses to the inputs of
+        <srai> elements.  Templates are classified when the cache is
+        first used after the brain, the substitutions or the bot's name
+        change (see Analyzer.purity()), and clones share the result.  A
+        response is only cached if none of the templates used to build
+        it touched any other state.  The least recently used responses
+        are dropped when the cache is full.  The cache is emptied
+        whenever the brain, the bot predicates or the substitutions
+        change.  Its hits and misses are counted in the metrics.
+
+        """
+        self._responseCacheSize = size
+        if size > 0:
+            if self._responseCache is None:
+                self._responseCache = collections.OrderedDict()
+            while len(self._responseCache) > size:
+                self._responseCache.popitem(last = False)
+            self._classifyTemplates()
+        else:
+            self._responseCache = None
+
+    def _clearResponseCache(self, classify = True):
+        """Empty the response cache, after something it depends on has
+        changed.  Unless classify is False, the templates are classified
+        again as well (see _classifyTemplates()); their classes only
+        depend on the brain, the substitutions and the bot's name.
+
+        """
+        if classify:
+            self._purity = None
+        if self._responseCache is not None:
+            self._responseCache.clear()
+
+    def _classifyTemplates(self):
+        """Classify the templates in the brain for the response cache."""
+        if self._purity is None:
+            self._purity = Analyzer(self._brain).purity(self._subbers['normal'].sub,
+                                                        self._matchBotName())
+
     def getPredicate(self, name, sessionID = _globalSessionID):
         """Retrieve the current value of the predicate 'name' from the
         specified session.
@@ -208,8 +593,9 @@ class Kernel:
         self._botPredicates[name] = value
         # Clumsy hack: if updating the bot name, we must update the
         # name in the brain as well
-        if name == "name":
+        if name == "name" and not self._brainShared:
             self._brain.setBotName(self.getBotPredicate("name"))
+        self._clearResponseCache(name == "name")
 
     def setTextEncoding(self, encoding):
         """Set the text encoding used when loading AIML files (Latin-1, UTF-8, etc.)."""
@@ -237,6 +623,8 @@ class Kernel:
             # iterate over the key,value pairs and add them to the subber
             for k,v in parser.items(s):
                 self._subbers[s][k] = v
+        self._subsVersion += 1
+        self._clearResponseCache()
 
     def _addSession(self, sessionID):
         """Create a new session with the specified ID string."""
@@ -247,7 +635,8 @@ class Kernel:
             # Initialize the special reserved predicates
             self._inputHistory: [],
             self._outputHistory: [],
-            self._inputStack: []
+            self._inputStack: [],
+            self._matchStack: []
         }
         
     def _deleteSession(self, sessionID):
@@ -271,34 +660,170 @@ class Kernel:
             s = self._sessions
         return copy.deepcopy(s)
 
-    def learn(self, filename):
+    def learn(self, filename, backend = "sax", trusted = False, manifest = None):
         """Load and learn the contents of the specified AIML file.
 
         If filename includes wildcard characters, all matching files
-        will be loaded and learned.
+        will be loaded and learned.  Zip and tar archives (optionally
+        compressed) are recognised by their contents, and every .aiml
+        file inside them is learned, straight from the archive.
+
+        Instead of a filename, you can also pass a file-like object, or a
+        string containing an AIML document (or a whole archive).
+
+        The backend argument selects the XML parser to use: "sax" (the
+        default) or the faster "expat".  See AimlParser.create_parser().
+
+        If trusted is True, the files are assumed to be valid AIML (for
+        example, because they have already passed aimlvalidate.py), and
+        are loaded without any validation.  If a manifest file is
+        provided as well, only files whose contents are listed in the
+        manifest are trusted; the rest are validated as usual.  See
+        Utils.readManifest() for the manifest format.
+
+        Categories are learned as they are parsed, so if a file turns out
+        not to be well-formed XML, the categories preceding the error are
+        kept.
 
         """
-        for f in glob.glob(filename):
-            if self._verboseMode: print "Loading %s..." % f,
-            start = time.clock()
-            # Load and parse the AIML file.
-            parser = AimlParser.create_parser()
-            handler = parser.getContentHandler()
-            handler.setEncoding(self._textEncoding)
-            try: parser.parse(f)
-            except xml.sax.SAXParseException, msg:
-                err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (f,msg)
-                sys.stderr.write(err)
+        self._ownBrain()
+        # Each category is handed to a TreeBuilder as soon as the parser has
+        # finished with it, and the builder adds them to the PatternMgr in
+        # batches, and at the end of each file.
+        builder = self._brain.builder()
+        def addCategory(key, template):
+            builder.add(key, template)
+            if builder.size() >= self._learnBatchSize:
+                builder.finish()
+        validated = None
+        if trusted and manifest is not None:
+            validated = Utils.readManifest(manifest)
+        try:
+            for name, source in self._learnSources(filename):
+                if self._verboseMode: print "Loading %s..." % name,
+                start = time.clock()
+                # If there's a manifest, only trust the file if its contents
+                # are listed there.  Read it into memory, so that it doesn't
+                # have to be read twice.
+                trustFile = trusted
+                if validated is not None:
+                    if hasattr(source, "read"):
+                        data = source.read()
+                    else:
+                        inFile = file(source, "rb")
+                        data = inFile.read()
+                        inFile.close()
+                    trustFile = Utils.contentDigest(data) in validated
+                    source = cStringIO.StringIO(data)
+                # Load and parse the AIML file.
+                parser = AimlParser.create_parser(addCategory, backend, trustFile)
+                handler = parser.getContentHandler()
+                handler.setEncoding(self._textEncoding)
+                try: parser.parse(source)
+                except xml.sax.SAXParseException, msg:
+                    err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (name,msg)
+                    sys.stderr.write(err)
+                    self._learnErrorCount.inc()
+                    continue
+                finally:
+                    # Whatever happened, the categories parsed so far are
+                    # already in the template table, so they belong in the
+                    # tree as well.
+                    builder.finish()
+                self._learnCount.inc()
+                # Parsing was successful.
+                if self._verboseMode:
+                    print "done (%.2f seconds)" % (time.clock() - start)
+        finally:
+            self._clearResponseCache()
+
+    def _learnSources(self, source):
+        """Generate the AIML documents that learn() should load from
+        source, as (name, source) tuples.  Each source is either a filename
+        or a file-like object.
+
+        """
+        if hasattr(source, "read"):
+            # A file-like object.  If it can be rewound, it might be an
+            # archive; otherwise it had better be an AIML document.
+            name = getattr(source, "name", "<stream>")
+            members = None
+            if hasattr(source, "seek"):
+                members = self._archiveMembers(name, source)
+            if members is None:
+                yield name, source
+            else:
+                for member in members: yield member
+            return
+        if source.lstrip()[:1] == "<":
+            # The string contains the document itself.
+            if type(source) == unicode:
+                source = source.encode("utf-8")
+            yield "<string>", cStringIO.StringIO(source)
+            return
+        if type(source) == str:
+            # The string might contain a whole archive; check its contents
+            # the same way as a file's.
+            members = self._archiveMembers("<string>", cStringIO.StringIO(source))
+            if members is not None:
+                for member in members: yield member
+                return
+        for f in glob.glob(source):
+            # Don't bother looking inside files that are obviously AIML.
+            if f.lower().endswith(".aiml"):
+                yield f, f
                 continue
-            # store the pattern/template pairs in the PatternMgr.
-            for key,tem in handler.categories.items():
-                self._brain.add(key,tem)
-            # Parsing was successful.
-            if self._verboseMode:
-                print "done (%.2f seconds)" % (time.clock() - start)
+            inFile = file(f, "rb")
+            try:
+                members = self._archiveMembers(f, inFile)
+                if members is None:
+                    yield f, f
+                else:
+                    for member in members: yield member
+            finally:
+                inFile.close()
+
+    def _archiveMembers(self, name, inFile):
+        """If inFile (a seekable file-like object) contains a zip or tar
+        archive, return a generator of (name, file) tuples for the .aiml
+        files it contains, in the order they're stored.  Otherwise, return
+        None.  The members are read straight out of the archive.
+
+        """
+        pos = inFile.tell()
+        if zipfile.is_zipfile(inFile):
+            inFile.seek(pos)
+            archive = zipfile.ZipFile(inFile)
+            def members():
+                try:
+                    for info in archive.infolist():
+                        if info.filename.lower().endswith(".aiml"):
+                            yield "%s/%s" % (name, info.filename), archive.open(info)
+                finally:
+                    archive.close()
+            return members()
+        inFile.seek(pos)
+        try: archive = tarfile.open(fileobj = inFile, mode = "r:*")
+        except tarfile.TarError:
+            inFile.seek(pos)
+            return None
+        def members():
+            # Iterating over the archive reads it one member at a time.
+            try:
+                for info in archive:
+                    if info.isfile() and info.name.lower().endswith(".aiml"):
+                        yield "%s/%s" % (name, info.name), archive.extractfile(info)
+            finally:
+                archive.close()
+        return members()
+
+    def respond(self, input, sessionID = _globalSessionID, timeout = None, nodes = None):
+        """Return the Kernel's response to the input string.
+
+        If timeout or nodes is provided, it overrides the corresponding
+        limit set with setBudget() for this call.
 
-    def respond(self, input, sessionID = _globalSessionID):
-        """Return the Kernel's response to the input string."""
+        """
         if len(input) == 0:
             return ""
 
@@ -308,43 +833,317 @@ class Kernel:
         except AttributeError: pass
         
         # prevent other threads from stomping all over us.
+        start = time.time()
+        self._respondLock.acquire()
+
+        # If someone's watching for GC pauses, hold off on collecting
+        # garbage until we're done (see setGCHook()).
+        deferGC = self._gcHook is not None and gc.isenabled()
+        if deferGC: gc.disable()
+
+        try:
+            finalResponse = self._respondInput(input, sessionID, start, timeout, nodes)
+        finally:
+            # Turn garbage collection back on and release the lock, even
+            # if a hook or template raised an exception.
+            if deferGC:
+                gc.enable()
+                self._collectDeferredGarbage()
+            self._respondTime.observe(time.time() - start)
+            self._respondLock.release()
+
+        try: return finalResponse.encode(self._textEncoding)
+        except UnicodeError: return finalResponse
+
+    def respondBatch(self, requests):
+        """Respond to a list of (input, sessionID) tuples, and return the
+        list of responses, in the same order.
+
+        The inputs for each session are answered in the order they
+        appear in the list, exactly as if respond() had been called on
+        each of them in turn.  The whole batch is answered in one go,
+        without letting other threads in between inputs, which saves the
+        per-call setup of respond().  Inputs (including the inputs of
+        <srai> elements) that come up more than once in the batch only
+        go through the 'normal' substitutions once.  The limits set with
+        setBudget() apply to each input separately.
+
+        """
         self._respondLock.acquire()
+        deferGC = self._gcHook is not None and gc.isenabled()
+        if deferGC: gc.disable()
+        results = []
+        self._normalMemo = {}
+        try:
+            for input, sessionID in requests:
+                if len(input) == 0:
+                    results.append("")
+                    continue
+                try: input = input.decode(self._textEncoding, 'replace')
+                except UnicodeError: pass
+                except AttributeError: pass
+                start = time.time()
+                response = self._respondInput(input, sessionID, start)
+                self._respondTime.observe(time.time() - start)
+                try: response = response.encode(self._textEncoding)
+                except UnicodeError: pass
+                results.append(response)
+        finally:
+            self._normalMemo = None
+            if deferGC:
+                gc.enable()
+                self._collectDeferredGarbage()
+            self._respondLock.release()
+        return results
+
+    def _respondInput(self, input, sessionID, start, timeout = None, nodes = None):
+        """Do the work of respond(), for a unicode input, once the lock is
+        held.  start is the time respond() was called.  Returns the
+        response as a unicode string.
+
+        """
+        self._requestCount.inc()
 
         # Add the session, if it doesn't already exist
         self._addSession(sessionID)
 
-        # split the input into discrete sentences
-        sentences = Utils.sentences(input)
-        finalResponse = ""
-        for s in sentences:
-            # Add the input to the history list before fetching the
-            # response, so that <input/> tags work properly.
-            inputHistory = self.getPredicate(self._inputHistory, sessionID)
-            inputHistory.append(s)
-            while len(inputHistory) > self._maxHistorySize:
-                inputHistory.pop(0)
-            self.setPredicate(self._inputHistory, inputHistory, sessionID)
-            
-            # Fetch the response
-            response = self._respond(s, sessionID)
+        self._budget = self._newBudget(start, timeout, nodes)
 
-            # add the data from this exchange to the history lists
-            outputHistory = self.getPredicate(self._outputHistory, sessionID)
-            outputHistory.append(response)
-            while len(outputHistory) > self._maxHistorySize:
-                outputHistory.pop(0)
-            self.setPredicate(self._outputHistory, outputHistory, sessionID)
+        hooks = self._hooks
+        if hooks is not None:
+            for pre, post in hooks.get("respond", []):
+                if pre is not None: pre("respond", None, sessionID)
 
-            # append this response to the final response.
-            finalResponse += (response + "  ")
-        finalResponse = finalResponse.strip()
+        try:
+            # split the input into discrete sentences
+            if hooks is None:
+                sentences = Utils.sentences(input)
+            else:
+                sentences = self._hooked("sentences", None, sessionID, Utils.sentences, input)
+            self._sentenceCount.inc(len(sentences))
+            finalResponse = ""
+            for s in sentences:
+                response, exceeded = self._respondSentence(s, sessionID)
+                if exceeded:
+                    # The rest of the input is abandoned as well.
+                    finalResponse = response
+                    break
+                # append this response to the final response.
+                finalResponse += (response + "  ")
+            finalResponse = finalResponse.strip()
+        finally:
+            self._budget = None
+            if hooks is not None:
+                for pre, post in hooks.get("respond", []):
+                    if post is not None: post("respond", None, sessionID)
 
         assert(len(self.getPredicate(self._inputStack, sessionID)) == 0)
+
+        if self._transcript is not None:
+            self._transcript.write(Utils.transcriptLine(sessionID, input, finalResponse))
+        return finalResponse
+
+    def respondIter(self, input, sessionID = _globalSessionID, timeout = None, nodes = None):
+        """Generate the Kernel's response to each sentence of the input
+        string, as soon as it is ready.
+
+        The session's history is updated just as respond() would update
+        it, and respond() would return the responses joined together.
+        The timeout and nodes arguments are as in respond(), and cover
+        the whole input.  Unlike respond(), the Kernel is only locked
+        while each sentence is being answered, so other threads can use
+        it while the caller deals with each response.  The input is split
+        into sentences as it goes, so answering the first sentence
+        doesn't have to wait for the rest to be looked at.
+
+        """
+        if len(input) == 0:
+            return
+
+        #ensure that input is a unicode string
+        try: input = input.decode(self._textEncoding, 'replace')
+        except UnicodeError: pass
+        except AttributeError: pass
+
+        start = time.time()
+        hooks = self._hooks
+        self._respondLock.acquire()
+        try:
+            self._requestCount.inc()
+            self._addSession(sessionID)
+            budget = self._newBudget(start, timeout, nodes)
+            if hooks is not None:
+                for pre, post in hooks.get("respond", []):
+                    if pre is not None: pre("respond", None, sessionID)
+                sentences = self._hooked("sentences", None, sessionID, Utils.sentences, input)
+            else:
+                sentences = Utils.iterSentences(input)
+        finally:
+            self._respondLock.release()
+
+        responses = []
+        exceeded = False
+        try:
+            for s in sentences:
+                self._respondLock.acquire()
+                deferGC = self._gcHook is not None and gc.isenabled()
+                if deferGC: gc.disable()
+                try:
+                    self._sentenceCount.inc()
+                    self._budget = budget
+                    response, exceeded = self._respondSentence(s, sessionID)
+                finally:
+                    self._budget = None
+                    if deferGC:
+                        gc.enable()
+                        self._collectDeferredGarbage()
+                    self._respondLock.release()
+                responses.append(response)
+                try: response = response.encode(self._textEncoding)
+                except UnicodeError: pass
+                yield response
+                if exceeded:
+                    # The rest of the input is abandoned as well.
+                    break
+        finally:
+            self._respondLock.acquire()
+            try:
+                if self._transcript is not None:
+                    finalResponse = string.join(responses, "  ").strip()
+                    if exceeded: finalResponse = responses[-1]
+                    self._transcript.write(Utils.transcriptLine(sessionID, input, finalResponse))
+                if hooks is not None:
+                    for pre, post in hooks.get("respond", []):
+                        if post is not None: post("respond", None, sessionID)
+                self._respondTime.observe(time.time() - start)
+            finally:
+                self._respondLock.release()
+
+    def _newBudget(self, start, timeout, nodes):
+        """Return the MatchBudget for a response started at time start,
+        or None if it has no limits.  timeout and nodes override the
+        limits set with setBudget().
+
+        """
+        if timeout is None: timeout = self._budgetTimeout
+        if nodes is None: nodes = self._budgetNodes
+        if timeout is None and nodes is None:
+            return None
+        deadline = None
+        if timeout is not None: deadline = start + timeout
+        return MatchBudget(nodes, deadline)
+
+    def _respondSentence(self, s, sessionID):
+        """Answer one sentence of input, and record it and its response in
+        the session's history.  Returns a tuple (response, exceeded),
+        where exceeded is True if the response ran out of budget.
+
+        """
+        # Add the input to the history list before fetching the
+        # response, so that <input/> tags work properly.
+        inputHistory = self.getPredicate(self._inputHistory, sessionID)
+        inputHistory.append(s)
+        while len(inputHistory) > self._maxHistorySize:
+            inputHistory.pop(0)
+        self.setPredicate(self._inputHistory, inputHistory, sessionID)
         
-        # release the lock and return
-        self._respondLock.release()
-        try: return finalResponse.encode(self._textEncoding)
-        except UnicodeError: return finalResponse
+        # Fetch the response
+        exceeded = False
+        try: response = self._respond(s, sessionID)
+        except BudgetExceeded, msg:
+            exceeded = True
+            response = self._abandonResponse(s, msg, sessionID)
+
+        # add the data from this exchange to the history lists
+        outputHistory = self.getPredicate(self._outputHistory, sessionID)
+        outputHistory.append(response)
+        while len(outputHistory) > self._maxHistorySize:
+            outputHistory.pop(0)
+        self.setPredicate(self._outputHistory, outputHistory, sessionID)
+        return response, exceeded
+
+    def _normalizedContext(self, key, text, segment, sessionID):
+        """Return a tuple (subbed, tokens): text after the 'normal'
+        substitutions, and the words the brain matches it as.
+
+        The session keeps the result under the specified key, and
+        returns it again for as long as text and the substitutions stay
+        the same.  This is used for the session's last response and
+        topic, which every match in a response needs, but which usually
+        only change between responses.
+
+        """
+        session = self._sessions[sessionID]
+        try:
+            cached = session[key]
+            if cached[0] == text and cached[1] == self._subsVersion:
+                return cached[2], cached[3]
+        except KeyError: pass
+        subbed = self._substitute('normal', text, sessionID)
+        tokens = self._brain.tokens(subbed, segment)
+        session[key] = (text, self._subsVersion, subbed, tokens)
+        return subbed, tokens
+
+    def _collectDeferredGarbage(self):
+        """Run the garbage collection that fell due while collection was
+        suspended (if any), and report its duration to the GC hook.
+
+        """
+        # This mirrors the collector's own choice of generation: nothing
+        # happens until generation 0 is over its threshold, and then the
+        # oldest generation that is over its threshold gets collected.
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        if thresholds[0] == 0 or counts[0] <= thresholds[0]:
+            return
+        for generation in (2, 1, 0):
+            if counts[generation] > thresholds[generation]:
+                start = time.time()
+                gc.collect(generation)
+                self._gcHook(generation, time.time() - start)
+                return
+
+    def _abandonResponse(self, input, msg, sessionID):
+        """Clean up after a response that ran out of budget, and return
+        the fallback response.
+
+        """
+        self._budgetExceededCount.inc()
+        if self._verboseMode:
+            err = "WARNING: response abandoned, %s (input='%s')\n" % (msg, input.encode(self._textEncoding, 'replace'))
+            sys.stderr.write(err)
+        # The inputs of any <srai> elements in progress are still on the
+        # stacks.
+        self.setPredicate(self._inputStack, [], sessionID)
+        self.setPredicate(self._matchStack, [], sessionID)
+        return self._budgetFallback
+
+    def explain(self, input, sessionID = _globalSessionID):
+        """Explain how a sentence of input would be matched, in the
+        specified session, without responding to it.
+
+        The input goes through the same substitutions as in respond(),
+        and is matched in the context of the session's previous response
+        and topic.  Returns the dictionary described in
+        PatternMgr.explain().
+
+        """
+        try: input = input.decode(self._textEncoding, 'replace')
+        except UnicodeError: pass
+        except AttributeError: pass
+        self._respondLock.acquire()
+        try:
+            self._addSession(sessionID)
+            outputHistory = self.getPredicate(self._outputHistory, sessionID)
+            try: that = outputHistory[-1]
+            except IndexError: that = ""
+            topic = self.getPredicate("topic", sessionID)
+            return self._brain.explain(self._substitute('normal', input, sessionID),
+                                       self._substitute('normal', that, sessionID),
+                                       self._substitute('normal', topic, sessionID),
+                                       self._matchBotName())
+        finally:
+            self._respondLock.release()
 
     # This version of _respond() just fetches the response for some input.
     # It does not mess with the input and output histories.  Recursive calls
@@ -354,58 +1153,108 @@ class Kernel:
         """Private version of respond(), does the real work."""
         if len(input) == 0:
             return ""
+        if self._budget is not None:
+            self._budget.check()
 
         # guard against infinite recursion
         inputStack = self.getPredicate(self._inputStack, sessionID)
         if len(inputStack) > self._maxRecursionDepth:
+            self._recursionAbortCount.inc()
+            self._impureResponse = True
             if self._verboseMode:
                 err = "WARNING: maximum recursion depth exceeded (input='%s')" % input.encode(self._textEncoding, 'replace')
                 sys.stderr.write(err)
             return ""
 
-        # push the input onto the input stack
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        inputStack.append(input)
-        self.setPredicate(self._inputStack, inputStack, sessionID)
-
         # run the input through the 'normal' subber
-        subbedInput = self._subbers['normal'].sub(input)
+        subbedInput = self._substitute('normal', input, sessionID)
 
         # fetch the bot's previous response, to pass to the match()
         # function as 'that'.
         outputHistory = self.getPredicate(self._outputHistory, sessionID)
         try: that = outputHistory[-1]
         except IndexError: that = ""
-        subbedThat = self._subbers['normal'].sub(that)
+        subbedThat, thatTokens = self._normalizedContext(self._thatContext, that, "that", sessionID)
 
         # fetch the current topic
         topic = self.getPredicate("topic", sessionID)
-        subbedTopic = self._subbers['normal'].sub(topic)
+        subbedTopic, topicTokens = self._normalizedContext(self._topicContext, topic, "topic", sessionID)
+
+        # guard against <srai> cycles: if the same input is already being
+        # processed in the same context, it would only lead back here.
+        # (The tokens are worked out from the other three items, so they
+        # don't affect the comparison.)
+        matchStack = self.getPredicate(self._matchStack, sessionID)
+        tokens = (self._brain.tokens(subbedInput), thatTokens, topicTokens)
+        key = (subbedInput, subbedThat, subbedTopic, tokens)
+        if key in matchStack:
+            self._sraiCycleCount.inc()
+            self._impureResponse = True
+            if self._verboseMode:
+                err = "WARNING: <srai> cycle detected (input='%s')\n" % input.encode(self._textEncoding, 'replace')
+                sys.stderr.write(err)
+            return ""
+
+        # look in the response cache
+        cache = self._responseCache
+        if cache is not None:
+            cacheKey = (subbedInput, that, topic)
+            try: response = cache.pop(cacheKey)
+            except KeyError: self._cacheMissCount.inc()
+            else:
+                # Put it back as the most recently used.
+                cache[cacheKey] = response
+                self._cacheHitCount.inc()
+                return response
+            self._classifyTemplates()
+
+        # push the input onto the input stack
+        inputStack = self.getPredicate(self._inputStack, sessionID)
+        inputStack.append(input)
+        self.setPredicate(self._inputStack, inputStack, sessionID)
+        matchStack.append(key)
+        outerImpure = self._impureResponse
+        self._impureResponse = False
 
         # Determine the final response.
         response = ""
-        elem = self._brain.match(subbedInput, subbedThat, subbedTopic)
-        if elem is None:
+        if self._hooks is None:
+            tid = self._brain.matchId(subbedInput, subbedThat, subbedTopic, self._matchBotName(), self._budget, tokens)
+        else:
+            tid = self._hooked("match", None, sessionID, self._brain.matchId,
+                               subbedInput, subbedThat, subbedTopic, self._matchBotName(), self._budget, tokens)
+        if tid is None:
+            self._noMatchCount.inc()
             if self._verboseMode:
                 err = "WARNING: No match found for input: %s\n" % input.encode(self._textEncoding)
                 sys.stderr.write(err)
         else:
+            self._matchCount.inc()
+            if cache is not None and self._purity.get(tid) == "impure":
+                self._impureResponse = True
             # Process the element into a response string.
-            response += self._processElement(elem, sessionID).strip()
+            response += self._processElement(self._brain.template(tid), sessionID).strip()
             response += " "
         response = response.strip()
 
+        if cache is not None and not self._impureResponse:
+            cache[cacheKey] = response
+            if len(cache) > self._responseCacheSize:
+                cache.popitem(last = False)
+        self._impureResponse = self._impureResponse or outerImpure
+
         # pop the top entry off the input stack.
         inputStack = self.getPredicate(self._inputStack, sessionID)
         inputStack.pop()
         self.setPredicate(self._inputStack, inputStack, sessionID)
+        matchStack.pop()
         
         return response
 
     def _processElement(self,elem, sessionID):
         """Process an AIML element.
 
-        The first item of the elem list is the name of the element's
+        The first item of the elem tuple is the name of the element's
         XML tag.  The second item is a dictionary containing any
         attributes passed to that tag, and their values.  Any further
         items in the list are the elements enclosed by the current
@@ -422,7 +1271,43 @@ class Kernel:
                 err = "WARNING: No handler found for <%s> element\n" % elem[0].encode(self._textEncoding, 'replace')
                 sys.stderr.write(err)
             return ""
-        return handlerFunc(elem, sessionID)
+        if self._budget is not None:
+            self._budget.spend()
+        if self._hooks is None:
+            response = handlerFunc(elem, sessionID)
+        else:
+            response = self._hooked("element", elem[0], sessionID, handlerFunc, elem, sessionID)
+        # The element might have taken a while without matching anything
+        # (a <system> command, for instance).
+        if self._budget is not None:
+            self._budget.check()
+        return response
+
+    def _substitute(self, subber, text, sessionID):
+        """Run text through the specified word substitutor."""
+        if self._hooks is None:
+            if subber == 'normal' and self._normalMemo is not None:
+                # respondBatch() remembers the results for the whole batch.
+                try: return self._normalMemo[text]
+                except KeyError:
+                    subbed = self._normalMemo[text] = self._subbers[subber].sub(text)
+                    return subbed
+            return self._subbers[subber].sub(text)
+        return self._hooked("substitute", subber, sessionID, self._subbers[subber].sub, text)
+
+    def _hooked(self, phase, detail, sessionID, func, *args):
+        """Call func with the specified arguments, surrounded by calls to
+        the hooks registered for phase (see addHook()).
+
+        """
+        hooks = self._hooks.get(phase, [])
+        for pre, post in hooks:
+            if pre is not None: pre(phase, detail, sessionID)
+        try:
+            return func(*args)
+        finally:
+            for pre, post in hooks:
+                if post is not None: post(phase, detail, sessionID)
 
 
     ######################################################
@@ -582,7 +1467,7 @@ class Kernel:
         response = ""
         for e in elem[2:]:
             response += self._processElement(e, sessionID)
-        return self._subbers['gender'].sub(response)
+        return self._substitute('gender', response, sessionID)
 
     # <get>
     def _processGet(self, elem, sessionID):
@@ -723,8 +1608,8 @@ class Kernel:
         for e in elem[2:]:
             response += self._processElement(e, sessionID)
         if len(elem[2:]) == 0:  # atomic <person/> = <person><star/></person>
-            response = self._processElement(['star',{}], sessionID)    
-        return self._subbers['person'].sub(response)
+            response = self._processElement(self._atomicStar, sessionID)    
+        return self._substitute('person', response, sessionID)
 
     # <person2>
     def _processPerson2(self,elem, sessionID):
@@ -743,8 +1628,8 @@ class Kernel:
         for e in elem[2:]:
             response += self._processElement(e, sessionID)
         if len(elem[2:]) == 0:  # atomic <person2/> = <person2><star/></person2>
-            response = self._processElement(['star',{}], sessionID)
-        return self._subbers['person2'].sub(response)
+            response = self._processElement(self._atomicStar, sessionID)
+        return self._substitute('person2', response, sessionID)
         
     # <random>
     def _processRandom(self, elem, sessionID):
@@ -824,7 +1709,8 @@ class Kernel:
         <sr> elements are shortcuts for <srai><star/></srai>.
 
         """
-        star = self._processElement(['star',{}], sessionID)
+        self._sraiCount.inc()
+        star = self._processElement(self._atomicStar, sessionID)
         response = self._respond(star, sessionID)
         return response
 
@@ -838,6 +1724,7 @@ class Kernel:
         returned.
 
         """
+        self._sraiCount.inc()
         newInput = ""
         for e in elem[2:]:
             newInput += self._processElement(e, sessionID)
@@ -860,17 +1747,27 @@ class Kernel:
         """
         try: index = int(elem[1]['index'])
         except KeyError: index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try: that = self._subbers['normal'].sub(outputHistory[-1])
-        except: that = "" # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("star", input, that, topic, index)
-        return response
+        return self._matchStar("star", index, sessionID)
     
+    def _matchStar(self, starType, index, sessionID):
+        """Do the work of the <star>, <thatstar> and <topicstar>
+        elements: match the current input again, and return the
+        specified part of it.
+
+        """
+        # The top of the match stack holds the normalized input and that
+        # of the input being processed.
+        matchStack = self.getPredicate(self._matchStack, sessionID)
+        input, that, subbedTopic, tokens = matchStack[-1]
+        # The topic, on the other hand, is the current one (the template
+        # might have changed it), without the 'normal' substitutions.
+        topic = self.getPredicate("topic", sessionID)
+        tokens = (tokens[0], tokens[1], self._brain.tokens(topic, "topic"))
+        if self._hooks is None:
+            return self._brain.star(starType, input, that, topic, index, self._matchBotName(), self._budget, tokens)
+        return self._hooked("match", starType, sessionID, self._brain.star,
+                            starType, input, that, topic, index, self._matchBotName(), self._budget, tokens)
+
     # <system>
     def _processSystem(self,elem, sessionID):
         """Process a <system> AIML element.
@@ -933,22 +1830,14 @@ class Kernel:
         """Process a raw text element.
 
         Raw text elements aren't really AIML tags. Text elements cannot contain
-        other elements; instead, the third item of the 'elem' list is a text
-        string, which is immediately returned. They have a single attribute,
-        automatically inserted by the parser, which indicates whether whitespace
-        in the text should be preserved or not.
+        other elements; instead, the third item of the 'elem' tuple is a text
+        string, which is immediately returned.  The parser has already reduced
+        any stretches of whitespace that weren't marked with
+        xml:space="preserve".
         
         """
         try: elem[2] + ""
         except TypeError: raise TypeError, "Text element contents are not text"
-
-        # If the the whitespace behavior for this element is "default",
-        # we reduce all stretches of >1 whitespace characters to a single
-        # space.  To improve performance, we do this only once for each
-        # text element encountered, and save the results for the future.
-        if elem[1]["xml:space"] == "default":
-            elem[2] = re.sub("\s+", " ", elem[2])
-            elem[1]["xml:space"] = "preserve"
         return elem[2]
 
     # <that>
@@ -998,16 +1887,7 @@ class Kernel:
         """
         try: index = int(elem[1]['index'])
         except KeyError: index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try: that = self._subbers['normal'].sub(outputHistory[-1])
-        except: that = "" # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("thatstar", input, that, topic, index)
-        return response
+        return self._matchStar("thatstar", index, sessionID)
 
     # <think>
     def _processThink(self,elem, sessionID):
@@ -1039,16 +1919,7 @@ class Kernel:
         """
         try: index = int(elem[1]['index'])
         except KeyError: index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try: that = self._subbers['normal'].sub(outputHistory[-1])
-        except: that = "" # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("topicstar", input, that, topic, index)
-        return response
+        return self._matchStar("topicstar", index, sessionID)
 
     # <uppercase>
     def _processUppercase(self,elem, sessionID):
@@ -1078,15 +1949,16 @@ class Kernel:
 ##################################################
 ### Self-test functions follow                 ###
 ##################################################
-def _testTag(kern, tag, input, outputList):
-    """Tests 'tag' by feeding the Kernel 'input'.  If the result
-    matches any of the strings in 'outputList', the test passes.
+def _testTag(kern, tag, input, outputList, sessionID = Kernel._globalSessionID):
+    """Tests 'tag' by feeding the Kernel 'input' (in the specified
+    session).  If the result matches any of the strings in
+    'outputList', the test passes.
     
     """
     global _numTests, _numPassed
     _numTests += 1
     print "Testing <" + tag + ">:",
-    response = kern.respond(input).decode(kern._textEncoding)
+    response = kern.respond(input, sessionID).decode(kern._textEncoding)
     if response in outputList:
         print "PASSED"
         _numPassed += 1
@@ -1095,6 +1967,21 @@ def _testTag(kern, tag, input, outputList):
         print "FAILED (response: '%s')" % response.encode(kern._textEncoding, 'replace')
         return False
 
+def _testCheck(name, passed, detail = ""):
+    """Records the result of a test that isn't a single response: passed
+    says whether it passed, and detail is printed if it didn't.
+
+    """
+    global _numTests, _numPassed
+    _numTests += 1
+    print "Testing <" + name + ">:",
+    if passed:
+        print "PASSED"
+        _numPassed += 1
+    else:
+        print "FAILED %s" % detail
+    return passed
+
 if __name__ == "__main__":
     # Run some self-tests
     k = Kernel()
@@ -1172,6 +2059,241 @@ if __name__ == "__main__":
     _testTag(k, 'version', 'test version', ["PyAIML is version %s" % k.version()])
     _testTag(k, 'whitespace preservation', 'test whitespace', ["Extra   Spaces\n   Rule!   (but not in here!)    But   Here   They   Do!"])
 
+    # Clones share the brain, but not bot predicates or what they learn.
+    c = k.clone()
+    c.setBotPredicate("name", "Clone")
+    _testTag(c, 'clone', 'test bot', ["My name is Clone"])
+    _testTag(k, 'clone (original)', 'test bot', ["My name is Nameless"])
+    c.learn("<aiml><category><pattern>TEST CLONE</pattern><template>Clone test passed</template></category></aiml>")
+    _testTag(c, 'clone learn', 'test clone', ["Clone test passed"])
+    _testTag(k, 'clone learn (original)', 'test clone', [""])
+    c = k.clone()
+    c.setBotPredicate("name", "ROBBY")
+    c.learn("<aiml><category><pattern>ARE YOU <bot name=\"name\"/></pattern><template>I am</template></category></aiml>")
+    _testTag(c, 'clone learn bot name', 'are you robby', ["I am"])
+
+    # Clones can respond at the same time, even while their shared brain
+    # is still unmarshalling templates as they're first matched.
+    import tempfile, threading
+    fd, brainFile = tempfile.mkstemp()
+    os.close(fd)
+    k.saveBrain(brainFile)
+    shared = Kernel()
+    shared.verbose(False)
+    shared.loadBrain(brainFile)
+    os.remove(brainFile)
+    threadInputs = ["test srai", "test sr test srai", "test star creamy goodness middle",
+                    "test formal", "test uppercase", "test lowercase", "test sentence"]
+    expected = [k.respond(input) for input in threadInputs]
+    threadResults = []
+    def _respondAll(kern):
+        try: threadResults.append([kern.respond(input) for input in threadInputs])
+        except Exception, e: threadResults.append(e)
+    threads = [threading.Thread(target = _respondAll, args = (shared.clone(),)) for i in range(8)]
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1) # switch threads as often as possible
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    sys.setcheckinterval(interval)
+    _testCheck('clone threads', threadResults == [expected] * len(threads), threadResults)
+
+    # What a clone learns can be saved as an overlay, and loaded into other
+    # clones of the same brain.
+    fd, overlayFile = tempfile.mkstemp()
+    os.close(fd)
+    c.saveOverlay(overlayFile)
+    c = k.clone()
+    c.setBotPredicate("name", "ROBOT")
+    c.loadOverlay(overlayFile)
+    os.remove(overlayFile)
+    _testTag(c, 'overlay bot name', 'are you robot', ["I am"])
+
+    # Brains survive being saved and loaded again.
+    import marshal
+    fd, brainFile = tempfile.mkstemp()
+    os.close(fd)
+    k.saveBrain(brainFile)
+    b = Kernel()
+    b.loadBrain(brainFile)
+    _testTag(b, 'brain file (size)', 'test size', ["I've learned %d categories" % k.numCategories()])
+    _testTag(b, 'brain file', 'test star creamy goodness middle', ['Middle star matched: creamy goodness'])
+
+    # Brain files written by PyAIML 0.8.6 and earlier hold the template
+    # count, the bot name and the node tree as nested dictionaries, with
+    # each template inline in its nested-list form.
+    def _oldElement(elem):
+        return [type(e) is tuple and _oldElement(e) or e for e in elem]
+    def _oldTree(brain, nid):
+        tree = {}
+        for key, value in brain._nodes[nid].items():
+            if key == brain._TEMPLATE: tree[key] = _oldElement(brain.template(value))
+            else: tree[key] = _oldTree(brain, value)
+        return tree
+    outFile = open(brainFile, "wb")
+    marshal.dump(k._brain.numTemplates(), outFile)
+    marshal.dump(k._brain._botName, outFile)
+    marshal.dump(_oldTree(k._brain, k._brain._root), outFile)
+    outFile.close()
+    b.loadBrain(brainFile)
+    os.remove(brainFile)
+    _testTag(b, 'old brain file (size)', 'test size', ["I've learned %d categories" % k.numCategories()])
+    _testTag(b, 'old brain file', 'test star creamy goodness middle', ['Middle star matched: creamy goodness'])
+    _testTag(b, 'old brain file (whitespace)', 'test whitespace', ["Extra   Spaces\n   Rule!   (but not in here!)    But   Here   They   Do!"])
+
+    # The response cache is shared by all sessions, but only keeps
+    # responses that are the same in every session.
+    k.setResponseCache(100)
+    k.learn("<aiml><category><pattern>TEST CACHE GET</pattern><template>Your name is <get name=\"name\"/></template></category></aiml>")
+    k.setPredicate("name", "Alice", "alice")
+    k.setPredicate("name", "Bob", "bob")
+    _testTag(k, 'response cache', 'test srai', ["srai test passed"])
+    _testTag(k, 'response cache (hit)', 'test srai', ["srai test passed"])
+    _testTag(k, 'response cache <get> #1', 'test cache get', ["Your name is Alice"], "alice")
+    _testTag(k, 'response cache <get> #2', 'test cache get', ["Your name is Bob"], "bob")
+    # Nor are the responses of templates that lead to impure ones through
+    # <srai>, whether the Analyzer can tell in advance or not.
+    k.learn("""<aiml>
+        <category><pattern>TEST CACHE PURE</pattern><template>pure</template></category>
+        <category><pattern>TEST CACHE RANDOM</pattern><template><random><li>a</li><li>b</li></random></template></category>
+        <category><pattern>TEST CACHE SET</pattern><template><set name="cached">set</set></template></category>
+        <category><pattern>TEST CACHE DATE</pattern><template><date/></template></category>
+        <category><pattern>TEST CACHE SRAI</pattern><template><srai>test cache get</srai></template></category>
+        <category><pattern>TEST CACHE STAR *</pattern><template><srai><star/></srai></template></category>
+    </aiml>""")
+    impureInputs = ["test cache random", "test cache set", "test cache date", "test cache get",
+                    "test cache srai", "test cache star test cache get", "test cache star test cache star test cache set"]
+    hits = k.metrics().get("aiml_response_cache_hits_total").get()
+    for input in ["test cache pure"] + impureInputs * 2:
+        k.respond(input, "alice")
+    cached = [key[0] for key in k._responseCache.keys()]
+    _testCheck('response cache (impure)', cached == ["test cache pure"], cached)
+    _testCheck('response cache (impure hits)', k.metrics().get("aiml_response_cache_hits_total").get() == hits)
+    _testTag(k, 'response cache <srai> #1', 'test cache star test cache get', ["Your name is Alice"], "alice")
+    _testTag(k, 'response cache <srai> #2', 'test cache star test cache get', ["Your name is Bob"], "bob")
+    k.setResponseCache(0)
+
+    # A response that runs past its deadline is abandoned, along with the
+    # rest of the input; respond() gives just the fallback, while
+    # respondIter() has already yielded the sentences that finished in
+    # time.  A slow <think> element stands in for a <system> command.
+    k.learn("<aiml><category><pattern>TEST SLOW</pattern><template><think>slow</think>done</template></category></aiml>")
+    def _slowThink(phase, detail, sessionID):
+        if detail == "think": time.sleep(0.2)
+    k.addHook("element", None, _slowThink)
+    k.setBudget(timeout = 0.05, fallback = "Too slow")
+    exceeded = k.metrics().get("aiml_budget_exceeded_total").get()
+    deadlineInput = "test srai.  test slow.  test srai"
+    _testTag(k, 'deadline', deadlineInput, ["Too slow"], "deadline")
+    _testCheck('deadline (history)', k.getPredicate(k._inputHistory, "deadline") == [u"test srai", u"test slow"]
+               and k.getPredicate(k._outputHistory, "deadline") == [u"srai test passed", u"Too slow"])
+    _testCheck('deadline (metrics)', k.metrics().get("aiml_budget_exceeded_total").get() == exceeded + 1)
+    partial = list(k.respondIter(deadlineInput, "deadline iter"))
+    _testCheck('deadline (respondIter)', partial == ["srai test passed", "Too slow"], partial)
+    k.removeHook("element", None, _slowThink)
+    k.setBudget()
+    _testTag(k, 'deadline (after)', "test slow", ["done"], "deadline")
+
+    # Running out of nodes deep in a <srai> recursion abandons the
+    # response (before the recursion limit would), and leaves the session
+    # ready for the next one.
+    k.learn("<aiml><category><pattern>TEST NODES *</pattern><template><srai>test nodes <star/> more</srai></template></category></aiml>")
+    k.setBudget(nodes = 200, fallback = "Too big")
+    exceeded = k.metrics().get("aiml_budget_exceeded_total").get()
+    aborts = k.metrics().get("aiml_recursion_aborts_total").get()
+    _testTag(k, 'node budget', "test nodes deep", ["Too big"], "nodes")
+    _testCheck('node budget (metrics)', k.metrics().get("aiml_budget_exceeded_total").get() == exceeded + 1
+               and k.metrics().get("aiml_recursion_aborts_total").get() == aborts)
+    _testCheck('node budget (stacks)', k.getPredicate(k._inputStack, "nodes") == []
+               and k.getPredicate(k._matchStack, "nodes") == [])
+    k.setBudget()
+    _testTag(k, 'node budget (after)', "test srai", ["srai test passed"], "nodes")
+
+    # A batch gives the same responses as answering its inputs one at a
+    # time, including those that depend on each session's history.
+    batchInputs = ["test that", "test get and set", "test that", "test srai.  test sr test srai",
+                   "test input", "test topic", "test topicstar", "test id", "test person2 I am", "test srai"]
+    requests = []
+    for input in batchInputs:
+        requests.extend([(input, "one"), (input, "two")])
+    sequential = k.clone()
+    expected = [sequential.respond(input, sessionID) for input, sessionID in requests]
+    batch = k.clone()
+    results = batch.respondBatch(requests)
+    _testCheck('respondBatch', results == expected, results)
+    # A clone made in the middle of a batch doesn't share its memo.
+    batchClones = []
+    def _cloneBatch(phase, detail, sessionID):
+        if len(batchClones) == 0: batchClones.append(batch.clone())
+    batch.addHook("respond", _cloneBatch)
+    batch.respondBatch(requests[:2])
+    batch.removeHook("respond", _cloneBatch)
+    _testCheck('respondBatch (clone)', batchClones[0]._normalMemo is None and batch._normalMemo is None)
+
+    # respondIter() gives the same responses as respond(), a sentence at a
+    # time, and each sentence is in the session's history by the time its
+    # response comes out.
+    iterInput = "test that.  test srai.  test that.  test input"
+    expected = k.clone().respond(iterInput, "iter")
+    iterKernel = k.clone()
+    responses = []
+    histories = []
+    for response in iterKernel.respondIter(iterInput, "iter"):
+        responses.append(response)
+        histories.append(len(iterKernel.getPredicate(iterKernel._inputHistory, "iter")))
+    _testCheck('respondIter', string.join(responses, "  ") == expected, responses)
+    _testCheck('respondIter (history)', histories == [1, 2, 3, 4]
+               and iterKernel.getPredicate(iterKernel._outputHistory, "iter") == responses, histories)
+    _testCheck('respondIter (empty)', list(iterKernel.respondIter("")) == [])
+
+    # learn() takes files (and wildcards), file objects, strings (byte or
+    # unicode), and zip or tar archives in a file or a string.
+    def _sourceDoc(word):
+        return '<aiml version="1.0"><category><pattern>TEST SOURCE %s</pattern><template>%s source passed</template></category></aiml>' % (word.upper(), word)
+    src = Kernel()
+    src.verbose(False)
+    src.learn(unicode(_sourceDoc("unicode")))
+    src.learn(cStringIO.StringIO(_sourceDoc("stream")))
+    zipData = cStringIO.StringIO()
+    archive = zipfile.ZipFile(zipData, "w")
+    archive.writestr("zip.aiml", _sourceDoc("zip"))
+    archive.writestr("README", "not AIML")
+    archive.close()
+    src.learn(zipData.getvalue())
+    for word, mode in [("tar", "w"), ("targz", "w:gz")]:
+        tarData = cStringIO.StringIO()
+        archive = tarfile.open(fileobj = tarData, mode = mode)
+        info = tarfile.TarInfo("%s.aiml" % word)
+        info.size = len(_sourceDoc(word))
+        archive.addfile(info, cStringIO.StringIO(_sourceDoc(word)))
+        archive.close()
+        src.learn(cStringIO.StringIO(tarData.getvalue()))
+    sourceDir = tempfile.mkdtemp()
+    for word in ["globone", "globtwo"]:
+        outFile = open(os.path.join(sourceDir, "%s.aiml" % word), "w")
+        outFile.write(_sourceDoc(word))
+        outFile.close()
+    src.learn(os.path.join(sourceDir, "glob*.aiml"))
+    for word in ["unicode", "stream", "zip", "tar", "targz", "globone", "globtwo"]:
+        _testTag(src, 'learn (%s)' % word, 'test source %s' % word, ["%s source passed" % word])
+
+    # With a manifest, only the files listed in it are trusted; the rest
+    # are validated (and this one fails).
+    badDoc = os.path.join(sourceDir, "manifest.aiml")
+    outFile = open(badDoc, "w")
+    outFile.write('<aiml version="1.0"><category><pattern>TEST MANIFEST</pattern><template>manifest passed<li>!</li></template></category></aiml>')
+    outFile.close()
+    manifest = os.path.join(sourceDir, "manifest.sha1")
+    for listed, expected in [(False, ""), (True, "manifest passed!")]:
+        outFile = open(manifest, "w")
+        outFile.write("# trusted files\n")
+        if listed: outFile.write("%s  manifest.aiml\n" % Utils.contentDigest(open(badDoc, "rb").read()))
+        outFile.close()
+        src.learn(badDoc, trusted = True, manifest = manifest)
+        _testTag(src, 'learn (manifest, %s)' % (listed and "listed" or "unlisted"), 'test manifest', [expected])
+    for name in os.listdir(sourceDir):
+        os.remove(os.path.join(sourceDir, name))
+    os.rmdir(sourceDir)
+
     # Report test results
     print "--------------------"
     if _numTests == _numPassed:
@@ -0,0 +1,218 @@
+"""This file contains a small registry of runtime metrics (counters,
+gauges and histograms), which the Kernel uses to keep track of what it
+has been doing.
+
+Usage:
+    > registry = Registry()
+    > requests = registry.counter("requests_total", "Number of requests.")
+    > requests.inc()
+    > print registry.asDict()
+    {'requests_total': 1}
+    > print registry.prometheus()
+    # HELP requests_total Number of requests.
+    # TYPE requests_total counter
+    requests_total 1
+
+"""
+
+import bisect
+import string
+
+class Counter:
+    """A value that only goes up."""
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount = 1):
+        """Increment the counter."""
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+    def _samples(self):
+        return [(self.name, self.value)]
+
+class Gauge:
+    """A value that can go up and down.  If a function is provided, the
+    value is whatever it returns at the time the gauge is read.
+
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, func = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._func = func
+
+    def set(self, value):
+        """Set the value of the gauge."""
+        self.value = value
+
+    def get(self):
+        if self._func is not None:
+            return self._func()
+        return self.value
+
+    def _samples(self):
+        return [(self.name, self.get())]
+
+class Histogram:
+    """Counts observed values (e.g. latencies) in buckets, and keeps their
+    sum and count.
+
+    """
+    type = "histogram"
+    # The default buckets suit latencies measured in seconds.
+    defaultBuckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+    def __init__(self, name, help, buckets = None):
+        self.name = name
+        self.help = help
+        if buckets is None:
+            buckets = self.defaultBuckets
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record a value."""
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        """Return a dictionary containing the count, the sum, and the
+        cumulative count for each bucket, keyed by its upper bound.
+
+        """
+        cumulative = {}
+        total = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self._counts):
+            total += count
+            cumulative[bound] = total
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+    def _samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self._counts):
+            total += count
+            samples.append(('%s_bucket{le="%s"}' % (self.name, bound), total))
+        samples.append(("%s_sum" % self.name, self.sum))
+        samples.append(("%s_count" % self.name, self.count))
+        return samples
+
+def _formatValue(value):
+    """Format a sample value for the Prometheus text format."""
+    if type(value) == float:
+        return repr(value)
+    return "%d" % value
+
+class Registry:
+    """A collection of named metrics.
+
+    Updating a metric is a plain addition, without any locking.  The
+    Kernel does most of its updating inside respond(), which only one
+    thread can be running at a time.
+
+    """
+    def __init__(self):
+        self._metrics = []
+        self._names = {}
+
+    def _register(self, metric):
+        if self._names.has_key(metric.name):
+            raise ValueError, "duplicate metric name: %s" % metric.name
+        self._names[metric.name] = metric
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        """Create and register a new Counter."""
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help, func = None):
+        """Create and register a new Gauge."""
+        return self._register(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets = None):
+        """Create and register a new Histogram."""
+        return self._register(Histogram(name, help, buckets))
+
+    def get(self, name):
+        """Return the metric with the specified name."""
+        return self._names[name]
+
+    def asDict(self):
+        """Return the current values of all of the metrics, keyed by name.
+        Histograms' values are dictionaries (see Histogram.get()).
+
+        """
+        result = {}
+        for metric in self._metrics:
+            result[metric.name] = metric.get()
+        return result
+
+    def prometheus(self):
+        """Return the current values of all of the metrics in the
+        Prometheus text exposition format.
+
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, value in metric._samples():
+                lines.append("%s %s" % (name, _formatValue(value)))
+        return string.join(lines, "\n") + "\n"
+
+# Self test
+if __name__ == "__main__":
+    registry = Registry()
+    counter = registry.counter("test_total", "A counter.")
+    histogram = registry.histogram("test_seconds", "A histogram.", [1.0, 0.25])
+    registry.gauge("test_items", "A gauge.", lambda: 42)
+    counter.inc()
+    counter.inc(2)
+    for value in [0.125, 0.25, 0.5, 4.0]:
+        histogram.observe(value)
+    assert(registry.asDict() == {"test_total": 3, "test_items": 42,
+        "test_seconds": {"count": 4, "sum": 4.875, "buckets": {0.25: 2, 1.0: 3, "+Inf": 4}}})
+    assert(registry.prometheus() == string.join([
+        "# HELP test_total A counter.", "# TYPE test_total counter", "test_total 3",
+        "# HELP test_seconds A histogram.", "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.25"} 2', 'test_seconds_bucket{le="1.0"} 3',
+        'test_seconds_bucket{le="+Inf"} 4', "test_seconds_sum 4.875", "test_seconds_count 4",
+        "# HELP test_items A gauge.", "# TYPE test_items gauge", "test_items 42", ""], "\n"))
+    try: registry.counter("test_total", "The same name again.")
+    except ValueError: pass
+    else: raise AssertionError, "duplicate metric registered"
+
+    # The Kernel's metrics count what respond() does.
+    import Kernel
+    kern = Kernel.Kernel()
+    kern.verbose(False)
+    kern.learn("""<aiml>
+        <category><pattern>HELLO</pattern><template>Hi there</template></category>
+        <category><pattern>HI</pattern><template><srai>HELLO</srai></template></category>
+    </aiml>""")
+    kern.respond("hello")
+    kern.respond("hi.  nonsense")
+    metrics = kern.metrics().asDict()
+    assert(metrics["aiml_requests_total"] == 2)
+    assert(metrics["aiml_sentences_total"] == 3)
+    assert(metrics["aiml_matches_total"] == 3) # including the <srai>
+    assert(metrics["aiml_no_matches_total"] == 1)
+    assert(metrics["aiml_srai_total"] == 1)
+    assert(metrics["aiml_learned_files_total"] == 1)
+    assert(metrics["aiml_categories"] == 2)
+    assert(metrics["aiml_sessions"] == 1)
+    assert(metrics["aiml_respond_seconds"]["count"] == 2)
+    assert(metrics["aiml_respond_seconds"]["buckets"]["+Inf"] == 2)
@@ -2,11 +2,17 @@
 # by Dr. Richard Wallace at the following site:
 # http://www.alicebot.org/documentation/matching.html
 
+from AimlParser import compactElement
+
+import hashlib
 import marshal
 import pprint
 import re
 import string
 import sys
+import time
+
+class BudgetExceeded(Exception): pass
 
 class PatternMgr:
 	# special dictionary keys
@@ -16,15 +22,80 @@ class PatternMgr:
 	_THAT       = 3
 	_TOPIC		= 4
 	_BOT_NAME   = 5
+
+	# Brain files start with this tag and a format version number.  Files
+	# written by older versions of PyAIML start with the template count
+	# instead, and store the node tree as nested dictionaries with each
+	# template inline.
+	_BRAIN_MAGIC   = "PyAIML brain"
+	_BRAIN_VERSION = 3
+	# Overlay files (see saveOverlay()) start with a tag of their own.
+	_OVERLAY_MAGIC = "PyAIML overlay"
 	
-	def __init__(self):
-		self._root = {}
+	def __init__(self, base = None):
+		"""Create an empty PatternMgr.
+
+		If base is provided, the new PatternMgr is an overlay: it starts
+		out with the same categories as base, but only stores the
+		categories that are added to it afterwards (and the nodes leading
+		to them).  Matching looks at both, and the overlay's categories
+		take precedence.  The base is shared, not copied, so it must not
+		be modified while the overlay exists.
+
+		"""
+		# The node tree is a flat table of nodes, with the root at index 0.
+		# Each node is a dictionary mapping a word (or one of the special
+		# keys above) to the index of a child node, except for _TEMPLATE,
+		# which maps to an index in the template table.  Since the nodes
+		# only contain strings and integers, the garbage collector doesn't
+		# have to track them.
+		self._nodes = [{}]
 		self._templateCount = 0
+		# Templates are kept in a table of their own.  Identical templates
+		# are only stored once.  Templates restored from a brain file stay
+		# in their marshalled form in _rawTemplates until they're needed.
+		self._templates = []
+		self._rawTemplates = []
+		self._templateIds = None # structural hash -> template id, built on demand
+		self._digestCache = None # see _digest()
+		# A frozen brain keeps its tables in tuples, and its templates
+		# marshalled (see freeze()).
+		self._frozen = False
 		self._botName = u"Nameless"
+		self._setBase(base)
+		if base is not None:
+			# Node and template ids carry on where the base's leave off, so
+			# the overlay can refer to the base's nodes and templates
+			# directly.  The overlay's root is a copy of the base's.
+			self._nodes = _LayeredList(base._nodes, [dict(base._nodes[base._root])])
+			self._templateCount = base._templateCount
+			self._botName = base._botName
 		punctuation = "\"`~!@#$%^&*()-_=+[{]}\|;:',<.>/?"
 		self._puncStripRE = re.compile("[" + re.escape(punctuation) + "]")
 		self._whitespaceRE = re.compile("\s+", re.LOCALE | re.UNICODE)
 
+	def _setBase(self, base):
+		"""Set the base brain of an overlay (or None for a brain that
+		stands alone).  The node table must be set up separately.
+
+		"""
+		self._base = base
+		if base is None:
+			self._nodeOffset = 0
+			self._templateOffset = 0
+			self._root = 0
+		else:
+			self._nodeOffset = len(base._nodes)
+			self._templateOffset = base.numUniqueTemplates()
+			self._root = self._nodeOffset
+
+	def base(self):
+		"""Return the base brain of an overlay, or None if this PatternMgr
+		isn't an overlay.
+
+		"""
+		return self._base
+
 	def numTemplates(self):
 		"""Return the number of templates currently stored."""
 		return self._templateCount
@@ -37,48 +108,316 @@ class PatternMgr:
 		# Collapse a multi-word name into a single word
 		self._botName = unicode(string.join(name.split()))
 
+	def numUniqueTemplates(self):
+		"""Return the number of distinct templates in the template table.
+
+		Categories with identical templates share a single table entry, so
+		this is usually smaller than numTemplates().
+
+		"""
+		return self._templateOffset + len(self._rawTemplates)
+
 	def dump(self):
 		"""Print all learned patterns, for debugging purposes."""
-		pprint.pprint(self._root)
+		pprint.pprint(self._nestedNode(self._root))
+
+	def _nestedNode(self, nid):
+		"""Return the subtree rooted at the specified node as nested
+		dictionaries, with template ids at the leaves.
+
+		"""
+		node = {}
+		for key, value in self._nodes[nid].items():
+			if key == self._TEMPLATE: node[key] = value
+			else: node[key] = self._nestedNode(value)
+		return node
+
+	def freeze(self):
+		"""Convert the brain to a read-only form that the cyclic garbage
+		collector never has to scan.
+
+		The node table becomes a tuple, and the templates are only kept in
+		marshalled form; each match unmarshals a fresh copy of its
+		template.  Adding a category to a frozen brain thaws it again.
+
+		"""
+		if self._frozen:
+			return
+		# Build the frozen tables before switching over to them, since
+		# other threads might be matching on the brain (see _template()).
+		rawTemplates = tuple([marshal.dumps(self._template(self._templateOffset + i)) for i in range(len(self._rawTemplates))])
+		if self._base is None:
+			nodes = tuple(self._nodes)
+		else:
+			nodes = _LayeredList(self._nodes.base, tuple(self._nodes.top))
+		self._rawTemplates = rawTemplates
+		self._nodes = nodes
+		self._frozen = True
+		self._templates = None
+
+	def isFrozen(self):
+		"""Return True if the brain is currently frozen (see freeze())."""
+		return self._frozen
+
+	def _thaw(self):
+		"""Make a frozen brain modifiable again."""
+		if self._base is None:
+			self._nodes = list(self._nodes)
+		else:
+			self._nodes = _LayeredList(self._nodes.base, list(self._nodes.top))
+		self._rawTemplates = list(self._rawTemplates)
+		self._templates = [None] * len(self._rawTemplates)
+		self._frozen = False
 
 	def save(self, filename):
 		"""Dump the current patterns to the file specified by filename.  To
 		restore later, use restore().
 
+		An overlay is saved together with its base, as a brain that stands
+		alone.  To save just the overlay, use saveOverlay().
+
 		"""
 		try:
 			outFile = open(filename, "wb")
+			marshal.dump(self._BRAIN_MAGIC, outFile)
+			marshal.dump(self._BRAIN_VERSION, outFile)
 			marshal.dump(self._templateCount, outFile)
 			marshal.dump(self._botName, outFile)
-			marshal.dump(self._root, outFile)
+			marshal.dump(self._flatNodes(), outFile)
+			marshal.dump(self._marshalledTemplates(), outFile)
 			outFile.close()
 		except Exception, e:
 			print "Error saving PatternMgr to file %s:" % filename
 			raise Exception, e
 
-	def restore(self, filename):
-		"""Restore a previously save()d collection of patterns."""
+	def _flatNodes(self):
+		"""Return a list containing the whole node table, including any
+		base brains, with the root at index 0.
+
+		"""
+		if self._base is None:
+			return list(self._nodes)
+		nodes = self._base._flatNodes() + list(self._nodes.top)
+		# Nothing refers to the base's root, so the overlay's root can
+		# simply take its place.
+		nodes[0] = nodes[self._root]
+		return nodes
+
+	def saveOverlay(self, filename):
+		"""Save the categories that have been added to an overlay (but not
+		its base) to the file specified by filename.  To restore them
+		later, use restoreOverlay().
+
+		"""
+		if self._base is None:
+			raise ValueError, "PatternMgr is not an overlay"
+		try:
+			outFile = open(filename, "wb")
+			marshal.dump(self._OVERLAY_MAGIC, outFile)
+			marshal.dump(self._BRAIN_VERSION, outFile)
+			marshal.dump(self._nodeOffset, outFile)
+			marshal.dump(self._templateOffset, outFile)
+			marshal.dump(self._base._digest(), outFile)
+			marshal.dump(self._templateCount, outFile)
+			marshal.dump(self._botName, outFile)
+			marshal.dump(list(self._nodes.top), outFile)
+			marshal.dump([self._marshalledTemplate(self._templateOffset + i) for i in range(len(self._rawTemplates))], outFile)
+			outFile.close()
+		except Exception, e:
+			print "Error saving PatternMgr overlay to file %s:" % filename
+			raise Exception, e
+
+	def restoreOverlay(self, filename):
+		"""Restore an overlay saved with saveOverlay().  The overlay's
+		base must contain the same brain as it did when the overlay was
+		saved; the file records a digest of the base to check this, and
+		ValueError is raised if it doesn't match.
+
+		"""
+		if self._base is None:
+			raise ValueError, "PatternMgr is not an overlay"
 		try:
 			inFile = open(filename, "rb")
+			if marshal.load(inFile) != self._OVERLAY_MAGIC:
+				raise ValueError, "not a PyAIML overlay file"
+			version = marshal.load(inFile)
+			if version != self._BRAIN_VERSION:
+				raise ValueError, "unsupported brain format version %s" % version
+			nodeOffset = marshal.load(inFile)
+			templateOffset = marshal.load(inFile)
+			digest = marshal.load(inFile)
+			if nodeOffset != self._nodeOffset or templateOffset != self._templateOffset \
+			   or digest != self._base._digest():
+				raise ValueError, "overlay does not match its base brain"
 			self._templateCount = marshal.load(inFile)
 			self._botName = marshal.load(inFile)
-			self._root = marshal.load(inFile)
+			self._nodes = _LayeredList(self._nodes.base, marshal.load(inFile))
+			self._rawTemplates = marshal.load(inFile)
+			self._templates = [None] * len(self._rawTemplates)
+			self._templateIds = None
+			self._digestCache = None
+			self._frozen = False
+			inFile.close()
+		except Exception, e:
+			print "Error restoring PatternMgr overlay from file %s:" % filename
+			raise Exception, e
+
+	def _digest(self):
+		"""Return a digest of the node and template tables (including those
+		of any base brain).  An overlay refers to its base's nodes and
+		templates by index, so it can only be restored on top of a base
+		with the same digest as the one it was saved with.
+
+		The digest is kept until the brain changes, so that loading several
+		overlays on top of the same base only has to hash it once.
+
+		"""
+		if self._digestCache is not None:
+			return self._digestCache
+		digest = hashlib.sha1()
+		nodes = self._nodes
+		for nid in range(len(nodes)):
+			# Sort each node's items, so that the digest doesn't depend on
+			# the order they were added in.
+			digest.update(marshal.dumps(sorted(nodes[nid].items())))
+		for tid in range(self.numUniqueTemplates()):
+			digest.update(self._marshalledTemplate(tid))
+		self._digestCache = digest.digest()
+		return self._digestCache
+
+	def restore(self, filename):
+		"""Restore a previously save()d collection of patterns.
+
+		If this PatternMgr is an overlay, it is detached from its base.
+
+		"""
+		try:
+			inFile = open(filename, "rb")
+			header = marshal.load(inFile)
+			self._setBase(None)
+			self._digestCache = None
+			if header == self._BRAIN_MAGIC:
+				version = marshal.load(inFile)
+				if version != self._BRAIN_VERSION:
+					raise ValueError, "unsupported brain format version %s" % version
+				self._templateCount = marshal.load(inFile)
+				self._botName = marshal.load(inFile)
+				self._nodes = marshal.load(inFile)
+				# The templates themselves are only unmarshalled when they're
+				# first matched (see _template()).
+				self._rawTemplates = marshal.load(inFile)
+				self._templates = [None] * len(self._rawTemplates)
+				self._templateIds = None
+			else:
+				# Old-style brain, with the templates stored in the node tree.
+				self._templateCount = header
+				self._botName = marshal.load(inFile)
+				self._loadNestedTree(marshal.load(inFile))
+			self._frozen = False
 			inFile.close()
 		except Exception, e:
 			print "Error restoring PatternMgr from file %s:" % filename
 			raise Exception, e
 
+	def _loadNestedTree(self, root):
+		"""Replace the node and template tables with the contents of an
+		old-style node tree, made of nested dictionaries with each
+		template stored inline.
+
+		"""
+		self._nodes = [{}]
+		self._templates = []
+		self._rawTemplates = []
+		self._templateIds = {}
+		pending = [(root, self._nodes[0])]
+		while len(pending) > 0:
+			tree, node = pending.pop()
+			for key, value in tree.items():
+				if key == self._TEMPLATE:
+					node[key] = self._storeTemplate(compactElement(value))
+				else:
+					pending.append((value, self._childNode(node, key)))
+
 	def add(self, (pattern,that,topic), template):
 		"""Add a [pattern/that/topic] tuple and its corresponding template
 		to the node tree.
 
+		"""
+		if self._frozen:
+			self._thaw()
+		self._digestCache = None
+		path = self._path(pattern, that, topic)
+		self._addPath(self._nodes[self._root], path, self._storeTemplate(template))
+
+	def addMany(self, categories):
+		"""Add a batch of categories to the node tree.
+
+		categories is a sequence (or any other iterable) of
+		((pattern,that,topic), template) pairs.  The result is the same as
+		calling add() on each pair in turn; in particular, if a category
+		appears more than once, the last template wins.  For large
+		batches this is faster than add(), because categories that share
+		a prefix share the walk down the tree.
+
+		"""
+		builder = self.builder()
+		for key, template in categories:
+			builder.add(key, template)
+		builder.finish()
+
+	def builder(self):
+		"""Return a TreeBuilder, which adds categories to the node tree in
+		bulk.  See TreeBuilder for details.
+
+		"""
+		if self._frozen:
+			self._thaw()
+		self._digestCache = None
+		return TreeBuilder(self)
+
+	def merge(self, other):
+		"""Add all of the categories in another PatternMgr to this one.
+
+		If both contain a category with the same [pattern/that/topic]
+		tuple, the template from other wins; so merging several brains
+		in turn gives the later ones precedence.  The templates are
+		copied in their marshalled form, without unmarshalling them.
+
+		"""
+		builder = self.builder()
+		# Map other's template ids to ours.
+		tids = {}
+		pending = [((), other._nodes[other._root])]
+		while len(pending) > 0:
+			path, node = pending.pop()
+			for key, value in node.items():
+				if key == self._TEMPLATE:
+					try: tid = tids[value]
+					except KeyError:
+						tid = self._storeMarshalledTemplate(other._marshalledTemplate(value))
+						tids[value] = tid
+					builder.addPath(path, tid)
+				else:
+					pending.append((path + (key,), other._nodes[value]))
+		builder.finish()
+
+	def _keyName(self, key):
+		"""Return a node key as a string."""
+		if key == self._STAR: return u"*"
+		if key == self._UNDERSCORE: return u"_"
+		if key == self._THAT: return u"<that>"
+		if key == self._TOPIC: return u"<topic>"
+		if key == self._BOT_NAME: return u"<bot name>"
+		return key
+
+	def _path(self, pattern, that, topic):
+		"""Return a tuple containing the sequence of node keys leading from
+		the root to the template of a [pattern/that/topic] tuple.
+
 		"""
 		# TODO: make sure words contains only legal characters
 		# (alphanumerics,*,_)
-
-		# Navigate through the node tree to the template's location, adding
-		# nodes if necessary.
-		node = self._root
+		path = []
 		for word in string.split(pattern):
 			key = word
 			if key == u"_":
@@ -87,73 +426,208 @@ class PatternMgr:
 				key = self._STAR
 			elif key == u"BOT_NAME":
 				key = self._BOT_NAME
-			if not node.has_key(key):
-				node[key] = {}
-			node = node[key]
+			path.append(key)
 
 		# navigate further down, if a non-empty "that" pattern was included
 		if len(that) > 0:
-			if not node.has_key(self._THAT):
-				node[self._THAT] = {}
-			node = node[self._THAT]
+			path.append(self._THAT)
 			for word in string.split(that):
 				key = word
 				if key == u"_":
 					key = self._UNDERSCORE
 				elif key == u"*":
 					key = self._STAR
-				if not node.has_key(key):
-					node[key] = {}
-				node = node[key]
+				path.append(key)
 
 		# navigate yet further down, if a non-empty "topic" string was included
 		if len(topic) > 0:
-			if not node.has_key(self._TOPIC):
-				node[self._TOPIC] = {}
-			node = node[self._TOPIC]
+			path.append(self._TOPIC)
 			for word in string.split(topic):
 				key = word
 				if key == u"_":
 					key = self._UNDERSCORE
 				elif key == u"*":
 					key = self._STAR
-				if not node.has_key(key):
-					node[key] = {}
-				node = node[key]
+				path.append(key)
+		return tuple(path)
 
+	def _addPath(self, node, path, tid):
+		"""Attach template tid to the node reached by following path down
+		from node, adding nodes if necessary.
 
-		# add the template.
+		"""
+		for key in path:
+			node = self._childNode(node, key)
 		if not node.has_key(self._TEMPLATE):
 			self._templateCount += 1	
-		node[self._TEMPLATE] = template
+		node[self._TEMPLATE] = tid
+
+	def _childNode(self, node, key):
+		"""Return the child of node with the specified key, adding a new
+		node to the table if necessary.
+
+		In an overlay, the child is about to be modified, so if it belongs
+		to the base brain, it is replaced by a copy in the overlay.
+
+		"""
+		try: nid = node[key]
+		except KeyError:
+			child = {}
+		else:
+			if nid >= self._nodeOffset:
+				return self._nodes[nid]
+			child = dict(self._nodes[nid])
+		node[key] = len(self._nodes)
+		self._nodes.append(child)
+		return child
+
+	def _storeTemplate(self, template):
+		"""Add template to the template table, and return its id.
+
+		If an identical template is already in the table, the existing
+		entry is reused.
+
+		"""
+		return self._storeMarshalledTemplate(marshal.dumps(template), template)
 
-	def match(self, pattern, that, topic):
+	def _storeMarshalledTemplate(self, data, template = None):
+		"""Add a template to the template table, given its marshalled
+		form, and return its id.  If the unmarshalled template is already
+		at hand, it can be provided as well.
+
+		"""
+		if self._templateIds is None:
+			# Build the index lazily, so that restoring a brain doesn't
+			# require unmarshalling (or even hashing) every template.
+			self._templateIds = {}
+			for tid in range(self._templateOffset, self.numUniqueTemplates()):
+				key = self._templateKey(self._marshalledTemplate(tid))
+				self._templateIds.setdefault(key, tid)
+		key = self._templateKey(data)
+		try: return self._templateIds[key]
+		except KeyError: pass
+		tid = self._templateOffset + len(self._templates)
+		self._templates.append(template)
+		if template is None:
+			# _template() unmarshals it when it's needed.
+			self._rawTemplates.append(data)
+		else:
+			self._rawTemplates.append(None)
+		self._templateIds[key] = tid
+		return tid
+
+	def _templateKey(self, data):
+		"""Return the structural hash of a marshalled template."""
+		return hashlib.sha1(data).digest()
+
+	def _template(self, tid):
+		"""Return the template with the specified id, unmarshalling it
+		first if it hasn't been used since the brain was restored.
+
+		"""
+		if tid < self._templateOffset:
+			return self._base._template(tid)
+		tid -= self._templateOffset
+		# Several Kernels can be matching on the same brain at once (see
+		# Kernel.clone()), so each table is only read once, and another
+		# thread might unmarshal the same template in the meantime.
+		templates = self._templates
+		if templates is None:
+			# The brain is frozen.
+			return marshal.loads(self._rawTemplates[tid])
+		template = templates[tid]
+		if template is None:
+			rawTemplates = self._rawTemplates
+			data = rawTemplates[tid]
+			if data is None:
+				# Another thread got there first.
+				return templates[tid]
+			template = compactElement(marshal.loads(data))
+			templates[tid] = template
+			if type(rawTemplates) is list:
+				rawTemplates[tid] = None
+		return template
+
+	def _marshalledTemplate(self, tid):
+		"""Return the marshalled form of the template with the specified id."""
+		if tid < self._templateOffset:
+			return self._base._marshalledTemplate(tid)
+		tid -= self._templateOffset
+		data = self._rawTemplates[tid]
+		if data is None:
+			data = marshal.dumps(self._templates[tid])
+		return data
+
+	def _marshalledTemplates(self):
+		"""Return a list of every template in the table, in marshalled form."""
+		return [self._marshalledTemplate(tid) for tid in range(self.numUniqueTemplates())]
+
+	def match(self, pattern, that, topic, botName = None, budget = None):
 		"""Return the template which is the closest match to pattern. The
 		'that' parameter contains the bot's previous response. The 'topic'
-		parameter contains the current topic of conversation.
+		parameter contains the current topic of conversation.  If botName
+		is provided, it is used in place of the name set with setBotName().
+		If budget is provided, it is a MatchBudget that limits the work
+		matching can do; BudgetExceeded is raised if it runs out.
 
 		Returns None if no template is found.
 		
+		"""
+		tid = self.matchId(pattern, that, topic, botName, budget)
+		if tid is None:
+			return None
+		return self._template(tid)
+
+	def matchId(self, pattern, that, topic, botName = None, budget = None, tokens = None):
+		"""Like match(), but return the id of the template instead of the
+		template itself (see template()).  Identical templates share the
+		same id.
+
+		If tokens is provided, it is a tuple containing the results of
+		tokens() for pattern, that and topic, which saves working them
+		out again.
+
 		"""
 		if len(pattern) == 0:
 			return None
+		patMatch, template = self._matchPath(pattern, that, topic, botName, budget, tokens)
+		return template
+
+	def tokens(self, text, segment = "pattern"):
+		"""Return the list of words that text is matched as.
+
+		The segment parameter says which part of the input text is:
+		'pattern', 'that' or 'topic'.  An empty that or topic is replaced
+		by a placeholder word, which only a wildcard matches.
+
+		"""
+		# 'that' and 'topic' must never be empty
+		if segment == "that" and text.strip() == u"": text = u"ULTRABOGUSDUMMYTHAT"
+		elif segment == "topic" and text.strip() == u"": text = u"ULTRABOGUSDUMMYTOPIC"
 		# Mutilate the input.  Remove all punctuation and convert the
 		# text to all caps.
-		input = string.upper(pattern)
-		input = re.sub(self._puncStripRE, " ", input)
-		if that.strip() == u"": that = u"ULTRABOGUSDUMMYTHAT" # 'that' must never be empty
-		thatInput = string.upper(that)
-		thatInput = re.sub(self._puncStripRE, " ", thatInput)
-		thatInput = re.sub(self._whitespaceRE, " ", thatInput)
-		if topic.strip() == u"": topic = u"ULTRABOGUSDUMMYTOPIC" # 'topic' must never be empty
-		topicInput = string.upper(topic)
-		topicInput = re.sub(self._puncStripRE, " ", topicInput)
-		
+		text = string.upper(text)
+		text = re.sub(self._puncStripRE, " ", text)
+		text = re.sub(self._whitespaceRE, " ", text)
+		return text.split()
+
+	def template(self, tid):
+		"""Return the template with the specified id."""
+		return self._template(tid)
+
+	def _matchPath(self, pattern, that, topic, botName = None, trace = None, tokens = None):
+		"""Do the work of match(), and return the (pat, tem) tuple
+		returned by _match().
+
+		"""
+		if tokens is None:
+			tokens = (self.tokens(pattern), self.tokens(that, "that"), self.tokens(topic, "topic"))
 		# Pass the input off to the recursive call
-		patMatch, template = self._match(input.split(), thatInput.split(), topicInput.split(), self._root)
-		return template
+		if botName is None: botName = self._botName
+		words, thatWords, topicWords = tokens
+		return self._match(words, thatWords, topicWords, self._nodes[self._root], botName, trace)
 
-	def star(self, starType, pattern, that, topic, index):
+	def star(self, starType, pattern, that, topic, index, botName = None, budget = None, tokens = None):
 		"""Returns a string, the portion of pattern that was matched by a *.
 
 		The 'starType' parameter specifies which type of star to find.
@@ -162,23 +636,17 @@ class PatternMgr:
 		 - 'thatstar': matches a star in the that pattern.
 		 - 'topicstar': matches a star in the topic pattern.
 
+		The botName, budget and tokens parameters have the same meaning
+		as in match() and matchId().
+
 		"""
-		# Mutilate the input.  Remove all punctuation and convert the
-		# text to all caps.
-		input = string.upper(pattern)
-		input = re.sub(self._puncStripRE, " ", input)
-		input = re.sub(self._whitespaceRE, " ", input)
+		if tokens is None:
+			tokens = (self.tokens(pattern), self.tokens(that, "that"), self.tokens(topic, "topic"))
 		if that.strip() == u"": that = u"ULTRABOGUSDUMMYTHAT" # 'that' must never be empty
-		thatInput = string.upper(that)
-		thatInput = re.sub(self._puncStripRE, " ", thatInput)
-		thatInput = re.sub(self._whitespaceRE, " ", thatInput)
 		if topic.strip() == u"": topic = u"ULTRABOGUSDUMMYTOPIC" # 'topic' must never be empty
-		topicInput = string.upper(topic)
-		topicInput = re.sub(self._puncStripRE, " ", topicInput)
-		topicInput = re.sub(self._whitespaceRE, " ", topicInput)
 
 		# Pass the input off to the recursive pattern-matcher
-		patMatch, template = self._match(input.split(), thatInput.split(), topicInput.split(), self._root)
+		patMatch, template = self._matchPath(pattern, that, topic, botName, budget, tokens)
 		if template == None:
 			return ""
 
@@ -187,13 +655,13 @@ class PatternMgr:
 		words = None
 		if starType == 'star':
 			patMatch = patMatch[:patMatch.index(self._THAT)]
-			words = input.split()
+			words = tokens[0]
 		elif starType == 'thatstar':
 			patMatch = patMatch[patMatch.index(self._THAT)+1 : patMatch.index(self._TOPIC)]
-			words = thatInput.split()
+			words = tokens[1]
 		elif starType == 'topicstar':
 			patMatch = patMatch[patMatch.index(self._TOPIC)+1 :]
-			words = topicInput.split()
+			words = tokens[2]
 		else:
 			# unknown value
 			raise ValueError, "starType must be in ['star', 'thatstar', 'topicstar']"
@@ -247,12 +715,19 @@ class PatternMgr:
 			elif starType == 'topicstar': return string.join(topic.split()[start:end+1])
 		else: return ""
 
-	def _match(self, words, thatWords, topicWords, root):
+	def _match(self, words, thatWords, topicWords, root, botName, trace = None):
 		"""Return a tuple (pat, tem) where pat is a list of nodes, starting
 		at the root and leading to the matching pattern, and tem is the
-		matched template.
+		id of the matched template.  botName is the word that matches
+		BOT_NAME in patterns.
+
+		If trace is a _MatchTrace object, the work done is recorded in it
+		(see explain()).  It can also be a MatchBudget, which only counts
+		the nodes visited.
 
 		""" 
+		if trace is not None:
+			segment = trace.visit(words, thatWords, topicWords)
 		# base-case: if the word list is empty, return the current node's
 		# template.
 		if len(words) == 0:
@@ -262,23 +737,29 @@ class PatternMgr:
 			if len(thatWords) > 0:
 				# If thatWords isn't empty, recursively
 				# pattern-match on the _THAT node with thatWords as words.
+				traced = trace is not None and root.has_key(self._THAT)
+				if traced: trace.push(self._THAT)
 				try:
-					pattern, template = self._match(thatWords, [], topicWords, root[self._THAT])
+					pattern, template = self._match(thatWords, [], topicWords, self._nodes[root[self._THAT]], botName, trace)
 					if pattern != None:
 						pattern = [self._THAT] + pattern
 				except KeyError:
 					pattern = []
 					template = None
+				if traced: trace.pop(segment, template)
 			elif len(topicWords) > 0:
 				# If thatWords is empty and topicWords isn't, recursively pattern
 				# on the _TOPIC node with topicWords as words.
+				traced = trace is not None and root.has_key(self._TOPIC)
+				if traced: trace.push(self._TOPIC)
 				try:
-					pattern, template = self._match(topicWords, [], [], root[self._TOPIC])
+					pattern, template = self._match(topicWords, [], [], self._nodes[root[self._TOPIC]], botName, trace)
 					if pattern != None:
 						pattern = [self._TOPIC] + pattern
 				except KeyError:
 					pattern = []
 					template = None
+				if traced: trace.pop(segment, template)
 			if template == None:
 				# we're totally out of input.  Grab the template at this node.
 				pattern = []
@@ -297,21 +778,27 @@ class PatternMgr:
 			# where a * or _ is at the end of the pattern.
 			for j in range(len(suffix)+1):
 				suf = suffix[j:]
-				pattern, template = self._match(suf, thatWords, topicWords, root[self._UNDERSCORE])
+				if trace is not None: trace.push(self._UNDERSCORE)
+				pattern, template = self._match(suf, thatWords, topicWords, self._nodes[root[self._UNDERSCORE]], botName, trace)
+				if trace is not None: trace.pop(segment, template, words[:j+1])
 				if template is not None:
 					newPattern = [self._UNDERSCORE] + pattern
 					return (newPattern, template)
 
 		# Check first
 		if root.has_key(first):
-			pattern, template = self._match(suffix, thatWords, topicWords, root[first])
+			if trace is not None: trace.push(first)
+			pattern, template = self._match(suffix, thatWords, topicWords, self._nodes[root[first]], botName, trace)
+			if trace is not None: trace.pop(segment, template)
 			if template is not None:
 				newPattern = [first] + pattern
 				return (newPattern, template)
 
 		# check bot name
-		if root.has_key(self._BOT_NAME) and first == self._botName:
-			pattern, template = self._match(suffix, thatWords, topicWords, root[self._BOT_NAME])
+		if root.has_key(self._BOT_NAME) and first == botName:
+			if trace is not None: trace.push(self._BOT_NAME)
+			pattern, template = self._match(suffix, thatWords, topicWords, self._nodes[root[self._BOT_NAME]], botName, trace)
+			if trace is not None: trace.pop(segment, template)
 			if template is not None:
 				newPattern = [first] + pattern
 				return (newPattern, template)
@@ -322,10 +809,402 @@ class PatternMgr:
 			# where a * or _ is at the end of the pattern.
 			for j in range(len(suffix)+1):
 				suf = suffix[j:]
-				pattern, template = self._match(suf, thatWords, topicWords, root[self._STAR])
+				if trace is not None: trace.push(self._STAR)
+				pattern, template = self._match(suf, thatWords, topicWords, self._nodes[root[self._STAR]], botName, trace)
+				if trace is not None: trace.pop(segment, template, words[:j+1])
 				if template is not None:
 					newPattern = [self._STAR] + pattern
 					return (newPattern, template)
 
 		# No matches were found.
 		return (None, None)			
+
+	def explain(self, pattern, that, topic, botName = None):
+		"""Match an input the way match() does, and return a dictionary
+		explaining the result, for finding out why an input matches the
+		category it does, or why matching it is slow.
+
+		The dictionary contains the following entries:
+		 - 'template': the matched template, or None.
+		 - 'path': the keys of the nodes leading to the template, as
+		   strings.  The that and topic parts of the path start with
+		   "<that>" and "<topic>".
+		 - 'captures': a list of (segment, words) tuples, one for each
+		   wildcard in the path, giving the words that it matched.  The
+		   segment is 'pattern', 'that' or 'topic'.
+		 - 'segments': a dictionary with an entry for each segment, giving
+		   the number of nodes 'visited' and the number of 'backtracks'
+		   (branches that were tried and abandoned) in that segment.
+		 - 'rejected': a list of (path, attempts) tuples for the branches
+		   that were abandoned, in the order they were first tried.  path
+		   is the path to the branch, and attempts is the number of times
+		   it was tried (a wildcard is tried once for each number of
+		   words it could match).
+
+		"""
+		trace = _MatchTrace(self)
+		patMatch, template = None, None
+		if len(pattern) > 0:
+			patMatch, template = self._matchPath(pattern, that, topic, botName, trace)
+		result = trace.result()
+		result["template"] = None
+		result["path"] = []
+		if template is not None:
+			result["template"] = self._template(template)
+			result["path"] = [self._keyName(key) for key in patMatch]
+		else:
+			# Nothing was captured on the way to a template.
+			result["captures"] = []
+		return result
+
+class TreeBuilder:
+	"""Adds categories to a PatternMgr's node tree in bulk.
+
+	Categories passed to add() are stored in the PatternMgr's template table
+	right away, but only enter the node tree when finish() is called.  At
+	that point they are sorted by path, so that each category only has to
+	be walked down from the point where its path diverges from the
+	previous one's.  The end result is the same as calling PatternMgr.add()
+	on each category in the order they were passed to add().
+	finish() can be called as often as needed; each call adds the
+	categories queued since the last one.
+
+	"""
+	def __init__(self, patternMgr):
+		self._patternMgr = patternMgr
+		self._entries = []
+
+	def add(self, (pattern,that,topic), template):
+		"""Queue a [pattern/that/topic] tuple and its template."""
+		mgr = self._patternMgr
+		self._entries.append((mgr._path(pattern, that, topic), mgr._storeTemplate(template)))
+
+	def addPath(self, path, tid):
+		"""Queue a template that is already in the template table, under a
+		path in the form returned by PatternMgr._path().
+
+		"""
+		self._entries.append((path, tid))
+
+	def size(self):
+		"""Return the number of categories waiting for finish()."""
+		return len(self._entries)
+
+	def finish(self):
+		"""Add all of the queued categories to the node tree."""
+		mgr = self._patternMgr
+		mgr._digestCache = None
+		nodes = mgr._nodes
+		entries = self._entries
+		self._entries = []
+		# The sort is stable, so duplicate paths stay in their original
+		# order, and the last one wins.
+		entries.sort(key=lambda entry: entry[0])
+		# stack[i] is the node reached by following the first i keys of
+		# the previous path.
+		stack = [nodes[mgr._root]]
+		prevPath = ()
+		for path, tid in entries:
+			common = 0
+			limit = min(len(path), len(prevPath))
+			while common < limit and path[common] == prevPath[common]:
+				common += 1
+			del stack[common+1:]
+			node = stack[-1]
+			for i in range(common, len(path)):
+				key = path[i]
+				try: nid = node[key]
+				except KeyError:
+					# Everything below a newly-added node is new as well,
+					# so there's no need to look before adding the rest.
+					for key in path[i:]:
+						child = {}
+						node[key] = len(nodes)
+						nodes.append(child)
+						node = child
+						stack.append(node)
+					break
+				if nid < mgr._nodeOffset:
+					# A node in an overlay's base brain; copy it first.
+					node = mgr._childNode(node, key)
+				else:
+					node = nodes[nid]
+				stack.append(node)
+			if not node.has_key(mgr._TEMPLATE):
+				mgr._templateCount += 1
+			node[mgr._TEMPLATE] = tid
+			prevPath = path
+
+
+class _LayeredList:
+	"""A sequence made of two others, one stacked on top of the other.
+	Indices past the end of the base sequence refer to the top sequence,
+	and new items are appended to the top.
+
+	"""
+	def __init__(self, base, top):
+		self.base = base
+		self.top = top
+		self._offset = len(base)
+
+	def __len__(self):
+		return self._offset + len(self.top)
+
+	def __getitem__(self, i):
+		if i < self._offset:
+			return self.base[i]
+		return self.top[i - self._offset]
+
+	def append(self, item):
+		self.top.append(item)
+
+
+class _MatchTrace:
+	"""Records the work done by PatternMgr._match(), for explain()."""
+	def __init__(self, patternMgr):
+		self._patternMgr = patternMgr
+		self._stack = []
+		self._captures = []
+		self._segments = {}
+		for segment in ["pattern", "that", "topic"]:
+			self._segments[segment] = {"visited": 0, "backtracks": 0}
+		self._rejected = {}
+		self._rejectedOrder = []
+
+	def visit(self, words, thatWords, topicWords):
+		"""Record a visit to a node, and return the segment it's in."""
+		# The that and topic words are consumed in turn, once the
+		# pattern's words have run out.
+		if len(thatWords) > 0: segment = "pattern"
+		elif len(topicWords) > 0: segment = "that"
+		else: segment = "topic"
+		self._segments[segment]["visited"] += 1
+		return segment
+
+	def push(self, key):
+		"""Record that matching is about to descend to the child with the
+		specified key.
+
+		"""
+		self._stack.append(key)
+
+	def pop(self, segment, template, captured = None):
+		"""Record the return from a child, with the template found there
+		(if any).  For wildcards, captured is the list of words it
+		matched.
+
+		"""
+		if template is None:
+			self._segments[segment]["backtracks"] += 1
+			path = tuple([self._patternMgr._keyName(key) for key in self._stack])
+			if not self._rejected.has_key(path):
+				self._rejected[path] = 0
+				self._rejectedOrder.append(path)
+			self._rejected[path] += 1
+		elif captured is not None:
+			# Matching unwinds from the end of the path, so the captures
+			# are found in reverse order.
+			self._captures.insert(0, (segment, captured))
+		self._stack.pop()
+
+	def result(self):
+		"""Return the trace as a dictionary (see PatternMgr.explain())."""
+		return {
+			"captures": self._captures,
+			"segments": self._segments,
+			"rejected": [(list(path), self._rejected[path]) for path in self._rejectedOrder],
+		}
+
+
+class MatchBudget:
+	"""Limits the work done by one or more calls to PatternMgr.match().
+
+	Each node visited by the matcher uses up one unit of the budget (and
+	callers can use up more with spend(), for work of their own).  Once
+	more than 'nodes' units have been used, or the time given by
+	'deadline' (as returned by time.time()) has passed, BudgetExceeded is
+	raised.  Either limit can be None.
+
+	"""
+	# The clock is only checked this often, since it costs more than a
+	# node visit does.
+	_clockInterval = 64
+
+	def __init__(self, nodes = None, deadline = None):
+		self.nodes = nodes
+		self.deadline = deadline
+		self.used = 0
+		self._nextCheck = 0 # the clock is checked once used reaches this
+
+	def spend(self, amount = 1):
+		"""Use up part of the budget, raising BudgetExceeded if it has
+		run out.
+
+		"""
+		self.used += amount
+		if self.nodes is not None and self.used > self.nodes:
+			raise BudgetExceeded, "node budget of %d exceeded" % self.nodes
+		if self.deadline is not None and self.used >= self._nextCheck:
+			self._nextCheck = self.used + self._clockInterval
+			self.check()
+
+	def check(self):
+		"""Raise BudgetExceeded if the deadline has passed, without using
+		up any of the budget.
+
+		"""
+		if self.deadline is not None and time.time() > self.deadline:
+			raise BudgetExceeded, "deadline passed"
+
+	# The matcher calls the same methods as it does on a _MatchTrace.
+	def visit(self, words, thatWords, topicWords):
+		self.spend()
+
+	def push(self, key):
+		pass
+
+	def pop(self, segment, template, captured = None):
+		pass
+
+
+# Self test
+if __name__ == "__main__":
+	def _template(text):
+		return ("template", {}, ("text", {}, text))
+	categories = [
+		((u"HELLO", u"*", u"*"), _template(u"hi")),
+		((u"HELLO *", u"*", u"*"), _template(u"hi there")),
+		((u"_ THERE", u"*", u"*"), _template(u"where")),
+		((u"YES", u"DO YOU *", u"*"), _template(u"good")),
+		((u"YES", u"*", u"FRUIT"), _template(u"apples")),
+		((u"HELLO", u"*", u"*"), _template(u"hello again")),
+		((u"HELLO BOT_NAME", u"*", u"*"), _template(u"that's me")),
+	]
+
+	# addMany() and the TreeBuilder (even when it's finished more than
+	# once) give the same result as add()ing each category in turn; the
+	# last template for a category wins.
+	added = PatternMgr()
+	for key, template in categories:
+		added.add(key, template)
+	bulk = PatternMgr()
+	bulk.addMany(categories)
+	built = PatternMgr()
+	builder = built.builder()
+	for i, (key, template) in enumerate(categories):
+		builder.add(key, template)
+		if i % 3 == 2: builder.finish()
+	builder.finish()
+	for mgr in [bulk, built]:
+		assert(mgr.numTemplates() == added.numTemplates() == 6)
+		assert(mgr._nestedNode(mgr._root) == added._nestedNode(added._root))
+	assert(bulk.match(u"hello", u"", u"") == _template(u"hello again"))
+	assert(bulk.match(u"hello out there", u"", u"") == _template(u"where"))
+	assert(bulk.match(u"yes", u"do you like it", u"") == _template(u"good"))
+	assert(bulk.match(u"yes", u"", u"fruit") == _template(u"apples"))
+	bulk.setBotName(u"ALICE")
+	assert(bulk.match(u"hello alice", u"", u"") == _template(u"that's me"))
+
+	# Merging brains (here restored from files, as brainmerge.py and
+	# Kernel.mergeBrain() do) gives the same result as adding their
+	# categories in turn: where brains share a category, the one merged
+	# last wins, and shared categories are only counted once.
+	import os, tempfile
+	others = [
+		[((u"HELLO", u"*", u"*"), _template(u"hello from two")),
+		 ((u"GOODBYE", u"*", u"*"), _template(u"bye from two"))],
+		[((u"GOODBYE", u"*", u"*"), _template(u"bye from three")),
+		 ((u"YES", u"DO YOU *", u"*"), _template(u"good")),
+		 ((u"THANKS", u"*", u"*"), _template(u"you're welcome"))],
+	]
+	merged = PatternMgr()
+	merged.addMany(categories)
+	expected = PatternMgr()
+	expected.addMany(categories)
+	for batch in others:
+		source = PatternMgr()
+		source.addMany(batch)
+		fd, brainFile = tempfile.mkstemp()
+		os.close(fd)
+		source.save(brainFile)
+		restored = PatternMgr()
+		restored.restore(brainFile)
+		os.remove(brainFile)
+		merged.merge(restored)
+		for key, template in batch:
+			expected.add(key, template)
+	assert(merged.numTemplates() == expected.numTemplates() == 8)
+	for input in [u"hello", u"goodbye", u"thanks", u"hello world"]:
+		assert(merged.match(input, u"", u"") == expected.match(input, u"", u""))
+	assert(merged.match(u"hello", u"", u"") == _template(u"hello from two"))
+	assert(merged.match(u"goodbye", u"", u"") == _template(u"bye from three"))
+	assert(merged.match(u"yes", u"do you like it", u"") == _template(u"good"))
+
+	# An overlay can only be restored on top of the base it was saved
+	# with, not just one of the same size.
+	base = PatternMgr()
+	base.addMany(categories)
+	overlay = PatternMgr(base)
+	overlay.add((u"GOODBYE", u"*", u"*"), _template(u"bye"))
+	overlay.add((u"HELLO", u"*", u"*"), _template(u"hi overlay"))
+	fd, overlayFile = tempfile.mkstemp()
+	os.close(fd)
+	overlay.saveOverlay(overlayFile)
+	restored = PatternMgr(base)
+	restored.restoreOverlay(overlayFile)
+	assert(restored.numTemplates() == 7)
+	assert(restored.match(u"goodbye", u"", u"") == _template(u"bye"))
+	assert(restored.match(u"hello", u"", u"") == _template(u"hi overlay"))
+	assert(restored.match(u"hello world", u"", u"") == _template(u"hi there"))
+	edited = PatternMgr()
+	edited.addMany([(key, _template(u"edited %d" % i)) for i, (key, template) in enumerate(categories)])
+	assert(len(edited._nodes) == len(base._nodes) and edited.numUniqueTemplates() == base.numUniqueTemplates())
+	sys.stdout = open(os.devnull, "w") # restoreOverlay() reports the error
+	try: PatternMgr(edited).restoreOverlay(overlayFile)
+	except Exception: pass
+	else: raise AssertionError, "overlay restored on top of the wrong base"
+	sys.stdout = sys.__stdout__
+	# The base's digest is kept between overlays, but not once it changes.
+	assert(base._digestCache is not None)
+	base.add((u"HELLO", u"*", u"*"), _template(u"hi"))
+	assert(len(base._nodes) == len(edited._nodes) and base.numUniqueTemplates() == edited.numUniqueTemplates())
+	sys.stdout = open(os.devnull, "w")
+	try: PatternMgr(base).restoreOverlay(overlayFile)
+	except Exception: pass
+	else: raise AssertionError, "overlay restored on top of a changed base"
+	sys.stdout = sys.__stdout__
+	os.remove(overlayFile)
+
+	# A brain (frozen or not) survives being saved in the current format
+	# and restored.  Files in any other version of the format are refused.
+	bulk.freeze()
+	fd, brainFile = tempfile.mkstemp()
+	os.close(fd)
+	bulk.save(brainFile)
+	restored = PatternMgr()
+	restored.restore(brainFile)
+	assert(not restored.isFrozen())
+	assert(restored.numTemplates() == bulk.numTemplates())
+	assert(restored._nestedNode(restored._root) == bulk._nestedNode(bulk._root))
+	for input in [u"hello", u"hello world", u"hello out there", u"hello alice"]:
+		assert(restored.match(input, u"", u"") == bulk.match(input, u"", u""))
+	outFile = open(brainFile, "wb")
+	marshal.dump(PatternMgr._BRAIN_MAGIC, outFile)
+	marshal.dump(2, outFile)
+	outFile.close()
+	sys.stdout = open(os.devnull, "w") # restore() reports the error
+	try: PatternMgr().restore(brainFile)
+	except Exception, e: assert(str(e) == "unsupported brain format version 2")
+	else: raise AssertionError, "version 2 brain file restored"
+	sys.stdout = sys.__stdout__
+	os.remove(brainFile)
+
+	# A match that visits n nodes fits in a budget of n nodes, but not n-1.
+	budget = MatchBudget()
+	bulk.matchId(u"hello world", u"", u"", None, budget)
+	needed = budget.used
+	assert(needed > 1)
+	assert(bulk.match(u"hello world", u"", u"", None, MatchBudget(needed)) == _template(u"hi there"))
+	try: bulk.match(u"hello world", u"", u"", None, MatchBudget(needed - 1))
+	except BudgetExceeded, e: assert(str(e) == "node budget of %d exceeded" % (needed - 1))
+	else: raise AssertionError, "node budget not enforced"
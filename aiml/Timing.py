@@ -0,0 +1,160 @@
+"""This file contains the TimingCollector class, which uses the Kernel's
+hooks to measure where the time spent responding to input goes.
+
+Usage:
+    > collector = TimingCollector()
+    > collector.attach(kernel)
+    > kernel.respond("Hello")
+    > print collector.report()
+
+"""
+
+import string
+import threading
+import time
+
+class TimingCollector:
+    """Aggregates the time spent in each phase of Kernel.respond(), and in
+    each type of template element.
+
+    Timings are kept under keys of the form "phase" or "phase:detail"
+    (e.g. "match", "substitute:normal" or "element:srai").  For each
+    key, the collector records the number of calls, the total time (which
+    includes any nested phases, e.g. everything a <srai> element does),
+    the self time (which doesn't), and the longest call.
+
+    A collector can be attached to several Kernels at once, and is safe
+    to use from several threads.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+
+    def attach(self, kern):
+        """Register the collector's hooks with a Kernel."""
+        kern.addHook(None, self.pre, self.post)
+
+    def detach(self, kern):
+        """Unregister the collector's hooks from a Kernel."""
+        kern.removeHook(None, self.pre, self.post)
+
+    def reset(self):
+        """Discard all of the timings collected so far."""
+        self._lock.acquire()
+        self._stats = {}
+        self._lock.release()
+
+    def pre(self, phase, detail, sessionID):
+        """The 'pre' hook: start timing a phase."""
+        try: stack = self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+        # Each entry is [key, start time, time spent in nested phases].
+        stack.append([self._key(phase, detail), time.time(), 0.0])
+
+    def post(self, phase, detail, sessionID):
+        """The 'post' hook: stop timing a phase, and record the result."""
+        end = time.time()
+        try: stack = self._local.stack
+        except AttributeError: return
+        key = self._key(phase, detail)
+        # If a phase was aborted by an exception, its entry may still be on
+        # the stack; skip over it.
+        while len(stack) > 0 and stack[-1][0] != key:
+            stack.pop()
+        if len(stack) == 0:
+            return
+        key, start, nested = stack.pop()
+        elapsed = end - start
+        if len(stack) > 0:
+            stack[-1][2] += elapsed
+        self._lock.acquire()
+        try:
+            try: stats = self._stats[key]
+            except KeyError:
+                stats = self._stats[key] = {"count": 0, "total": 0.0, "self": 0.0, "max": 0.0}
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["self"] += elapsed - nested
+            if elapsed > stats["max"]:
+                stats["max"] = elapsed
+        finally:
+            self._lock.release()
+
+    def _key(self, phase, detail):
+        if detail is None:
+            return phase
+        return "%s:%s" % (phase, detail)
+
+    def stats(self):
+        """Return a dictionary mapping each key to a dictionary with the
+        entries 'count', 'total', 'self', 'max' and 'mean'.  The times are
+        in seconds.
+
+        """
+        self._lock.acquire()
+        try:
+            result = {}
+            for key, stats in self._stats.items():
+                result[key] = dict(stats)
+                result[key]["mean"] = stats["total"] / stats["count"]
+            return result
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """Return the timings as a table, in order of self time."""
+        stats = self.stats()
+        keys = stats.keys()
+        keys.sort(key=lambda key: -stats[key]["self"])
+        lines = ["%-24s %8s %10s %10s %10s %10s" % ("phase", "count", "total ms", "self ms", "mean ms", "max ms")]
+        for key in keys:
+            s = stats[key]
+            lines.append("%-24s %8d %10.2f %10.2f %10.3f %10.3f" % (key, s["count"],
+                s["total"] * 1000, s["self"] * 1000, s["mean"] * 1000, s["max"] * 1000))
+        return string.join(lines, "\n")
+
+# Self test
+if __name__ == "__main__":
+    import Kernel
+    kern = Kernel.Kernel()
+    kern.verbose(False)
+    kern.learn("""<aiml>
+        <category><pattern>HELLO</pattern><template>Hi there</template></category>
+        <category><pattern>HI</pattern><template><srai>HELLO</srai></template></category>
+    </aiml>""")
+    collector = TimingCollector()
+    collector.attach(kern)
+    kern.respond("hi")
+    kern.respond("hello")
+    stats = collector.stats()
+    assert(stats["respond"]["count"] == 2)
+    assert(stats["sentences"]["count"] == 2)
+    assert(stats["match"]["count"] == 3) # including the <srai>
+    assert(stats["element:srai"]["count"] == 1)
+    for s in stats.values():
+        assert(0.0 <= s["self"] <= s["total"] + 1e-9 and s["max"] <= s["total"] + 1e-9)
+    # A nested phase's time counts towards the total of the phase around it.
+    assert(stats["respond"]["total"] >= stats["match"]["total"])
+
+    # The 'respond' post hook is called even if the response fails.  (A
+    # failed response leaves its session in a mess, so it gets one of its
+    # own.)
+    def fail(phase, detail, sessionID):
+        raise RuntimeError, "hook failed"
+    kern.addHook("element", fail)
+    try: kern.respond("hello", "failing")
+    except RuntimeError: pass
+    else: raise AssertionError, "hook exception swallowed"
+    kern.removeHook("element", fail)
+    assert(collector.stats()["respond"]["count"] == 3)
+
+    # Once detached, the collector sees nothing more.
+    collector.detach(kern)
+    assert(kern._hooks is None)
+    kern.respond("hello")
+    assert(collector.stats()["respond"]["count"] == 3)
+    collector.reset()
+    assert(collector.stats() == {})
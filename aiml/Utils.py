@@ -3,30 +3,135 @@ modules in the PyAIML package.
 
 """
 
+import hashlib
+import re
+
+def contentDigest(data):
+    """Return the digest of the string data used to identify files in
+    manifests (see readManifest()).
+
+    """
+    return hashlib.sha1(data).hexdigest()
+
+def readManifest(filename):
+    """Read a manifest file, and return the set of digests it contains.
+
+    A manifest lists files by the SHA-1 digest of their contents, in the
+    format written by the sha1sum utility: one file per line, with the
+    hexadecimal digest followed by whitespace and the filename.  Only the
+    digests matter.  Blank lines and lines starting with '#' are ignored.
+
+    """
+    digests = set()
+    inFile = file(filename)
+    for line in inFile:
+        line = line.strip()
+        if len(line) == 0 or line[0] == "#":
+            continue
+        digests.add(line.split()[0].lower())
+    inFile.close()
+    return digests
+
+# Characters that are escaped in transcript files, and their escapes.
+_transcriptEscapes = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"}
+_transcriptEscapeRE = re.compile(r"[\\\t\n\r]")
+_transcriptUnescapes = dict([(v, k) for k, v in _transcriptEscapes.items()])
+_transcriptUnescapeRE = re.compile(r"\\[\\tnr]")
+
+def transcriptLine(sessionID, input, response):
+    """Return the line of a transcript file that records one exchange.
+
+    A transcript is a UTF-8 text file with one exchange per line: the
+    session ID, the input and the response, separated by tabs.
+    Backslashes, tabs and line breaks within the fields are escaped with
+    backslashes.
+
+    """
+    fields = []
+    for field in [sessionID, input, response]:
+        if type(field) == unicode:
+            field = field.encode("utf-8")
+        elif type(field) != str:
+            field = str(field)
+        fields.append(_transcriptEscapeRE.sub(lambda m: _transcriptEscapes[m.group()], field))
+    return "\t".join(fields) + "\n"
+
+def readTranscript(filename):
+    """Read a transcript file (see transcriptLine()), and return a list of
+    (sessionID, input, response) tuples, in the order of the file.
+
+    The responses are optional; for lines without one, the response is
+    None.  Blank lines and lines starting with '#' are ignored.
+
+    """
+    exchanges = []
+    inFile = file(filename)
+    for line in inFile:
+        line = line.rstrip("\r\n")
+        if len(line.strip()) == 0 or line[0] == "#":
+            continue
+        fields = [_transcriptUnescapeRE.sub(lambda m: _transcriptUnescapes[m.group()], f) for f in line.split("\t")]
+        if len(fields) < 2:
+            raise ValueError, "bad transcript line: %s" % line
+        if len(fields) == 2:
+            fields.append(None)
+        exchanges.append(tuple(fields[:3]))
+    inFile.close()
+    return exchanges
+
+# The characters that end a sentence.
+_sentenceEndRE = re.compile("[.?!]")
+
 def sentences(s):
     """Split the string s into a list of sentences."""
+    return list(iterSentences(s))
+
+def iterSentences(s):
+    """Generate the sentences in the string s, one at a time, as
+    sentences() would return them.
+
+    """
     try: s+""
     except: raise TypeError, "s must be a string"
     pos = 0
-    sentenceList = []
-    l = len(s)
-    while pos < l:
-        try: p = s.index('.', pos)
-        except: p = l+1
-        try: q = s.index('?', pos)
-        except: q = l+1
-        try: e = s.index('!', pos)
-        except: e = l+1
-        end = min(p,q,e)
-        sentenceList.append( s[pos:end].strip() )
-        pos = end+1
-    # If no sentences were found, return a one-item list containing
-    # the entire input string.
-    if len(sentenceList) == 0: sentenceList.append(s)
-    return sentenceList
+    for m in _sentenceEndRE.finditer(s):
+        yield s[pos:m.start()].strip()
+        pos = m.end()
+    if pos < len(s):
+        yield s[pos:].strip()
+    elif len(s) == 0:
+        # There are no sentences in the string, so it's returned as
+        # it is.
+        yield s
 
 # Self test
 if __name__ == "__main__":
     # sentences
     sents = sentences("First.  Second, still?  Third and Final!  Well, not really")
     assert(len(sents) == 4)
+    # An empty string is a single empty sentence, and the last sentence
+    # doesn't need a terminator.  Each terminator ends a sentence, even an
+    # empty one, and anything after the last one (even whitespace) makes
+    # another.
+    assert(sentences("") == [""])
+    assert(sentences("No terminator") == ["No terminator"])
+    assert(sentences("Trailing punctuation!") == ["Trailing punctuation"])
+    assert(sentences("  Trailing space!  ") == ["Trailing space", ""])
+    assert(sentences("Wait...  what") == ["Wait", "", "", "what"])
+    assert(sentences(u"Unicode?  Yes.") == [u"Unicode", u"Yes"])
+    try: sentences(None)
+    except TypeError: pass
+    else: raise AssertionError, "sentences(None) didn't raise TypeError"
+    sents = iterSentences("First.  Second")
+    assert(sents.next() == "First")
+    assert(list(sents) == ["Second"])
+
+    # transcripts
+    import os, tempfile
+    fd, name = tempfile.mkstemp()
+    os.write(fd, transcriptLine("s1", u"Hi\tthere\\", "line one\nline two"))
+    os.write(fd, "# comment\ns2\tno response\n")
+    os.close(fd)
+    exchanges = readTranscript(name)
+    os.remove(name)
+    assert(exchanges == [("s1", "Hi\tthere\\", "line one\nline two"), ("s2", "no response", None)])
@@ -0,0 +1,68 @@
+"""
+PyAIML brain analyzer.
+
+Usage:
+    aimlanalyze.py [options] file1 [file2 ...]
+
+Looks for categories that can make pattern matching expensive, such as
+patterns with several adjacent wildcards, and searches for inputs that
+make the matcher visit as many nodes as possible.  The files can be AIML
+files or brain files (as written by Kernel.saveBrain()); brain files are
+recognized by their .brn extension.  See aiml.Analyzer for how the costs
+are worked out.
+
+Options:
+    -l length    Analyze inputs of up to this many words (default 8).
+    -n count     Number of nodes and categories to list (default 10).
+    -a count     Number of adversarial inputs to list (default 5).  Use 0
+                 to skip the search, which is the slow part.
+    -b name      The bot name to match <bot name="name"/> in patterns with.
+"""
+
+import aiml.AimlParser
+from aiml.Analyzer import Analyzer
+from aiml.PatternMgr import PatternMgr
+import getopt
+import glob
+import sys
+import time
+
+if __name__ == "__main__":
+    try: opts, args = getopt.getopt(sys.argv[1:], "l:n:a:b:")
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        sys.exit(2)
+    length = 8
+    limit = 10
+    adversarial = 5
+    botName = None
+    for opt, value in opts:
+        if opt == "-l": length = int(value)
+        elif opt == "-n": limit = int(value)
+        elif opt == "-a": adversarial = int(value)
+        elif opt == "-b": botName = value
+
+    # Input files can contain wildcards; iterate over matches.
+    files = []
+    for arg in args:
+        files.extend(glob.glob(arg))
+    if len(files) < 1:
+        print __doc__
+        sys.exit(2)
+
+    start = time.time()
+    brain = PatternMgr()
+    for f in files:
+        if f.lower().endswith(".brn"):
+            other = PatternMgr()
+            other.restore(f)
+            brain.merge(other)
+        else:
+            parser = aiml.AimlParser.create_parser()
+            parser.parse(f)
+            brain.addMany(parser.getContentHandler().categories.items())
+    if botName is not None:
+        brain.setBotName(botName)
+    print "Loaded %d categories in %.2f seconds.\n" % (brain.numTemplates(), time.time() - start)
+    print Analyzer(brain, length).report(limit, adversarial)
@@ -0,0 +1,212 @@
+"""
+PyAIML synthetic AIML generator.
+
+Usage:
+    aimlgen.py [options] output.aiml
+
+Writes a file of made-up AIML categories, for testing how PyAIML copes
+with brains much larger than the standard set.  The words are drawn from
+a made-up vocabulary, with a Zipf-like distribution so that some words
+are much more common than others, as in real AIML.  The same options and
+seed always produce the same file.
+
+Options:
+    -c count     Number of categories (default 10000).
+    -v words     Size of the vocabulary (default 5000).
+    -w fraction  Fraction of pattern words that are wildcards (* or _)
+                 (default 0.15).
+    -t fraction  Fraction of categories with a <that> pattern (default 0.1).
+    -p fraction  Fraction of categories inside a <topic> (default 0.1).
+    -d depth     Maximum length of <srai> chains (default 3).  Each
+                 category redirects to a category one level down, down
+                 to level 0, whose templates are plain text.
+    -r fraction  Fraction of categories that use <srai> (default 0.3).
+    -f count     Split the output over several files of at most 'count'
+                 categories each, named output-0001.aiml and so on.
+    -s seed      Seed for the random number generator (default 1234).
+"""
+
+import bisect
+import getopt
+import os
+import random
+import sys
+
+_syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "ba",
+              "do", "fi", "gu", "ha", "je", "po", "qui", "wa", "xe", "yo"]
+
+class Generator:
+    """Generates random AIML categories.  See the module documentation for
+    the meaning of the parameters.
+
+    """
+    def __init__(self, vocabulary = 5000, wildcards = 0.15, that = 0.1,
+                 topic = 0.1, sraiDepth = 3, srai = 0.3, seed = 1234):
+        self._rand = random.Random(seed)
+        self._wildcards = wildcards
+        self._that = that
+        self._topic = topic
+        self._sraiDepth = sraiDepth
+        self._srai = srai
+        # Make up the vocabulary.  Word i is picked with a probability
+        # proportional to 1/(i+1).
+        words = set()
+        while len(words) < vocabulary:
+            words.add("".join([self._rand.choice(_syllables) for i in range(self._rand.randint(1, 4))]).upper())
+        self._words = sorted(words)
+        self._rand.shuffle(self._words)
+        self._weights = []
+        total = 0.0
+        for i in range(len(self._words)):
+            total += 1.0 / (i + 1)
+            self._weights.append(total)
+        self._topics = [self._phrase(1, 2) for i in range(20)]
+        # Keys already used, so that every category is unique, and a sample
+        # of the inputs matched by each srai level, for the categories one
+        # level up to redirect to.
+        self._keys = set()
+        self._targets = [[] for i in range(sraiDepth + 1)]
+        self._count = 0
+
+    def _word(self):
+        return self._words[bisect.bisect(self._weights, self._rand.random() * self._weights[-1])]
+
+    def _phrase(self, shortest, longest):
+        return " ".join([self._word() for i in range(self._rand.randint(shortest, longest))])
+
+    def _pattern(self, shortest, longest):
+        words = []
+        for i in range(self._rand.randint(shortest, longest)):
+            if self._rand.random() < self._wildcards:
+                words.append(self._rand.choice(["*", "*", "*", "_"]))
+            else:
+                words.append(self._word())
+        return " ".join(words)
+
+    def _input(self, pattern):
+        """Return an input that matches pattern."""
+        words = []
+        for word in pattern.split():
+            if word in ["*", "_"]: word = self._phrase(1, 2)
+            words.append(word)
+        return " ".join(words)
+
+    def category(self):
+        """Return a new category, as a tuple (pattern, that, topic,
+        template), where template is the AIML text of the template.  that
+        and topic are empty if the category doesn't use them.
+
+        """
+        while True:
+            pattern = self._pattern(1, 6)
+            that = ""
+            if self._rand.random() < self._that:
+                that = self._pattern(1, 4)
+            topic = ""
+            if self._rand.random() < self._topic:
+                topic = self._rand.choice(self._topics)
+            if (pattern, that, topic) not in self._keys:
+                break
+        self._keys.add((pattern, that, topic))
+        self._count += 1
+
+        level = 0
+        if self._sraiDepth > 0 and self._rand.random() < self._srai:
+            level = self._rand.randint(1, self._sraiDepth)
+            while level > 0 and len(self._targets[level - 1]) == 0:
+                level -= 1
+        if level > 0:
+            template = "<srai>%s</srai>" % self._rand.choice(self._targets[level - 1])
+        else:
+            template = self._phrase(3, 12).capitalize() + "."
+            if "*" in pattern or "_" in pattern:
+                template += " <star/>"
+        # Keep a random sample of the inputs for each level (only the
+        # categories without a that or topic can be reached from any
+        # context).
+        if that == "" and topic == "":
+            targets = self._targets[level]
+            if len(targets) < 1000:
+                targets.append(self._input(pattern))
+            else:
+                i = self._rand.randrange(self._count)
+                if i < len(targets): targets[i] = self._input(pattern)
+        return pattern, that, topic, template
+
+    def sampleInputs(self):
+        """Return a sample of inputs that match the categories generated so
+        far.
+
+        """
+        inputs = []
+        for targets in self._targets:
+            inputs.extend(targets)
+        return inputs
+
+def writeAiml(outFile, categories):
+    """Write a list of categories (as returned by Generator.category()) to
+    an open file, as an AIML document.
+
+    """
+    outFile.write('<?xml version="1.0" encoding="UTF-8"?>\n<aiml version="1.0.1">\n')
+    for pattern, that, topic, template in categories:
+        if topic != "": outFile.write('<topic name="%s">' % topic)
+        outFile.write("<category><pattern>%s</pattern>" % pattern)
+        if that != "": outFile.write("<that>%s</that>" % that)
+        outFile.write("<template>%s</template></category>" % template)
+        if topic != "": outFile.write("</topic>")
+        outFile.write("\n")
+    outFile.write("</aiml>\n")
+
+def generate(filename, count, perFile = None, **params):
+    """Generate count categories, and write them to filename (or, if
+    perFile is given, to a series of files with at most perFile
+    categories each).  The remaining arguments are passed on to
+    Generator.  Returns a tuple (filenames, generator).
+
+    """
+    gen = Generator(**params)
+    filenames = []
+    base, ext = os.path.splitext(filename)
+    written = 0
+    while written < count or len(filenames) == 0:
+        n = count - written
+        name = filename
+        if perFile is not None:
+            n = min(n, perFile)
+            name = "%s-%04d%s" % (base, len(filenames) + 1, ext or ".aiml")
+        outFile = file(name, "w")
+        writeAiml(outFile, [gen.category() for i in range(n)])
+        outFile.close()
+        filenames.append(name)
+        written += n
+    return filenames, gen
+
+if __name__ == "__main__":
+    try: opts, args = getopt.getopt(sys.argv[1:], "c:v:w:t:p:d:r:f:s:")
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        sys.exit(2)
+    count = 10000
+    perFile = None
+    params = {}
+    for opt, value in opts:
+        if opt == "-c": count = int(value)
+        elif opt == "-v": params["vocabulary"] = int(value)
+        elif opt == "-w": params["wildcards"] = float(value)
+        elif opt == "-t": params["that"] = float(value)
+        elif opt == "-p": params["topic"] = float(value)
+        elif opt == "-d": params["sraiDepth"] = int(value)
+        elif opt == "-r": params["srai"] = float(value)
+        elif opt == "-f": perFile = int(value)
+        elif opt == "-s": params["seed"] = int(value)
+    if len(args) != 1:
+        print __doc__
+        sys.exit(2)
+
+    filenames, gen = generate(args[0], count, perFile, **params)
+    size = 0
+    for name in filenames:
+        size += os.path.getsize(name)
+    print "Wrote %d categories to %d file(s) (%.2f MB)." % (count, len(filenames), size / 1048576.0)
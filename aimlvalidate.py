@@ -1,56 +1,272 @@
 """
-Python AIML Validator, v1.1
+Python AIML Validator, v1.3
 Author: Cort Stratton (cort@cortstratton.org)
 
 Usage:
-    aimlvalidate.py file1.aiml [file2.aiml ...]
+    aimlvalidate.py [options] file1.aiml [file2.aiml ...]
+
+Options:
+    -b backend   XML parser to use: "sax" (the default) or "expat".
+    -j jobs      Number of worker processes to validate files with
+                 (default: the number of CPUs).
+    -c cachefile Skip files whose contents are listed in cachefile, and add
+                 the files that pass to it.  The cache uses the same
+                 format as the output of sha1sum, so it can also be used
+                 as the manifest for Kernel.learn(trusted=True).
+    -s summary   Write a JSON summary of the results, including how long
+                 each file took to parse, to the file 'summary'.
+    -t           Run the validator's self-test and exit.
 """
 
 # Revision history:
 #
+# 1.3: Files are validated in parallel; added the -j, -c, -s and -t options
+# 1.2: Added the -b option to select the parser backend
 # 1.0.1: Redirected stderr to stdout
 # 1.0: Initial release
 
-import aiml
+import aiml.AimlParser
+import aiml.Utils
+import cStringIO
+import getopt
 import glob
+import json
+import multiprocessing
+import os
 import sys
+import time
 import xml.sax
 
+def validateFile((filename, data, backend)):
+    """Validate the contents of an AIML file.
+
+    Returns a dictionary describing the result, suitable for the JSON
+    summary.  The 'output' entry holds the text to print for the file.
+
+    """
+    # AimlParser prints its errors to stderr; capture them, so that each
+    # file's messages can be printed together.
+    output = cStringIO.StringIO()
+    realStderr = sys.stderr
+    sys.stderr = output
+    parser = aiml.AimlParser.create_parser(backend=backend)
+    handler = parser.getContentHandler()
+    start = time.time()
+    try:
+        try:
+            # Attempt to parse the file.
+            parser.parse(cStringIO.StringIO(data))
+            # Check the number of parse errors.
+            if handler.getNumErrors() == 0:
+                status = "passed"
+                output.write("PASSED\n")
+            else:
+                status = "failed"
+                output.write("FAILED\n")
+        except xml.sax.SAXParseException, msg:
+            # These errors occur if the document does not contain
+            # well-formed XML (e.g. open or unbalanced tags).  If
+            # they occur, parsing the whole document is aborted
+            # immediately.
+            status = "fatal"
+            output.write("FATAL ERROR: %s:%s:%s: %s\n" % (filename, msg.getLineNumber(), msg.getColumnNumber(), msg.getMessage()))
+    finally:
+        sys.stderr = realStderr
+    return {
+        "file": filename,
+        "status": status,
+        "errors": handler.getNumErrors(),
+        "seconds": time.time() - start,
+        "output": output.getvalue(),
+    }
+
+def readCache(filename):
+    """Return the contents of a cache file, as a dictionary mapping
+    content digests to filenames.  The file is read with the same rules as
+    aiml.Utils.readManifest().  A missing cache file is empty.
+
+    """
+    cache = {}
+    if not os.path.exists(filename):
+        return cache
+    inFile = file(filename)
+    for line in inFile:
+        line = line.strip()
+        if len(line) == 0 or line[0] == "#":
+            continue
+        fields = line.split(None, 1)
+        cache[fields[0].lower()] = fields[-1]
+    inFile.close()
+    return cache
+
+def writeCache(filename, cache):
+    """Write a cache file (see readCache())."""
+    outFile = file(filename, "w")
+    for digest, name in sorted(cache.items(), key=lambda item: item[1]):
+        outFile.write("%s  %s\n" % (digest, name))
+    outFile.close()
+
+def validateFiles(files, backend, jobs, cache):
+    """Validate a list of AIML files, using up to 'jobs' worker
+    processes, and skipping files whose content digests are keys of the
+    cache dictionary (see readCache()).
+
+    Returns a tuple (results, digests): the result for each file (see
+    validateFile()), and the digest of each file's contents, in the order
+    the files were given.
+
+    """
+    results = [None] * len(files)
+    digests = [None] * len(files)
+    work = []
+    for i in range(len(files)):
+        inFile = file(files[i], "rb")
+        data = inFile.read()
+        inFile.close()
+        digests[i] = aiml.Utils.contentDigest(data)
+        if cache.has_key(digests[i]):
+            results[i] = {"file": files[i], "status": "cached", "errors": 0,
+                          "seconds": 0.0, "output": "PASSED (cached)\n"}
+        else:
+            work.append((i, (files[i], data, backend)))
+
+    # Validate the remaining files, in parallel if possible.
+    if jobs > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(work)))
+        validated = pool.map(validateFile, [args for i, args in work], 1)
+        pool.close()
+        pool.join()
+    else:
+        validated = map(validateFile, [args for i, args in work])
+    for (i, args), result in zip(work, validated):
+        results[i] = result
+    return results, digests
+
+def selfTest():
+    """Check that files are validated the same way with one worker or
+    several, and that the cache skips exactly the files that passed
+    before.
+
+    """
+    import shutil, tempfile
+    dir = tempfile.mkdtemp()
+    try:
+        good = os.path.join(dir, "good.aiml")
+        bad = os.path.join(dir, "bad.aiml")
+        broken = os.path.join(dir, "broken.aiml")
+        outFile = file(good, "w")
+        outFile.write('<aiml version="1.0"><category><pattern>HI</pattern><template>Hello</template></category></aiml>')
+        outFile.close()
+        outFile = file(bad, "w")
+        outFile.write('<aiml version="1.0"><category><pattern>HI</pattern><template><star index="x"/></template></category></aiml>')
+        outFile.close()
+        outFile = file(broken, "w")
+        outFile.write('<aiml version="1.0"><category><pattern>HI</pattern></aiml>')
+        outFile.close()
+        files = [good, bad, broken]
+        for jobs in [1, 2]:
+            results, digests = validateFiles(files, "sax", jobs, {})
+            assert([r["status"] for r in results] == ["passed", "failed", "fatal"])
+
+        # Only the file that passed goes into the cache, and it's skipped
+        # next time.  The cache is also a valid manifest.
+        cacheFile = os.path.join(dir, "cache.sha1")
+        writeCache(cacheFile, {digests[0]: good})
+        cache = readCache(cacheFile)
+        assert(cache == {digests[0]: good})
+        assert(aiml.Utils.readManifest(cacheFile) == set([digests[0]]))
+        results, digests = validateFiles(files, "sax", 2, cache)
+        assert([r["status"] for r in results] == ["cached", "failed", "fatal"])
+
+        # Changing a file's contents takes it out of the cache.
+        outFile = file(good, "a")
+        outFile.write("\n")
+        outFile.close()
+        results, digests = validateFiles(files, "sax", 1, cache)
+        assert(results[0]["status"] == "passed")
+    finally:
+        shutil.rmtree(dir)
+    print "Self-test passed."
+
 if __name__ == "__main__":
+    try: opts, args = getopt.getopt(sys.argv[1:], "b:j:c:s:t")
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        sys.exit(2)
+    backend = "sax"
+    jobs = multiprocessing.cpu_count()
+    cacheFile = None
+    summaryFile = None
+    for opt, value in opts:
+        if opt == "-b":
+            if value not in aiml.AimlParser.backends:
+                print "Unknown backend: %s" % value
+                sys.exit(2)
+            backend = value
+        elif opt == "-j":
+            jobs = max(1, int(value))
+        elif opt == "-c":
+            cacheFile = value
+        elif opt == "-s":
+            summaryFile = value
+        elif opt == "-t":
+            selfTest()
+            sys.exit(0)
+
     # Need input file(s)!
-    if len(sys.argv) < 2:
+    if len(args) < 1:
         print __doc__
         sys.exit(2)
 
     # AimlParser prints its errors to stderr; we redirect stderr to stdout.
     sys.stderr = sys.stdout
 
-    # Iterate over input files    
+    cache = {}
+    if cacheFile is not None:
+        cache = readCache(cacheFile)
+
+    # Read the input files, and work out which ones need to be validated.
+    # Input files can contain wildcards; iterate over matches.
+    files = []
+    for arg in args:
+        files.extend(glob.glob(arg))
+    start = time.time()
+    results, digests = validateFiles(files, backend, jobs, cache)
+    elapsed = time.time() - start
+
+    # Print the results, in the order the files were given.
     validCount = 0
-    docCount = 0
-    for arg in sys.argv[1:]:
-        # Input files can contain wildcards; iterate over matches
-        for f in glob.glob(arg):
-            parser = xml.sax.make_parser(["aiml.AimlParser"])
-            handler = parser.getContentHandler()
-            docCount += 1
-            print "%s:" % f
-            try:
-                # Attempt to parse the file.
-                parser.parse(f)
-                # Check the number of parse errors.
-                if handler.getNumErrors() == 0:    
-                    validCount += 1
-                    print "PASSED\n"
-                else:
-                    print "FAILED\n"
-            except xml.sax.SAXParseException, msg:
-                # These errors occur if the document does not contain
-                # well-formed XML (e.g. open or unbalanced tags).  If
-                # they occur, parsing the whole document is aborted
-                # immediately.
-                print "FATAL ERROR: %s\n" % msg
-                
+    docCount = len(files)
+    for i in range(len(files)):
+        result = results[i]
+        print "%s:" % files[i]
+        print result["output"]
+        if result["status"] in ["passed", "cached"]:
+            validCount += 1
+            cache[digests[i]] = files[i]
+
+    if cacheFile is not None:
+        writeCache(cacheFile, cache)
+
+    if summaryFile is not None:
+        summary = {
+            "backend": backend,
+            "jobs": jobs,
+            "seconds": elapsed,
+            "documents": docCount,
+            "valid": validCount,
+            "cached": len([r for r in results if r["status"] == "cached"]),
+            "files": [],
+        }
+        for result in results:
+            entry = dict(result)
+            del entry["output"]
+            summary["files"].append(entry)
+        outFile = file(summaryFile, "w")
+        json.dump(summary, outFile, indent=2, sort_keys=True)
+        outFile.close()
+
     # Print final results
     print "%d out of %d documents are AIML 1.0.1 compliant." % (validCount, docCount)
     if docCount == validCount:
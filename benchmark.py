@@ -0,0 +1,349 @@
+"""
+PyAIML benchmark suite.
+
+Usage:
+    benchmark.py [options] [name ...]
+
+Runs a set of reproducible micro-benchmarks for the parts of PyAIML that
+matter most to performance: the AimlParser backends, PatternMgr's add(),
+match() and star(), WordSub.sub(), Utils.sentences(), and the processing
+of templates by tag type.  If any names are given, only the benchmarks
+whose names start with one of them are run (e.g. "parse" or
+"template.srai").
+
+Each benchmark is run 'repeats' times, and the fastest run is reported as
+the time per operation.  The data the benchmarks work on comes from the
+AIML files in the standard/ directory (files that aren't well-formed XML
+are skipped), and the random module is seeded, so that every run does
+the same work.
+
+Options:
+    -r repeats   Number of times to run each benchmark (default 3).
+    -s seed      Seed for the random module (default 1234).
+    -o results   Write the results to the JSON file 'results'.
+    -c baseline  Compare the results to a JSON file written earlier with
+                 -o, and report the benchmarks that have become slower.
+                 The exit status is 1 if any of them have.
+    -t percent   How much slower than the baseline a benchmark has to be
+                 to count as a regression (default 10).
+    -l           List the available benchmarks and exit.
+"""
+
+import aiml
+import aiml.AimlParser
+import aiml.DefaultSubs
+import aiml.Utils
+from aiml.PatternMgr import PatternMgr
+from aiml.WordSub import WordSub
+import cStringIO
+import getopt
+import glob
+import json
+import os
+import platform
+import random
+import sys
+import time
+import xml.sax
+
+def parseFile(filename, backend):
+    """Parse an AIML file with the specified backend, and return the number
+    of categories it contains.
+
+    """
+    parser = aiml.AimlParser.create_parser(backend=backend)
+    parser.parse(filename)
+    return len(parser.getContentHandler().categories)
+
+def aimlFiles(patterns):
+    """Return the AIML files matching the list of glob patterns, leaving
+    out any that aren't well-formed XML.
+
+    """
+    files = []
+    for pattern in patterns:
+        for f in sorted(glob.glob(pattern)):
+            try: parseFile(f, "sax")
+            except xml.sax.SAXParseException, msg:
+                print "Skipping %s (%s)" % (f, msg)
+                continue
+            files.append(f)
+    return files
+
+class BenchmarkData:
+    """The data shared by the benchmarks.  Everything is built on demand,
+    and only once.
+
+    """
+    def __init__(self, files, seed):
+        self.files = files
+        self.seed = seed
+        self._categories = None
+        self._brain = None
+        self._inputs = None
+
+    def categories(self):
+        """Return a list of all of the ((pattern,that,topic), template)
+        pairs in the AIML files, in the order they were parsed.
+
+        """
+        if self._categories is None:
+            self._categories = []
+            for f in self.files:
+                parser = aiml.AimlParser.create_parser()
+                parser.parse(f)
+                self._categories.extend(parser.getContentHandler().categories.items())
+        return self._categories
+
+    def brain(self):
+        """Return a PatternMgr containing all of the categories."""
+        if self._brain is None:
+            self._brain = PatternMgr()
+            self._brain.addMany(self.categories())
+        return self._brain
+
+    def inputs(self, count = 2000):
+        """Return a list of (input, that, topic) tuples to match, made by
+        filling in the wildcards of randomly-chosen patterns.
+
+        """
+        if self._inputs is None:
+            rand = random.Random(self.seed)
+            words = ["YES", "THE CAT", "MY NAME IS BOB", "SOMETHING ELSE ENTIRELY"]
+            def fill(pattern):
+                result = []
+                for word in pattern.split():
+                    if word in ["*", "_"]: word = rand.choice(words)
+                    result.append(word)
+                return " ".join(result)
+            self._inputs = []
+            for (pattern, that, topic), template in rand.sample(self.categories(), count):
+                self._inputs.append((fill(pattern), fill(that), fill(topic)))
+        return self._inputs
+
+# The benchmarks.  Each one is a function that takes a BenchmarkData
+# object, does any setup that shouldn't be timed, and returns a tuple
+# (func, ops): func is the function to time, and ops is the number of
+# operations it performs.
+
+def benchParse(backend):
+    def bench(data):
+        files = [file(f, "rb").read() for f in data.files]
+        def run():
+            for contents in files:
+                parser = aiml.AimlParser.create_parser(backend=backend)
+                parser.parse(cStringIO.StringIO(contents))
+        return run, len(files)
+    return bench
+
+def benchAdd(data):
+    categories = data.categories()
+    def run():
+        brain = PatternMgr()
+        for key, template in categories:
+            brain.add(key, template)
+    return run, len(categories)
+
+def benchAddMany(data):
+    categories = data.categories()
+    def run():
+        PatternMgr().addMany(categories)
+    return run, len(categories)
+
+def benchMatch(data):
+    brain = data.brain()
+    inputs = data.inputs()
+    def run():
+        for input, that, topic in inputs:
+            brain.match(input, that, topic)
+    return run, len(inputs)
+
+def benchStar(data):
+    brain = data.brain()
+    inputs = data.inputs()
+    def run():
+        for input, that, topic in inputs:
+            brain.star("star", input, that, topic, 1)
+    return run, len(inputs)
+
+def benchSubs(data):
+    subber = WordSub(aiml.DefaultSubs.defaultNormal)
+    rand = random.Random(data.seed)
+    texts = []
+    for input, that, topic in data.inputs():
+        texts.append(" ".join([input.lower(), "I'm sure you're right, isn't it?"]))
+    rand.shuffle(texts)
+    def run():
+        for text in texts:
+            subber.sub(text)
+    return run, len(texts)
+
+def benchSentences(data):
+    rand = random.Random(data.seed)
+    sentences = [" ".join(input.split()) for input, that, topic in data.inputs()]
+    text = ""
+    for sentence in sentences:
+        text += sentence + rand.choice([". ", "? ", "! "])
+    def run():
+        aiml.Utils.sentences(text)
+    return run, len(sentences)
+
+# One category for each tag type to benchmark.  Each template is mostly
+# made up of the tag in question.
+_templateAiml = """<aiml version="1.0.1">
+<category><pattern>BENCH TEXT</pattern><template>Just some text.</template></category>
+<category><pattern>BENCH BOT</pattern><template><bot name="name"/></template></category>
+<category><pattern>BENCH CONDITION</pattern><template><condition name="mood">
+    <li value="happy">Yay</li><li value="sad">Boo</li><li>Meh</li></condition></template></category>
+<category><pattern>BENCH FORMAL *</pattern><template><formal><star/></formal></template></category>
+<category><pattern>BENCH GENDER *</pattern><template><gender><star/></gender></template></category>
+<category><pattern>BENCH GET</pattern><template><get name="mood"/></template></category>
+<category><pattern>BENCH PERSON *</pattern><template><person><star/></person></template></category>
+<category><pattern>BENCH PERSON2 *</pattern><template><person2><star/></person2></template></category>
+<category><pattern>BENCH RANDOM</pattern><template><random><li>One</li><li>Two</li><li>Three</li></random></template></category>
+<category><pattern>BENCH SENTENCE *</pattern><template><sentence><star/></sentence></template></category>
+<category><pattern>BENCH SET</pattern><template><set name="mood">happy</set></template></category>
+<category><pattern>BENCH SRAI</pattern><template><srai>BENCH TEXT</srai></template></category>
+<category><pattern>BENCH STAR *</pattern><template><star/></template></category>
+<category><pattern>BENCH THAT</pattern><template><that/></template></category>
+<category><pattern>BENCH THINK</pattern><template><think><set name="mood">sad</set></think></template></category>
+<category><pattern>BENCH UPPERCASE *</pattern><template><uppercase><star/></uppercase></template></category>
+</aiml>
+"""
+
+def benchTemplate(tag):
+    def bench(data):
+        kern = aiml.Kernel()
+        kern.verbose(False)
+        kern.learn(_templateAiml)
+        input = "bench %s" % tag
+        if tag in ["formal", "gender", "person", "person2", "sentence", "star", "uppercase"]:
+            input += " he told her I was with you"
+        count = 500
+        def run():
+            for i in range(count):
+                kern.respond(input)
+        return run, count
+    return bench
+
+benchmarks = [
+    ("parse.sax",           benchParse("sax")),
+    ("parse.expat",         benchParse("expat")),
+    ("patternmgr.add",      benchAdd),
+    ("patternmgr.addmany",  benchAddMany),
+    ("patternmgr.match",    benchMatch),
+    ("patternmgr.star",     benchStar),
+    ("wordsub.sub",         benchSubs),
+    ("utils.sentences",     benchSentences),
+]
+for _tag in ["text", "bot", "condition", "formal", "gender", "get", "person",
+             "person2", "random", "sentence", "set", "srai", "star", "that",
+             "think", "uppercase"]:
+    benchmarks.append(("template.%s" % _tag, benchTemplate(_tag)))
+
+def runBenchmark(bench, data, repeats):
+    """Run a benchmark 'repeats' times, and return a tuple (seconds, ops)
+    where seconds is the time per operation taken by the fastest run.
+
+    """
+    # Reseed before each benchmark, so that the ones that use the random
+    # module (e.g. <random> templates) don't depend on which benchmarks
+    # ran before them.
+    random.seed(data.seed)
+    func, ops = bench(data)
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / ops, ops
+
+def compareResults(results, baseline, threshold):
+    """Print a comparison of results with baseline, and return the names
+    of the benchmarks that are more than threshold (a fraction) slower.
+
+    """
+    regressions = []
+    print "\nComparison with baseline:"
+    for name in sorted(results.keys()):
+        if not baseline.has_key(name):
+            print "  %-24s (not in baseline)" % name
+            continue
+        ratio = results[name]["seconds"] / baseline[name]["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print "  %-24s %6.2fx%s" % (name, ratio, flag)
+    return regressions
+
+if __name__ == "__main__":
+    try: opts, args = getopt.getopt(sys.argv[1:], "r:s:o:c:t:l")
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        sys.exit(2)
+    repeats = 3
+    seed = 1234
+    outFile = None
+    baselineFile = None
+    threshold = 10.0
+    for opt, value in opts:
+        if opt == "-r": repeats = int(value)
+        elif opt == "-s": seed = int(value)
+        elif opt == "-o": outFile = value
+        elif opt == "-c": baselineFile = value
+        elif opt == "-t": threshold = float(value)
+        elif opt == "-l":
+            for name, bench in benchmarks: print name
+            sys.exit(0)
+
+    selected = []
+    for name, bench in benchmarks:
+        if len(args) == 0 or [a for a in args if name.startswith(a)]:
+            selected.append((name, bench))
+    if len(selected) == 0:
+        print "No benchmarks match %s." % " ".join(args)
+        sys.exit(2)
+
+    # AimlParser reports invalid categories on stderr, and Kernels report
+    # unmatched input; those messages aren't interesting here.
+    realStderr = sys.stderr
+    sys.stderr = open(os.devnull, "w")
+
+    files = aimlFiles([os.path.join(os.path.dirname(__file__) or ".", "standard", "*.aiml")])
+    if len(files) == 0:
+        print "No AIML files found."
+        sys.exit(1)
+    data = BenchmarkData(files, seed)
+
+    print "Running %d benchmarks, best of %d runs:" % (len(selected), repeats)
+    results = {}
+    for name, bench in selected:
+        seconds, ops = runBenchmark(bench, data, repeats)
+        results[name] = {"seconds": seconds, "ops": ops}
+        print "  %-24s %10.2f usec/op  %10.0f ops/s" % (name, seconds * 1e6, 1.0 / seconds)
+    sys.stderr = realStderr
+
+    if outFile is not None:
+        out = file(outFile, "w")
+        json.dump({
+            "version": aiml.Kernel().version(),
+            "python": platform.python_version(),
+            "seed": seed,
+            "repeats": repeats,
+            "results": results,
+        }, out, indent=2, sort_keys=True)
+        out.close()
+
+    if baselineFile is not None:
+        inFile = file(baselineFile)
+        baseline = json.load(inFile)["results"]
+        inFile.close()
+        regressions = compareResults(results, baseline, threshold / 100.0)
+        if len(regressions) > 0:
+            print "%d of %d benchmarks are more than %g%% slower than the baseline." % (
+                len(regressions), len(results), threshold)
+            sys.exit(1)
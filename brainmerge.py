@@ -0,0 +1,65 @@
+"""
+PyAIML brain merger.
+
+Usage:
+    brainmerge.py [-n name] -o output.brn input1.brn [input2.brn ...]
+
+Merges several brain files (as written by Kernel.saveBrain()) into one,
+without reparsing any AIML.  Where more than one of the input files
+contains a category with the same pattern, that and topic, the one from
+the file listed last wins.
+
+Options:
+    -o output    The file to write the merged brain to (required).
+    -n name      The bot name to store in the merged brain.  By default,
+                 the name stored in the first input file is kept.
+"""
+
+from aiml.PatternMgr import PatternMgr
+import getopt
+import glob
+import sys
+import time
+
+if __name__ == "__main__":
+    try: opts, args = getopt.getopt(sys.argv[1:], "o:n:")
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        sys.exit(2)
+    outFile = None
+    botName = None
+    for opt, value in opts:
+        if opt == "-o": outFile = value
+        elif opt == "-n": botName = value
+
+    # Input files can contain wildcards; iterate over matches.
+    files = []
+    for arg in args:
+        files.extend(glob.glob(arg))
+    if outFile is None or len(files) < 1:
+        print __doc__
+        sys.exit(2)
+
+    start = time.time()
+    # The first brain can simply be restored; the rest are merged into it.
+    brain = PatternMgr()
+    for i, f in enumerate(files):
+        print "Merging %s..." % f,
+        fileStart = time.time()
+        if i == 0:
+            brain.restore(f)
+            numCategories = brain.numTemplates()
+        else:
+            other = PatternMgr()
+            other.restore(f)
+            numCategories = other.numTemplates()
+            brain.merge(other)
+        print "done (%d categories in %.2f seconds)" % (numCategories, time.time() - fileStart)
+    if botName is not None:
+        brain.setBotName(botName)
+
+    print "Saving %s..." % outFile,
+    brain.save(outFile)
+    print "done"
+    print "Merged %d files into %d categories in %.2f seconds." % (len(files), brain.numTemplates(), time.time() - start)
@@ -0,0 +1,155 @@
+"""
+PyAIML scaling benchmark.
+
+Usage:
+    scaling.py [options]
+
+Measures how learning, memory use, brain loading and matching scale with
+the number of categories, using synthetic AIML made by aimlgen.py.  For
+each category count, a fresh process learns the generated AIML, saves
+and reloads the brain, and matches a sample of inputs.  The results are
+written as CSV and plotted as text.
+
+Options:
+    -c counts    Comma-separated list of category counts
+                 (default 1000,10000,100000).
+    -o file      Write the results to a CSV file, as well as printing
+                 them.
+    -k           Keep the generated AIML and brain files (they're written
+                 to a temporary directory, which is normally deleted).
+
+The -v, -w, -t, -p, -d, -r and -s options are passed on to the AIML
+generator; see aimlgen.py.
+"""
+
+import aiml
+from aiml.PatternMgr import PatternMgr
+import aimlgen
+import getopt
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# The columns of the results.
+columns = ["categories", "aiml_mb", "learn_s", "memory_mb", "brain_mb",
+           "load_s", "match_p50_us", "match_p99_us"]
+
+def memoryUsage():
+    """Return the memory used by the current process, in MB."""
+    try:
+        inFile = open("/proc/self/statm")
+        pages = int(inFile.read().split()[1])
+        inFile.close()
+        return pages * resource.getpagesize() / 1048576.0
+    except (IOError, OSError):
+        # Not Linux; settle for the peak.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def measure(filenames, brainFile, inputs, results):
+    """Learn the AIML files, save the brain and load it again, and match
+    the inputs against it.  Runs in a process of its own, so that the
+    memory measurements start from scratch, and puts a dictionary of
+    results on the results queue.
+
+    """
+    kern = aiml.Kernel()
+    kern.verbose(False)
+    before = memoryUsage()
+    start = time.time()
+    for f in filenames:
+        kern.learn(f)
+    learnTime = time.time() - start
+    memory = memoryUsage() - before
+    kern.saveBrain(brainFile)
+    kern.resetBrain()
+
+    brain = PatternMgr()
+    start = time.time()
+    brain.restore(brainFile)
+    loadTime = time.time() - start
+
+    latencies = []
+    for input in inputs:
+        start = time.time()
+        brain.match(input, u"", u"")
+        latencies.append(time.time() - start)
+    latencies.sort()
+    results.put({
+        "learn_s": learnTime,
+        "memory_mb": memory,
+        "brain_mb": os.path.getsize(brainFile) / 1048576.0,
+        "load_s": loadTime,
+        "match_p50_us": latencies[len(latencies) / 2] * 1e6,
+        "match_p99_us": latencies[min(len(latencies) - 1, len(latencies) * 99 / 100)] * 1e6,
+    })
+
+def plot(rows, column, width = 50):
+    """Print a text bar chart of one column of the results."""
+    print "\n%s:" % column
+    largest = max([row[column] for row in rows]) or 1
+    for row in rows:
+        bar = "#" * int(round(width * row[column] / largest))
+        print "  %10d %12.3f %s" % (row["categories"], row[column], bar)
+
+if __name__ == "__main__":
+    try: opts, args = getopt.getopt(sys.argv[1:], "c:o:kv:w:t:p:d:r:s:")
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        sys.exit(2)
+    counts = [1000, 10000, 100000]
+    csvFile = None
+    keep = False
+    params = {}
+    for opt, value in opts:
+        if opt == "-c": counts = [int(c) for c in value.split(",")]
+        elif opt == "-o": csvFile = value
+        elif opt == "-k": keep = True
+        elif opt == "-v": params["vocabulary"] = int(value)
+        elif opt == "-w": params["wildcards"] = float(value)
+        elif opt == "-t": params["that"] = float(value)
+        elif opt == "-p": params["topic"] = float(value)
+        elif opt == "-d": params["sraiDepth"] = int(value)
+        elif opt == "-r": params["srai"] = float(value)
+        elif opt == "-s": params["seed"] = int(value)
+
+    tempDir = tempfile.mkdtemp(prefix="pyaiml-scaling-")
+    rows = []
+    try:
+        for count in counts:
+            print "%d categories..." % count,
+            sys.stdout.flush()
+            filenames, gen = aimlgen.generate(os.path.join(tempDir, "scale%d.aiml" % count),
+                                              count, 100000, **params)
+            aimlSize = 0
+            for f in filenames:
+                aimlSize += os.path.getsize(f)
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure, args=(filenames,
+                os.path.join(tempDir, "scale%d.brn" % count), gen.sampleInputs(), results))
+            process.start()
+            row = results.get()
+            process.join()
+            row["categories"] = count
+            row["aiml_mb"] = aimlSize / 1048576.0
+            rows.append(row)
+            print "learned in %.2f seconds" % row["learn_s"]
+    finally:
+        if keep: print "Generated files are in %s" % tempDir
+        else: shutil.rmtree(tempDir)
+
+    lines = [",".join(columns)]
+    for row in rows:
+        lines.append(",".join([str(row[c]) for c in columns]))
+    print
+    print "\n".join(lines)
+    if csvFile is not None:
+        outFile = file(csvFile, "w")
+        outFile.write("\n".join(lines) + "\n")
+        outFile.close()
+    for column in columns[2:]:
+        plot(rows, column)
@@ -1,34 +1,243 @@
 """
-This file contains the PyAIML stress test.  It creates two bots, and connects
-them in a cyclic loop.  A lot of output is generated; piping the results to
-a log file is highly recommended.
+This file contains the PyAIML stress test, a load generator that simulates
+a number of users talking to a bot at the same time.
+
+Usage:
+    stress.py [options]
+
+Each simulated user has a session of its own, and runs in a thread of its
+own.  The users either replay the conversations in a transcript file, or
+make up their own conversations, which mix stock phrases with fragments
+of the bot's previous responses.  At the end, the stress test reports the
+throughput, the distribution of respond() latencies, and the number of
+errors and empty responses (i.e. input that didn't match any category).
+
+Options:
+    -u users     Number of simultaneous users (default 10).  When
+                 replaying a transcript, each of its sessions is a user,
+                 and at most this many of them run at once.
+    -n count     Number of exchanges per user in a generated
+                 conversation (default 100).
+    -k kernels   Number of Kernels to spread the users over (default 1).
+                 The extra Kernels are clones of the first one, sharing
+                 its brain.
+    -b brain     Load the bot's brain from a file, instead of learning
+                 the standard AIML set.
+    -t file      Replay the conversations in a transcript file.
+    -w file      Record every exchange in a transcript file, which can be
+                 replayed later with -t.  See aiml.Kernel.setTranscript().
+    -s seed      Seed for generated conversations (default 1234).
+    -v           Print every exchange as it happens.
 """
 
 import aiml
+import aiml.Utils
+import getopt
+import random
+import sys
+import threading
+import time
+
+# Stock phrases for generated conversations.
+_phrases = [
+    "Hello", "Hi there", "What is your name", "How are you", "My name is Bob",
+    "Who created you", "What is AIML", "Tell me a joke", "Do you like movies",
+    "What time is it", "I like pizza", "Why", "Yes", "No", "Where are you",
+    "Are you a robot", "What do you think about that", "Goodbye",
+    "askquestion",
+]
+
+def generatedConversation(seed, count):
+    """Return a function that makes up the next input of a conversation,
+    given the bot's previous response.
+
+    """
+    rand = random.Random(seed)
+    state = {"left": count}
+    def nextInput(response):
+        if state["left"] == 0:
+            return None
+        state["left"] -= 1
+        # Talk back to the bot some of the time, as the bots in the
+        # original stress test did.
+        if response and rand.random() < 0.4:
+            words = aiml.Utils.sentences(response)[0].split()
+            if len(words) > 0:
+                start = rand.randrange(len(words))
+                return " ".join(words[start:start+8])
+        return rand.choice(_phrases)
+    return nextInput
+
+def replayedConversation(inputs):
+    """Return a function that replays a list of inputs."""
+    inputs = list(inputs)
+    inputs.reverse()
+    def nextInput(response):
+        if len(inputs) == 0:
+            return None
+        return inputs.pop()
+    return nextInput
+
+class User:
+    """A simulated user, who holds one or more conversations with a
+    Kernel, one after another.
+
+    """
+    def __init__(self, kern, verbose):
+        self._kern = kern
+        self._verbose = verbose
+        self.latencies = []
+        self.errors = []
+        self.empty = 0
+
+    def converse(self, sessionID, nextInput):
+        response = ""
+        while True:
+            input = nextInput(response)
+            if input is None:
+                break
+            start = time.time()
+            try:
+                response = self._kern.respond(input, sessionID)
+            except Exception, e:
+                self.latencies.append(time.time() - start)
+                self.errors.append("%s: %s" % (e.__class__.__name__, e))
+                response = ""
+                continue
+            self.latencies.append(time.time() - start)
+            if response == "":
+                self.empty += 1
+            if self._verbose:
+                print "%s> %s\n%s: %s" % (sessionID, input, sessionID, response)
+
+def percentile(values, p):
+    """Return the p'th percentile of a sorted list of values."""
+    if len(values) == 0:
+        return 0.0
+    index = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+# Upper bounds of the latency histogram's buckets, in milliseconds.
+_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def report(users, elapsed):
+    """Print the statistics gathered by a list of Users."""
+    latencies = []
+    errors = []
+    empty = 0
+    for user in users:
+        latencies.extend(user.latencies)
+        errors.extend(user.errors)
+        empty += user.empty
+    latencies.sort()
+    total = len(latencies)
+    if total == 0:
+        print "No exchanges took place."
+        return
+    print "%d exchanges in %.2f seconds (%.1f per second)" % (total, elapsed, total / elapsed)
+    print "Latency (ms): p50 %.2f  p95 %.2f  p99 %.2f  max %.2f" % tuple(
+        [percentile(latencies, p) * 1000 for p in [50, 95, 99]] + [latencies[-1] * 1000])
+    print "Errors: %d (%.2f%%)  No match: %d (%.2f%%)" % (
+        len(errors), 100.0 * len(errors) / total, empty, 100.0 * empty / total)
+    for error in sorted(set(errors))[:5]:
+        print "  %s" % error
+
+    print "\nLatency histogram:"
+    counts = [0] * (len(_buckets) + 1)
+    for latency in latencies:
+        i = 0
+        while i < len(_buckets) and latency * 1000 >= _buckets[i]:
+            i += 1
+        counts[i] += 1
+    for i in range(len(counts)):
+        if i < len(_buckets): label = "< %d ms" % _buckets[i]
+        else: label = ">= %d ms" % _buckets[-1]
+        print "  %10s %7d %s" % (label, counts[i], "#" * int(round(50.0 * counts[i] / total)))
+
+if __name__ == "__main__":
+    try: opts, args = getopt.getopt(sys.argv[1:], "u:n:k:b:t:w:s:v")
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        sys.exit(2)
+    numUsers = 10
+    count = 100
+    numKernels = 1
+    brainFile = None
+    replayFile = None
+    recordFile = None
+    seed = 1234
+    verbose = False
+    for opt, value in opts:
+        if opt == "-u": numUsers = max(1, int(value))
+        elif opt == "-n": count = int(value)
+        elif opt == "-k": numKernels = max(1, int(value))
+        elif opt == "-b": brainFile = value
+        elif opt == "-t": replayFile = value
+        elif opt == "-w": recordFile = value
+        elif opt == "-s": seed = int(value)
+        elif opt == "-v": verbose = True
+
+    # Create the kernels
+    kern = aiml.Kernel()
+    kern.verbose(False)
+    print "Initializing Kernel"
+    if brainFile is not None:
+        kern.bootstrap(brainFile=brainFile)
+    else:
+        kern.bootstrap(learnFiles="std-startup.xml", commands="load aiml b")
+    random.seed(seed)
+    if recordFile is not None:
+        transcript = file(recordFile, "w")
+        kern.setTranscript(transcript)
+    kernels = [kern]
+    while len(kernels) < numKernels:
+        kernels.append(kern.clone())
+
+    # Work out who says what.  Each conversation is a tuple (sessionID,
+    # nextInput), and the users take turns picking them up.
+    conversations = []
+    if replayFile is not None:
+        sessions = {}
+        order = []
+        for sessionID, input, response in aiml.Utils.readTranscript(replayFile):
+            if not sessions.has_key(sessionID):
+                sessions[sessionID] = []
+                order.append(sessionID)
+            sessions[sessionID].append(input)
+        for sessionID in order:
+            conversations.append((sessionID, replayedConversation(sessions[sessionID])))
+        numUsers = min(numUsers, len(conversations))
+    else:
+        for i in range(numUsers):
+            conversations.append(("user%d" % i, generatedConversation(seed + i, count)))
+    conversations.reverse()
+    conversationLock = threading.Lock()
+
+    users = []
+    threads = []
+    for i in range(numUsers):
+        user = User(kernels[i % len(kernels)], verbose)
+        def run(user = user):
+            while True:
+                conversationLock.acquire()
+                try:
+                    if len(conversations) == 0:
+                        return
+                    sessionID, nextInput = conversations.pop()
+                finally:
+                    conversationLock.release()
+                user.converse(sessionID, nextInput)
+        users.append(user)
+        threads.append(threading.Thread(target = run))
+
+    print "Running %d users on %d kernels..." % (numUsers, len(kernels))
+    start = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.time() - start
 
-# Create the kernels
-kern1 = aiml.Kernel()
-kern1.verbose(False)
-kern2 = aiml.Kernel()
-kern2.verbose(False)
-
-# Initialize the kernels
-print "Initializing Kernel #1"
-kern1.bootstrap(learnFiles="std-startup.xml", commands="load aiml b")
-kern1.saveBrain("standard.brn")
-print "\nInitializing Kernel #2"
-kern2.bootstrap(brainFile="standard.brn")
-
-# Start the bots off with some basic input.
-response = "askquestion"
-
-# Off they go!
-while True:
-    response = kern1.respond(response).strip()
-    print "1:", response
-    response = kern2.respond(response).strip()
-    print "2:", response
-    # If the robots have run out of things to say, force one of them
-    # to break the ice.
-    if response == "":
-        response = "askquestion"
+    if recordFile is not None:
+        kern.setTranscript(None)
+        transcript.close()
+    report(users, elapsed)